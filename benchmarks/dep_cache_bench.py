@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+"""Time the dependency computation of tf_dep_finder on all the .tf files of a folder,
+without cache, with an empty (cold) parse cache and with a warm one.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_dep_finder
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tf-root', required=True,
+                      help='directory where to look for terraform files')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='number of warm runs')
+  return parser.parse_args(argv)
+
+def timed(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return time.perf_counter() - start, result
+
+def main(args):
+  tf_root = os.path.normpath(args.tf_root)
+  tmp_dir = tempfile.mkdtemp()
+  cache_file = os.path.join(tmp_dir, 'deps_cache.json')
+  try:
+    no_cache_time, expected = timed(tf_dep_finder.compute_deps, tf_root)
+    cold_time, cold = timed(tf_dep_finder.compute_deps, tf_root, cache_file)
+    warm_times = []
+    for i in range(args.repeat):
+      warm_time, warm = timed(tf_dep_finder.compute_deps, tf_root, cache_file)
+      warm_times.append(warm_time)
+      if warm != expected:
+        print('warm run %d computed a different dependency graph' % (i))
+        sys.exit(1)
+    if cold != expected:
+      print('cold run computed a different dependency graph')
+      sys.exit(1)
+    print('dependencies: %d' % (sum([len(d) for d in expected.values()])))
+    print('cache size:   %d bytes' % (os.path.getsize(cache_file)))
+    print('no cache:     %.4fs' % (no_cache_time))
+    print('cold cache:   %.4fs' % (cold_time))
+    print('warm cache:   %.4fs (best of %d)' % (min(warm_times), args.repeat))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+  main(parse_args(sys.argv[1:]))
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""End-to-end benchmark of the scripts on a group folder hierarchy, either an
+existing one or one generated with gen_org. Each phase runs in its own process,
+so that its peak RSS can be measured, and the results are written as JSON, to be
+compared between commits with --compare.
+Phases:
+- parse: read and validate the group configuration files (load_group_model)
+- render: render the terraform code of all groups in memory
+- ci_groups: full tf_generator ci-groups run, writing the terraform files
+- ci_groups_noop: incremental ci-groups run with nothing to regenerate
+- dep_scan: parse the generated terraform files and link the packages
+- build_waves: build waves of all the packages
+- codeowners: generate the CODEOWNERS file
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import tf_dep_finder
+import codeowners_gen
+import instrumentation
+import gen_org
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+def peak_rss_kb():
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # bytes on macOS, kilobytes elsewhere
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+def phase_parse(ctx):
+  groups = tf_generator.load_group_model(ctx['resources'], ctx['domain'])
+  return {'groups': len(groups), 'memberships': sum([len(g['membership']) for g in groups.values()])}
+
+def phase_render(ctx):
+  groups = tf_generator.load_group_model(ctx['resources'], ctx['domain'])
+  start = time.perf_counter()
+  out = io.StringIO()
+  for group in groups.values():
+    tf_generator.tf_group(group, ctx['parent']).write_tf(out)
+    for member_id, roles in group['membership'].items():
+      tf_generator.tf_member(group['full_name'], member_id, tf_generator.ROLE_NAMES[roles]).write_tf(out)
+  # only the rendering is timed, not the parsing
+  return {'bytes': len(out.getvalue()), 'seconds': time.perf_counter() - start}
+
+def ci_groups(ctx):
+  args = tf_generator.parse_args(['--resources', ctx['resources'], '--config', ctx['config'],
+                                  '--template-dir', TEMPLATE_DIR, '--tf-out', ctx['tf_out'],
+                                  '--incremental', '--jobs', str(ctx['jobs']), 'ci-groups'])
+  if not args.func(args):
+    raise RuntimeError('ci-groups failed')
+
+def phase_ci_groups(ctx):
+  if os.path.exists(ctx['tf_out']):
+    shutil.rmtree(ctx['tf_out'])
+  ci_groups(ctx)
+  files = [os.path.join(d, f) for d, _, fs in os.walk(ctx['tf_out']) for f in fs]
+  return {'files': len(files), 'bytes': sum([os.path.getsize(f) for f in files])}
+
+def phase_ci_groups_noop(ctx):
+  ci_groups(ctx)
+
+def phase_dep_scan(ctx):
+  tf_packages, backend2package = tf_dep_finder.scan_packages(ctx['tf_out'])
+  deps = tf_dep_finder.link_packages(tf_packages, backend2package)
+  return {'packages': len(tf_packages), 'dependencies': sum([len(d) for d in deps.values()])}
+
+def phase_build_waves(ctx):
+  waves = tf_dep_finder.plan_build_steps([(ctx['tf_out'], True)], ctx['tf_out'], waves=True)
+  return {'waves': len(waves), 'packages': sum([len(w) for w in waves])}
+
+def phase_codeowners(ctx):
+  args = codeowners_gen.parse_args(['--repo-root', ctx['resources'], '--codeowners-out', ctx['codeowners']])
+  codeowners_gen.parse_owners(args)
+  return {'bytes': os.path.getsize(ctx['codeowners'])}
+
+PHASES = [
+  ('parse', phase_parse),
+  ('render', phase_render),
+  ('ci_groups', phase_ci_groups),
+  ('ci_groups_noop', phase_ci_groups_noop),
+  ('dep_scan', phase_dep_scan),
+  ('build_waves', phase_build_waves),
+  ('codeowners', phase_codeowners),
+]
+
+def run_child(func, ctx, conn):
+  logging.getLogger().setLevel(logging.ERROR)
+  try:
+    instrumentation.reset()
+    start = time.perf_counter()
+    details = func(ctx) or {}
+    elapsed = details.pop('seconds', time.perf_counter() - start)
+    # spans and counters recorded by the scripts during the phase
+    timing = instrumentation.report()
+    if timing['spans']:
+      details['spans'] = dict([(k, round(v['seconds'], 6)) for k, v in timing['spans'].items()])
+    if timing['counters']:
+      details['counters'] = timing['counters']
+    conn.send((True, elapsed, peak_rss_kb(), details))
+  except Exception as e:
+    conn.send((False, 0, 0, {'error': repr(e)}))
+  conn.close()
+
+def run_phase(func, ctx):
+  """
+  Runs a phase in a new process. Returns (seconds, peak RSS in KB, details).
+  """
+  mp = multiprocessing.get_context('fork') if hasattr(os, 'fork') else multiprocessing
+  parent_conn, child_conn = mp.Pipe(False)
+  proc = mp.Process(target=run_child, args=(func, ctx, child_conn))
+  proc.start()
+  ok, elapsed, rss, details = parent_conn.recv()
+  proc.join()
+  if not ok:
+    raise RuntimeError('phase failed: %s' % (details['error']))
+  return elapsed, rss, details
+
+def git_commit():
+  try:
+    out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return out.stdout.strip() or None
+  except OSError:
+    return None
+
+def compare(results, base_file):
+  with open(base_file, 'r') as f:
+    base = json.load(f)
+  print('%-16s %10s %10s %8s %10s %10s' % ('phase', 'base (s)', 'now (s)', 'ratio', 'base RSS', 'now RSS'))
+  for name, _ in PHASES:
+    if not name in results['phases'] or not name in base.get('phases', {}):
+      continue
+    now, old = results['phases'][name], base['phases'][name]
+    print('%-16s %10.3f %10.3f %8.2f %9dK %9dK' % (name, old['seconds'], now['seconds'],
+                                                    now['seconds'] / old['seconds'] if old['seconds'] else 0,
+                                                    old['peak_rss_kb'], now['peak_rss_kb']))
+
+def main(args):
+  work_dir = tempfile.mkdtemp()
+  try:
+    ctx = {'domain': 'example.com', 'parent': 'customers/C0bench', 'jobs': args.jobs,
+           'tf_out': os.path.join(work_dir, 'terraform'), 'codeowners': os.path.join(work_dir, 'CODEOWNERS')}
+    if args.resources:
+      ctx['resources'] = os.path.normpath(args.resources)
+      ctx['config'] = args.config
+      dataset = {'resources': args.resources}
+    else:
+      ctx['resources'] = os.path.join(work_dir, 'group_root')
+      ctx['config'] = os.path.join(work_dir, 'config.yaml')
+      dataset = gen_org.generate_org(ctx['resources'], **gen_org.generator_kwargs(args))
+      dataset['generator'] = gen_org.generator_kwargs(args)
+      gen_org.write_config(ctx['config'])
+    ctx['domain'] = tf_generator.get_config(ctx['config'], ['group_domain'])['group_domain']
+    results = {'commit': git_commit(), 'python': platform.python_version(), 'time': time.time(),
+               'dataset': dataset, 'baseline_rss_kb': peak_rss_kb(), 'phases': {}}
+    selected = args.phases.split(',') if args.phases else [name for name, _ in PHASES]
+    for name, func in PHASES:
+      # the phases working on the generated terraform files need ci_groups
+      if not name in selected and not (name == 'ci_groups' and set(selected) & set(['ci_groups_noop', 'dep_scan', 'build_waves'])):
+        continue
+      times = []
+      rss = 0
+      for i in range(args.repeat):
+        elapsed, phase_rss, details = run_phase(func, ctx)
+        times.append(elapsed)
+        rss = max(rss, phase_rss)
+      results['phases'][name] = dict(details, seconds=min(times), all_seconds=times, peak_rss_kb=rss)
+      summary = dict([(k, v) for k, v in details.items() if k != 'counters'])
+      print('%-16s %8.3fs %9dK  %s' % (name, min(times), rss, json.dumps(details.get('spans') or summary, sort_keys=True)))
+    if args.output:
+      with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+      compare(results, args.compare)
+  finally:
+    shutil.rmtree(work_dir)
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--resources', required=False,
+                      help='existing group folder to use, instead of generating one')
+  parser.add_argument('--config', required=False,
+                      help='tf_generator configuration file, required with --resources')
+  parser.add_argument('--phases', required=False,
+                      help='comma separated list of phases to run (default: all)')
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='number of runs of each phase, the best time is reported')
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='number of worker processes used by tf_generator')
+  parser.add_argument('--output', required=False,
+                      help='write the results to this JSON file')
+  parser.add_argument('--compare', required=False,
+                      help='JSON results of a previous run to compare with')
+  gen_org.add_generator_args(parser)
+  args = parser.parse_args(argv)
+  if args.resources and not args.config:
+    parser.error('--config is required with --resources')
+  return args
+
+if __name__ == '__main__':
+  main(parse_args(sys.argv[1:]))
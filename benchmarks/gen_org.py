@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+"""Generate a synthetic group folder hierarchy, for benchmarking the scripts at the
+scale of a large organization. The tree has a folder per tenant, business unit
+and team, group configuration files in the team folders, and OWNERS files. The
+number of groups per team and the popularity of users follow Zipf-like
+distributions, controlled by --skew. The same seed always gives the same tree.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import random
+import argparse
+import itertools
+
+def zipf_weights(count, skew, rnd):
+  """
+  Cumulative weights of count items, the i-th most popular one having a weight of
+  1/i^skew. Items are shuffled so that popularity does not follow their order.
+  """
+  weights = [1.0 / ((i + 1) ** skew) for i in range(count)]
+  rnd.shuffle(weights)
+  return list(itertools.accumulate(weights))
+
+def pick_users(rnd, users, cum_weights, count):
+  """
+  Picks count distinct users, according to their popularity.
+  """
+  count = min(count, len(users))
+  picked = set()
+  while len(picked) < count:
+    picked.update(rnd.choices(users, cum_weights=cum_weights, k=count - len(picked)))
+  return sorted(picked)
+
+def write_group(out, name, description, owners, managers, members):
+  out.write('- name: %s\n' % (name))
+  out.write('  description: %s\n' % (description))
+  for role, role_members in (('owners', owners), ('managers', managers), ('members', members)):
+    if role_members:
+      out.write('  %s:\n' % (role))
+      for member in role_members:
+        out.write('  - %s\n' % (member))
+
+def write_owners(folder, rnd, count):
+  with open(os.path.join(folder, 'OWNERS'), 'w') as out:
+    out.write('# owners of %s\n' % (os.path.basename(folder)))
+    for i in range(count):
+      out.write('@owner-%d\n' % (rnd.randrange(1000)))
+    out.write('\n')
+
+def generate_org(out_dir, seed=1, tenants=5, business_units=10, teams=20, groups=10000, members=15,
+                 users=50000, skew=1.0, groups_per_file=5, owners_ratio=0.3, domain='example.com'):
+  """
+  Writes the group folder hierarchy under out_dir, which must not exist. Returns
+  the number of folders, files, groups and memberships generated.
+  """
+  rnd = random.Random(seed)
+  os.makedirs(out_dir)
+  user_ids = ['User.%d@%s' % (i, domain) for i in range(users)]
+  user_weights = zipf_weights(users, skew, rnd)
+  folders = ['tnt%d/bu%d/team%d' % (t, b, m)
+             for t in range(tenants) for b in range(business_units) for m in range(teams)]
+  # spread the groups over the team folders: a few teams have many groups
+  folder_weights = zipf_weights(len(folders), skew, rnd)
+  groups_per_folder = [0] * len(folders)
+  for i in rnd.choices(range(len(folders)), cum_weights=folder_weights, k=groups):
+    groups_per_folder[i] += 1
+  stats = {'folders': 0, 'files': 0, 'groups': groups, 'memberships': 0, 'owners_files': 0}
+  created = set()
+  for folder, count in zip(folders, groups_per_folder):
+    path = os.path.join(out_dir, folder)
+    os.makedirs(path)
+    # tenant and business unit folders always have owners, teams only some of them
+    for level in range(1, 4):
+      parent = '/'.join(folder.split('/')[:level])
+      if parent in created:
+        continue
+      created.add(parent)
+      stats['folders'] += 1
+      if level < 3 or rnd.random() < owners_ratio:
+        write_owners(os.path.join(out_dir, parent), rnd, rnd.randint(1, 3))
+        stats['owners_files'] += 1
+    for file_number in range(0, count, groups_per_file):
+      stats['files'] += 1
+      with open(os.path.join(path, 'groups_%d.yaml' % (file_number // groups_per_file)), 'w') as out:
+        for g in range(file_number, min(count, file_number + groups_per_file)):
+          # group sizes have a long tail
+          size = max(1, min(users, int(rnd.expovariate(1.0 / members))))
+          picked = pick_users(rnd, user_ids, user_weights, size + 2)
+          owners, managers, group_members = picked[:1], picked[1:2] if size > 5 else [], picked[2:]
+          stats['memberships'] += len(owners) + len(managers) + len(group_members)
+          write_group(out, '%s-g%d' % (folder.split('/')[-1], g), 'synthetic group %d' % (g),
+                      owners, managers, group_members)
+  return stats
+
+def write_config(config_file, domain='example.com'):
+  """
+  Writes a configuration file for tf_generator, matching the generated groups.
+  """
+  with open(config_file, 'w') as out:
+    out.write('gcs_bucket: bench-bucket\n')
+    out.write('gcs_prefix: ci-groups\n')
+    out.write('group_domain: %s\n' % (domain))
+    out.write('group_parent: customers/C0bench\n')
+    out.write('tf_service_account: tf@bench.iam.gserviceaccount.com\n')
+
+def add_generator_args(parser):
+  parser.add_argument('--seed', type=int, default=1, help='random seed')
+  parser.add_argument('--tenants', type=int, default=5, help='number of tenant folders')
+  parser.add_argument('--business-units', type=int, default=10, help='number of business units per tenant')
+  parser.add_argument('--teams', type=int, default=20, help='number of team folders per business unit')
+  parser.add_argument('--groups', type=int, default=10000, help='total number of groups')
+  parser.add_argument('--members', type=int, default=15, help='average number of members per group')
+  parser.add_argument('--users', type=int, default=50000, help='number of distinct users')
+  parser.add_argument('--skew', type=float, default=1.0,
+                      help='Zipf exponent of the groups per team and of the user popularity (0: uniform)')
+  parser.add_argument('--groups-per-file', type=int, default=5, help='number of groups per configuration file')
+  parser.add_argument('--owners-ratio', type=float, default=0.3, help='fraction of team folders with an OWNERS file')
+
+def generator_kwargs(args):
+  return {'seed': args.seed, 'tenants': args.tenants, 'business_units': args.business_units, 'teams': args.teams,
+          'groups': args.groups, 'members': args.members, 'users': args.users, 'skew': args.skew,
+          'groups_per_file': args.groups_per_file, 'owners_ratio': args.owners_ratio}
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--out', required=True, help='folder where the group hierarchy is written (must not exist)')
+  parser.add_argument('--config-out', required=False, help='also write a tf_generator configuration file')
+  add_generator_args(parser)
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  if os.path.exists(args.out):
+    print('output folder already exists: %s' % (args.out))
+    sys.exit(1)
+  stats = generate_org(args.out, **generator_kwargs(args))
+  if args.config_out:
+    write_config(args.config_out)
+  for k in ('folders', 'owners_files', 'files', 'groups', 'memberships'):
+    print('%-12s %d' % (k + ':', stats[k]))
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+"""Time identity_apply against identity_mock with simulated network latency, for
+several numbers of workers. Each run starts from an empty organization and creates
+all the groups of a group folder, and the result is checked to match the groups
+defined in the folder.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import identity_mock
+import identity_apply
+
+PARENT = 'customers/C0bench'
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--resources', required=True,
+                      help='folder containing the group configuration files')
+  parser.add_argument('--domain', default='example.com',
+                      help='domain of the groups')
+  parser.add_argument('--latency', type=float, default=0.02,
+                      help='seconds added by the mock server to each call')
+  parser.add_argument('--workers', default='1,4,16,32',
+                      help='comma separated numbers of workers to compare')
+  return parser.parse_args(argv)
+
+def run(desired, domain, workers, latency):
+  """
+  Applies the desired groups to a new mock server. Returns the elapsed time, the
+  number of calls, and the number of changes left after the run.
+  """
+  server = identity_mock.start_server(latency=latency)
+  try:
+    api_url = 'http://127.0.0.1:%d' % (server.server_address[1])
+    client = identity_apply.IdentityClient(api_url, 'bench', workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      start = time.perf_counter()
+      current, group_names, membership_names = identity_apply.fetch_current(client, executor, PARENT)
+      plan = tf_generator.diff_groups(desired, current, domain)
+      failures = identity_apply.apply_plan(client, executor, plan, desired, PARENT, group_names, membership_names)
+      elapsed = time.perf_counter() - start
+      current = identity_apply.fetch_current(client, executor, PARENT)[0]
+    left = tf_generator.diff_groups(desired, current, domain)
+    return elapsed, client.stats['calls'], len(failures) + sum([len(v) for v in left.values()])
+  finally:
+    server.shutdown()
+
+def main(args):
+  desired = tf_generator.load_group_model(args.resources, args.domain)
+  if desired is None:
+    sys.exit(1)
+  print('groups:      %d' % (len(desired)))
+  print('memberships: %d' % (sum([len(g['membership']) for g in desired.values()])))
+  for workers in [int(w) for w in args.workers.split(',')]:
+    elapsed, calls, left = run(desired, args.domain, workers, args.latency)
+    if left:
+      print('%d workers: %d changes were not applied' % (workers, left))
+      sys.exit(1)
+    print('%3d workers: %.3fs (%d calls)' % (workers, elapsed, calls))
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.WARNING)
+  main(parse_args(sys.argv[1:]))
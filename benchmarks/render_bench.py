@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+"""Compare the two rendering paths of tf_generator for group and membership
+resources: tf_dump.TFBlock and the fixed templates used with --fast-render. The
+output of both paths is checked to be byte-identical before timing them.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import io
+import time
+import argparse
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--groups', type=int, default=2000,
+                      help='number of groups to generate')
+  parser.add_argument('--members', type=int, default=50,
+                      help='number of members per group')
+  parser.add_argument('--seed', type=int, default=1,
+                      help='seed used for generating the group definitions')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of timed runs, the best one is reported')
+  return parser.parse_args(argv)
+
+def make_groups(count, members, seed):
+  """
+  Generates group definitions like the ones produced by cmd_ci_groups, with members
+  holding one, two or three roles.
+  """
+  rnd = random.Random(seed)
+  groups = []
+  for i in range(count):
+    users = ['User.%d@Example.com' % (u) for u in rnd.sample(range(members * 10), members)]
+    full_name = 'tnt%d-bu%d-group-%d' % (i % 7, i % 13, i)
+    groups.append({
+      'full_name' : full_name,
+      'unique_id' : full_name + '@example.com',
+      'owners' : users[:2],
+      'managers' : users[1:5],
+      'members' : users[3:],
+    })
+    groups[-1]['membership'] = tf_generator.index_members(groups[-1])[0]
+  return groups
+
+def render(groups, parent, fast):
+  """
+  Renders the groups the same way render_group_file does, to an in-memory stream.
+  """
+  out = io.StringIO()
+  for group in groups:
+    if fast:
+      tf_generator.write_tf_group(out, group, parent)
+    else:
+      tf_generator.tf_group(group, parent).write_tf(out)
+    out.write('\n\n')
+    for member_id, roles in group['membership'].items():
+      if fast:
+        tf_generator.write_tf_member(out, group['full_name'], member_id, tf_generator.ROLE_NAMES[roles])
+      else:
+        tf_generator.tf_member(group['full_name'], member_id, tf_generator.ROLE_NAMES[roles]).write_tf(out)
+      out.write('\n\n')
+  return out.getvalue()
+
+def best_time(func, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def main(args):
+  parent = 'customers/C0123abcd'
+  groups = make_groups(args.groups, args.members, args.seed)
+  # golden output check: both paths must produce exactly the same code
+  expected = render(groups, parent, False)
+  if render(groups, parent, True) != expected:
+    print('ERROR: --fast-render output differs from the tf_dump output')
+    sys.exit(1)
+  resources = expected.count('\nresource ') + 1
+  tfblock_time = best_time(lambda: render(groups, parent, False), args.repeat)
+  fast_time = best_time(lambda: render(groups, parent, True), args.repeat)
+  print('resources:    %d (%d bytes, identical output)' % (resources, len(expected)))
+  print('tf_dump:      %.3fs (%.2f us/resource)' % (tfblock_time, tfblock_time * 1e6 / resources))
+  print('fast-render:  %.3fs (%.2f us/resource)' % (fast_time, fast_time * 1e6 / resources))
+  print('speedup:      %.1fx' % (tfblock_time / fast_time))
+
+if __name__ == '__main__':
+  main(parse_args(sys.argv[1:]))
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+"""Measure the time and memory needed to build and render the terraform blocks of
+group memberships with tf_dump.TFBlock.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import io
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--memberships', type=int, default=100000,
+                      help='number of memberships to generate')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of timed runs, the best one is reported')
+  return parser.parse_args(argv)
+
+def build_blocks(count):
+  """
+  Builds the terraform blocks for a number of memberships, with a mix of roles.
+  """
+  roles = [['MEMBER'], ['MEMBER', 'MANAGER'], ['MEMBER', 'OWNER']]
+  return [tf_generator.tf_member('tnt1-bu1-group%d' % (i // 100), 'user.%d@example.com' % (i), roles[i % 3])
+          for i in range(count)]
+
+def render_blocks(blocks):
+  """
+  Renders the blocks to an in-memory stream, like the generator does for each file.
+  """
+  out = io.StringIO()
+  for block in blocks:
+    block.write_tf(out)
+    out.write('\n\n')
+  return out
+
+def main(args):
+  count = args.memberships
+  build_time = render_time = None
+  for i in range(args.repeat):
+    start = time.perf_counter()
+    blocks = build_blocks(count)
+    built = time.perf_counter()
+    render_blocks(blocks)
+    rendered = time.perf_counter()
+    if build_time is None or built - start < build_time:
+      build_time = built - start
+    if render_time is None or rendered - built < render_time:
+      render_time = rendered - built
+    del blocks
+  # memory retained by the blocks, measured separately since tracing slows down the runs
+  tracemalloc.start()
+  blocks = build_blocks(count)
+  retained, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  print('memberships:           %d' % (count))
+  print('build time:            %.2f us/membership' % (build_time * 1e6 / count))
+  print('render time:           %.2f us/membership' % (render_time * 1e6 / count))
+  print('retained memory:       %.0f bytes/membership' % (retained / count))
+  print('peak memory:           %.0f bytes/membership' % (peak / count))
+
+if __name__ == '__main__':
+  main(parse_args(sys.argv[1:]))
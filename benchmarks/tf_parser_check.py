@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+"""Compare the single-pass terraform parser of tf_dep_finder (parse_tf) with the
+regex based parse_* functions it replaced, kept here as the reference
+implementation, on all the .tf files of a folder, and time both.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import re
+import time
+import glob
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_dep_finder
+
+def parse_modules(tf_content, current_path):
+  """
+  Look for module declarations. These blocks have the following structure:
+  module "program" {
+    source = "../../../modules/program"
+    param_1 = "${var.param_1}"
+    ...
+  }
+  fortunately, "source" is a reserved keywork in terraform, so we can assume
+  that all "source" elements are pointers to othe rmodules.
+  """
+  result = []
+  p = re.compile(r'\Wsource\s*=\s*"([^"]+)"')
+  result = p.findall(tf_content)
+  # remove duplicates
+  if len(result) > 1:
+    res_set = set(result)
+    result = list(res_set)
+  # return the canonical path to the modules
+  # i.e. change this: 'programs/it/cloud/../../../modules/program'
+  # to this: 'modules/program'
+  result = [os.path.normpath(current_path + '/' + element) for element in result]
+  return result
+
+def parse_data_refs(tf_content):
+  """
+  Look for references to other remote states. These references look like this:
+  gcp_org_id = "${data.terraform_remote_state.foundation.org_id}"
+  """
+  result = []
+  p = re.compile(r'data\.terraform_remote_state\.([_a-z][_\-0-9a-z]*)\.')
+  result = p.findall(tf_content)
+  # remove duplicates
+  if len(result) > 1:
+    res_set = set(result)
+    result = list(res_set)
+  
+  return result
+
+def parse_backends(tf_content):
+  """
+  Look for backend blocks. These blocks have the following structure:
+  terraform {
+    backend "gcs" {
+      bucket = "tf-bootstrap-vdf"
+      prefix = "terraform/tenants/it/programs/cloud"
+    }
+  }
+  """
+  result = []
+  p = re.compile(r'terraform\s+\{[^\{\}]*backend\s+"[^"]+"\s*\{[^\}]+\}\s+\}')
+  backends = p.findall(tf_content)
+  if len(backends) == 0:
+    return result
+  # for each backend, get the bucket name and prefix
+  p_bucket = re.compile(r'bucket\s*=\s*"([^"]+)"')
+  p_prefix = re.compile(r'prefix\s*=\s*"([^"]+)"')
+  p_name = re.compile(r'backend\s*"([^"]+)"')
+  for backend in backends:
+    gcs_object = ''
+    m = p_bucket.search(backend)
+    if m:
+      gcs_object = 'gs://' + m.group(1)
+    m = p_prefix.search(backend)
+    if m:
+      gcs_object = gcs_object + '/' + m.group(1)
+    m = p_name.search(backend)
+    if m:
+      gcs_object = gcs_object + '/' + m.group(1) + '.tfstate'
+    result.append(gcs_object)
+  return result
+  
+def parse_remote_states(tf_content):
+  """
+  Parse remote states configurations from the provided file content. Returns a list of
+  tuples. Ex.: ('foundation', 'gc://tf-bootstrap-vdf/terraform/foundation')
+  Sample configuration:
+  data "terraform_remote_state" "foundation" {
+    backend = "gcs"
+    config {
+      bucket = "tf-bootstrap-vdf"
+      prefix = "terraform/foundation"
+    }
+  }
+  """
+  result = []
+  p = re.compile(r'data\s+\"terraform_remote_state\"\s+\"[^\"]+\"\s*\{[^\{\}]*backend\s*=\s*\"gcs\"\s*config\s*=?\s*\{[^\}]+\}\s+\}')
+  r_states = p.findall(tf_content)
+  if len(r_states) == 0:
+    return result
+  # for each remote state, get the bucket name and prefix
+  p_name = re.compile(r'data\s+"terraform_remote_state"\s+"([^"]+)"\s*\{')
+  p_backend_type = re.compile(r'backend\s*=\s*"([^"]+)"')
+  p_bucket = re.compile(r'bucket\s*=\s*"([^"]+)"')
+  p_prefix = re.compile(r'prefix\s*=\s*"([^"]+)"')
+  for r_state in r_states:
+    rs_name = ''
+    m = p_name.search(r_state)
+    if m:
+      rs_name = m.group(1)
+    gcs_object = ''
+    m = p_bucket.search(r_state)
+    if m:
+      gcs_object = 'gs://' + m.group(1)
+    m = p_prefix.search(r_state)
+    if m:
+      gcs_object = gcs_object + '/' + m.group(1)
+    m = p_backend_type.search(r_state)
+    if m:
+      gcs_object = gcs_object + '/' + m.group(1) + '.tfstate'
+    result.append((rs_name, gcs_object))
+  return result
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tf-root', required=True,
+                      help='directory where to look for terraform files')
+  return parser.parse_args(argv)
+
+def regex_refs(tf_content, tf_folder):
+  """
+  Results of the regex based functions, in the format returned by parse_tf.
+  """
+  return {
+    'BACKENDS' : parse_backends(tf_content),
+    'RS_DEF' : parse_remote_states(tf_content),
+    'RS_REF' : parse_data_refs(tf_content),
+    'MD_REF' : parse_modules(tf_content, tf_folder),
+  }
+
+def main(args):
+  contents = []
+  for tf_file in sorted(glob.glob(args.tf_root + '/**/*.tf', recursive=True)):
+    with open(tf_file, 'r') as f:
+      contents.append((tf_file, os.path.dirname(os.path.normpath(tf_file)), f.read()))
+  start = time.perf_counter()
+  regex_results = [regex_refs(c, d) for n, d, c in contents]
+  regex_time = time.perf_counter() - start
+  start = time.perf_counter()
+  parser_results = [tf_dep_finder.parse_tf(c, d) for n, d, c in contents]
+  parser_time = time.perf_counter() - start
+
+  # the parser must find everything the regexes find, except for 'source'
+  # attributes outside of module blocks. Anything else it finds is reported.
+  missing = 0
+  extra = 0
+  for (tf_file, d, c), expected, found in zip(contents, regex_results, parser_results):
+    for key in ['BACKENDS', 'RS_DEF', 'RS_REF', 'MD_REF']:
+      for item in set(expected[key]) - set(found[key]):
+        if key == 'MD_REF' and not 'module' in c:
+          continue
+        print('%s: %s %s only found by the regexes' % (tf_file, key, item))
+        missing += 1
+      for item in set(found[key]) - set(expected[key]):
+        print('%s: %s %s only found by parse_tf' % (tf_file, key, item))
+        extra += 1
+  print('files:          %d' % (len(contents)))
+  print('regex parsing:  %.3fs' % (regex_time))
+  print('parse_tf:       %.3fs' % (parser_time))
+  print('only in regex:  %d' % (missing))
+  print('only in parser: %d' % (extra))
+
+if __name__ == '__main__':
+  main(parse_args(sys.argv[1:]))
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+"""Parsing of the lists of changed files (git status / git diff outputs), shared by
+tf_dep_finder and codeowners_gen.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import codecs
+
+# formats of the change logs supported by parse_changelog
+CHANGELOG_FORMATS = ['porcelain', 'status-z', 'diff-z']
+
+def read_changelog(changelog, changelog_format='porcelain'):
+  """
+  Read a list of changes from a file. See parse_changelog.
+  """
+  with open(changelog, 'rb') as f:
+    content = f.read().decode('utf-8', 'surrogateescape')
+  return parse_changelog(content, changelog_format)
+
+def parse_changelog(content, changelog_format='porcelain'):
+  """
+  Parse a list of changes, and return the paths that were changed, as (path,
+  is_folder) tuples. Renamed files are returned twice: with their previous and
+  their new path. Supported formats:
+  - porcelain: 'git status --porcelain'
+  - status-z: 'git status --porcelain -z' (paths are not quoted, can have spaces)
+  - diff-z: 'git diff --name-status -z <commit>'
+  """
+  paths = []
+  if changelog_format == 'porcelain':
+    for line in content.splitlines():
+      line = line.rstrip()
+      if len(line) < 4:
+        continue
+      # R  old_name -> new_name
+      for path in (line[3:].split(' -> ') if line[0] in 'RC' else [line[3:]]):
+        # paths with special characters are quoted, with C-style escapes
+        if len(path) > 1 and path.startswith('"') and path.endswith('"'):
+          path = codecs.escape_decode(path[1:-1])[0].decode('utf-8')
+        paths.append(path)
+  elif changelog_format == 'status-z':
+    fields = content.split('\0')
+    i = 0
+    while i < len(fields):
+      entry = fields[i]
+      i += 1
+      if len(entry) < 4:
+        continue
+      paths.append(entry[3:])
+      # renames and copies are followed by the original path
+      if entry[0] in 'RC' and i < len(fields):
+        paths.append(fields[i])
+        i += 1
+  elif changelog_format == 'diff-z':
+    fields = content.split('\0')
+    i = 0
+    while i < len(fields) - 1:
+      status = fields[i]
+      # R<score> and C<score> have two paths, other statuses only one
+      count = 2 if status[:1] in ('R', 'C') else 1
+      paths.extend(fields[i + 1:i + 1 + count])
+      i += 1 + count
+  else:
+    raise ValueError('unknown changelog format: %s' % (changelog_format))
+  return [(os.path.normpath(path), path.endswith('/')) for path in paths if path]
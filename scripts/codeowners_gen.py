@@ -2,15 +2,29 @@
 
 """Generate a unified CODEOWNERS file from OWNER files found in the individual folders.
 
+The owners of a folder are the ones listed in its OWNERS file, plus the owners of
+its parent folders, unless the OWNERS file contains 'set noparent'. Blank lines
+and comments (starting with #) are ignored. Since the last matching line of a
+CODEOWNERS file takes precedence, each line lists all the owners of its folder.
+
 Copyright 2021 Google LLC. This software is provided as-is, without warranty or
 representation for any use or purpose. Your use of it is subject to your 
 agreement with Google.  
 """
 import os
 import sys
+import json
 import argparse
 import logging
-import glob
+import time
+import tempfile
+import instrumentation
+import changelog_parser
+import repo_index
+
+OWNERS_FILE = 'OWNERS'
+# version of the format of the owners index file
+OWNERS_INDEX_VERSION = 1
 
 def parse_args(argv):
   parser = argparse.ArgumentParser()
@@ -19,31 +33,263 @@ def parse_args(argv):
   parser.add_argument('--repo-root', help='path to the root of the code repository', required=True)
   parser.add_argument('--codeowners-out', help='path of the generated CODEOWNERS file', required=False)
   parser.add_argument('--add-owners', help='add owners in the form: /path1=owner1,owner2;/path2=owner3,owner4', required=False)
+  parser.add_argument('--index', required=False,
+                      help='file where the OWNERS files found are kept between runs. When it exists, only the '
+                           'OWNERS files listed in --changelog are read again')
+  parser.add_argument('--changelog', required=False,
+                      help='list of files that were modified since the index was written (git status --porcelain)')
+  parser.add_argument('--changelog-format', required=False, choices=changelog_parser.CHANGELOG_FORMATS,
+                      default='porcelain', help='format of the changelog (see changelog_parser.py)')
+  parser.add_argument('--rescan', action='store_true',
+                      help='read all the OWNERS files, even if an index exists')
+  parser.add_argument('--who-owns', action='append', required=False,
+                      help='print the owners of a path instead of generating the CODEOWNERS file (can be repeated)')
+  parser.add_argument('--fs-snapshot', required=False,
+                      help='file where the listing of the repository is kept between runs, so that only the '
+                           'folders that changed are listed again')
+  instrumentation.add_arguments(parser)
   parser.add_argument('--log-level', required=False,
                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                       default='INFO',
                       help='set log level')
   return parser.parse_args(argv)
 
-def parse_owners(args):
-  # get the list of the OWNERS files found in the repository
-  owners_files = glob.glob(args.repo_root + '/**/OWNERS', recursive=True)
-  owners_files.sort()
-
-  # parse the OWNERS files, and generate consolidated CODEOWNERS file
-  path_owners = {}
-  for owners_file in owners_files:
-    dirname = os.path.dirname(owners_file)
-    f = open(owners_file, "r")
-    members = []
+def read_owners_file(owners_file):
+  """
+  Reads an OWNERS file. Returns the list of owners, and whether the owners of the
+  parent folders are excluded ('set noparent').
+  """
+  owners = []
+  noparent = False
+  with open(owners_file, 'r') as f:
     for line in f:
-      owners_line = line
-      comment_idx = owners_line.find('#')
+      comment_idx = line.find('#')
       if comment_idx != -1:
-        owners_line = owners_line[:comment_idx]
-      owners_line = owners_line.strip()
-      members.append(owners_line)
-    path_owners['/' + dirname] = members
+        line = line[:comment_idx]
+      line = line.strip()
+      if not line:
+        continue
+      if line == 'set noparent':
+        noparent = True
+        continue
+      owners.extend([o for o in line.split() if not o in owners])
+  instrumentation.count('owners_files.parsed')
+  return owners, noparent
+
+def merge_owners(owners, added):
+  return owners + [o for o in added if not o in owners]
+
+class OwnersIndex(object):
+  """
+  Owners of the folders of a repository, stored as a tree of path components. The
+  owners of any path are found by walking down the tree from the root, so the cost
+  of a lookup only depends on the depth of the path.
+  Each folder can have owners from its OWNERS file, and additional owners given in
+  the command line (which are not saved with the index).
+  """
+
+  def __init__(self):
+    self.root = {}
+
+  @staticmethod
+  def split(path):
+    path = os.path.normpath(path)
+    return [] if path == '.' else path.strip(os.sep).split(os.sep)
+
+  def entry(self, folder):
+    node = self.root
+    for part in self.split(folder):
+      node = node.setdefault(part, {})
+    # None can not be a path component, it holds the owners of the folder
+    return node.setdefault(None, {'owners': [], 'noparent': False, 'extra': []})
+
+  def set_owners(self, folder, owners, noparent=False):
+    entry = self.entry(folder)
+    entry['owners'] = owners
+    entry['noparent'] = noparent
+
+  def add_extra_owners(self, folder, owners):
+    entry = self.entry(folder)
+    entry['extra'] = merge_owners(entry['extra'], owners)
+
+  def remove_under(self, folder):
+    """
+    Removes the owners read from the OWNERS files of a folder and its sub-folders.
+    """
+    node = self.root
+    for part in self.split(folder):
+      node = node.get(part)
+      if node is None:
+        return
+    pending = [node]
+    while pending:
+      node = pending.pop()
+      for part, child in node.items():
+        if part is None:
+          child['owners'] = []
+          child['noparent'] = False
+        else:
+          pending.append(child)
+
+  @staticmethod
+  def inherit(owners, entry):
+    if entry['noparent']:
+      owners = []
+    return merge_owners(merge_owners(owners, entry['owners']), entry['extra'])
+
+  def owners_of(self, path):
+    """
+    Returns the owners of a file or folder.
+    """
+    node = self.root
+    owners = self.inherit([], node[None]) if None in node else []
+    for part in self.split(path):
+      node = node.get(part)
+      if node is None:
+        break
+      if None in node:
+        owners = self.inherit(owners, node[None])
+    return owners
+
+  def folders(self):
+    """
+    Returns the folders with owners of their own, with all their owners, sorted by
+    path.
+    """
+    result = []
+    pending = [([], self.root, [])]
+    while pending:
+      parts, node, owners = pending.pop()
+      entry = node.get(None)
+      if entry:
+        owners = self.inherit(owners, entry)
+        if entry['owners'] or entry['extra']:
+          result.append(('/'.join(parts), owners))
+      for part, child in node.items():
+        if part is not None:
+          pending.append((parts + [part], child, owners))
+    return sorted(result)
+
+  def to_json(self):
+    folders = {}
+    pending = [([], self.root)]
+    while pending:
+      parts, node = pending.pop()
+      entry = node.get(None)
+      if entry and (entry['owners'] or entry['noparent']):
+        folders['/'.join(parts) or '.'] = {'owners': entry['owners'], 'noparent': entry['noparent']}
+      pending.extend([(parts + [part], child) for part, child in node.items() if part is not None])
+    return folders
+
+def scan_owners(index, folder):
+  """
+  Reads all the OWNERS files found in a folder and its sub-folders.
+  """
+  for owners_file in repo_index.find_files(folder, 'owners'):
+    index.set_owners(os.path.dirname(owners_file), *read_owners_file(owners_file))
+
+def update_owners(index, repo_root, changes):
+  """
+  Updates the index with a list of changed paths, as returned by
+  changelog_parser.read_changelog. Only the OWNERS files that changed are read.
+  """
+  root = os.path.normpath(repo_root)
+  for path, is_folder in changes:
+    # ignore the changes outside of the repository root
+    if root != '.' and path != root and not path.startswith(root + os.sep):
+      continue
+    if is_folder or os.path.isdir(path):
+      # new folders are listed as a whole
+      index.remove_under(path)
+      scan_owners(index, path)
+    elif os.path.basename(path) == OWNERS_FILE:
+      if os.path.isfile(path):
+        index.set_owners(os.path.dirname(path), *read_owners_file(path))
+      else:
+        index.set_owners(os.path.dirname(path), [])
+
+def load_index(index_file, repo_root):
+  """
+  Loads an index saved by a previous run. Returns None if there is none, or if it
+  was written by another version or for another folder.
+  """
+  if not index_file or not os.path.exists(index_file):
+    return None
+  try:
+    with open(index_file, 'r') as f:
+      saved = json.load(f)
+  except (IOError, ValueError) as e:
+    logging.warning('ignoring unreadable owners index \'%s\': %s' % (index_file, e))
+    return None
+  if saved.get('version') != OWNERS_INDEX_VERSION or saved.get('repo_root') != os.path.normpath(repo_root):
+    logging.info('ignoring owners index \'%s\' from a different version or folder' % (index_file))
+    return None
+  index = OwnersIndex()
+  for folder, entry in saved.get('folders', {}).items():
+    index.set_owners(folder, entry['owners'], entry['noparent'])
+  return index
+
+def save_index(index_file, index, repo_root):
+  content = json.dumps({'version': OWNERS_INDEX_VERSION, 'repo_root': os.path.normpath(repo_root),
+                        'folders': index.to_json()}, indent=1, sort_keys=True) + '\n'
+  write_if_changed(index_file, content)
+
+def write_if_changed(file_name, content):
+  """
+  Writes a file only if its content changed, replacing it atomically. Returns True
+  if the file was written.
+  """
+  if os.path.isfile(file_name):
+    with open(file_name, 'r') as f:
+      if f.read() == content:
+        return False
+  dirname = os.path.dirname(file_name) or '.'
+  if not os.path.exists(dirname):
+    os.makedirs(dirname)
+  fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(file_name) + '.')
+  with os.fdopen(fd, 'w') as f:
+    f.write(content)
+  # mkstemp creates private files, use the usual permissions instead
+  umask = os.umask(0)
+  os.umask(umask)
+  os.chmod(tmp_name, 0o666 & ~umask)
+  os.replace(tmp_name, file_name)
+  return True
+
+def load_owners(repo_root, index_file=None, changelog=None, changelog_format='porcelain', rescan=False):
+  """
+  Returns the index of the OWNERS files of a repository, read from the saved index
+  and the list of changes if possible, or from all the OWNERS files otherwise.
+  """
+  start = time.time()
+  index = None if rescan else load_index(index_file, repo_root)
+  if index is None:
+    index = OwnersIndex()
+    scan_owners(index, repo_root)
+  elif changelog:
+    update_owners(index, repo_root, changelog_parser.read_changelog(changelog, changelog_format))
+  if index_file:
+    save_index(index_file, index, repo_root)
+  instrumentation.add_span('codeowners.scan', time.time() - start)
+  return index
+
+def codeowners_lines(index):
+  """
+  Returns the lines of the CODEOWNERS file, one per folder with owners.
+  """
+  lines = []
+  for folder, owners in index.folders():
+    lines.append(('/' + folder if folder else '*') + ' ' + ' '.join(owners) + '\n')
+  return lines
+
+def write_codeowners(codeowners_out, lines):
+  if write_if_changed(codeowners_out, ''.join(lines)):
+    logging.info('CODEOWNERS file updated: %s' % (codeowners_out))
+  else:
+    logging.info('CODEOWNERS file unchanged: %s' % (codeowners_out))
+
+def parse_owners(args):
+  index = load_owners(args.repo_root, args.index, args.changelog, args.changelog_format, args.rescan)
 
   # add owners from command line param if any
   if args.add_owners:
@@ -51,36 +297,35 @@ def parse_owners(args):
     for folder_owner in folder_owners:
       folder_pair = folder_owner.split('=')
       if len(folder_pair) != 2:
-        logging.error('invalid --codeowners-out value. Please, use the proper format: /path1=owner1,owner2;/path2=owner3,owner4')
+        logging.error('invalid --add-owners value. Please, use the proper format: /path1=owner1,owner2;/path2=owner3,owner4')
         sys.exit(1)
-      folder = folder_pair[0]
-      members = folder_pair[1].split(',')
-      if not folder in path_owners:
-        path_owners[folder] = members
-      else:
-        path_owners[folder].extend(members)
-      print(path_owners)
+      # '*' applies to the whole repository
+      folder = '.' if folder_pair[0] == '*' else folder_pair[0]
+      index.add_extra_owners(folder, folder_pair[1].split(','))
+
+  if args.who_owns:
+    for path in args.who_owns:
+      print('%s %s' % (path, ' '.join(index.owners_of(path))))
+    return
 
   # I no code owners were found, just retrun
-  if len(path_owners) == 0:
+  lines = codeowners_lines(index)
+  if len(lines) == 0:
     return
 
   # write CODEOWNERS data to destination file (or stdout)
+  start = time.time()
   if args.codeowners_out:
-    dirname = os.path.dirname(args.codeowners_out)
-    if not os.path.exists(dirname):
-      os.makedirs(dirname)
-    cof = open(args.codeowners_out, "w")
+    write_codeowners(args.codeowners_out, lines)
   else:
-    cof = sys.stdout
-  for k in sorted(path_owners.keys()):
-    # write the line for the yaml config files folder
-    cof.write(k + ' ' + ' '.join(path_owners[k]) + '\n')
-  cof.close()
+    sys.stdout.write(''.join(lines))
+  instrumentation.add_span('codeowners.write', time.time() - start)
+  instrumentation.count('codeowners.entries', len(lines))
 
 if __name__ == '__main__':
   args = parse_args(sys.argv[1:])
   logging.getLogger().setLevel(getattr(logging, args.log_level))
   FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
   logging.basicConfig(format=FORMAT)
-  parse_owners(args)
+  repo_index.use_snapshot(args.repo_root, args.fs_snapshot)
+  instrumentation.run(args, parse_owners, args)
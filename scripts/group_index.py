@@ -0,0 +1,108 @@
+"""Index of the group definitions found in the group configuration files. It keeps
+every definition of each group, so conflicts can be resolved in a way that does not
+depend on the order in which files were read, and answers which file defines a group.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import json
+
+class GroupIndex(object):
+  """
+  This class records all the (group ID, source file, position) definitions. When a
+  group is defined more than once, the definition with the smallest source path and
+  position wins, whatever the order in which definitions were added. Group IDs are
+  compared in lower case, since group keys are case insensitive in Cloud Identity.
+  """
+
+  def __init__(self):
+    # all definitions of each group, as (source, position) tuples
+    self.definitions = {}
+    # winning definition of each group
+    self.winners = {}
+    # group IDs declared by each source, in position order
+    self.by_source = {}
+
+  def add(self, unique_id, source, position):
+    """
+    Records the definition of a group found at a given position (index of the
+    group in the file) of a source file.
+    """
+    definition = (source, position)
+    key = unique_id.lower()
+    if key in self.definitions:
+      self.definitions[key].append(definition)
+      if definition < self.winners[key]:
+        self.winners[key] = definition
+    else:
+      self.definitions[key] = [definition]
+      self.winners[key] = definition
+    self.by_source.setdefault(source, []).append(unique_id)
+
+  def add_source(self, source, unique_ids):
+    """
+    Records all the groups declared by a source file, in order.
+    """
+    for position, unique_id in enumerate(unique_ids):
+      self.add(unique_id, source, position)
+
+  def source_of(self, unique_id):
+    """
+    Returns the source file that defines a group, or None if the group is unknown.
+    """
+    winner = self.winners.get(unique_id.lower())
+    return winner[0] if winner else None
+
+  def is_winner(self, unique_id, source, position):
+    """
+    Checks whether the definition found at a position of a source file is the one
+    that will be used for the group.
+    """
+    return self.winners.get(unique_id.lower()) == (source, position)
+
+  def produced(self, source):
+    """
+    Returns the groups for which a source file holds the winning definition, in the
+    order in which they appear in the file.
+    """
+    return [unique_id for position, unique_id in enumerate(self.by_source.get(source, []))
+            if self.winners[unique_id.lower()] == (source, position)]
+
+  def conflicts(self):
+    """
+    Returns the groups defined more than once, by lower case ID, mapped to the sorted
+    list of their definitions. The first definition of each list is the one that is used.
+    """
+    return dict([(unique_id, sorted(defs)) for unique_id, defs in self.definitions.items() if len(defs) > 1])
+
+  def conflict_report(self):
+    """
+    Returns one line per conflicting group, listing all the places where it is
+    defined. Positions are shown starting at 1.
+    """
+    lines = []
+    conflicts = self.conflicts()
+    for unique_id in sorted(conflicts):
+      places = ['%s (#%d)' % (source, position + 1) for source, position in conflicts[unique_id]]
+      lines.append('group %s defined in: %s' % (unique_id, ', '.join(places)))
+    return lines
+
+  def __contains__(self, unique_id):
+    return unique_id.lower() in self.winners
+
+  def __len__(self):
+    return len(self.winners)
+
+  @classmethod
+  def from_manifest(cls, manifest_file):
+    """
+    Builds the index from the manifest written by 'tf_generator.py ci-groups', without
+    reading the group configuration files.
+    """
+    with open(manifest_file, 'r') as f:
+      manifest = json.load(f)
+    index = cls()
+    for source in sorted(manifest.get('sources', {})):
+      index.add_source(source, manifest['sources'][source].get('groups', []))
+    return index
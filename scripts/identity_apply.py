@@ -0,0 +1,377 @@
+#!/usr/bin/python
+
+"""Apply the groups defined in the group folder hierarchy directly with the Cloud
+Identity API, without terraform. The current groups and memberships are read from
+the API, compared with the groups defined in the YAML files, and only the changes
+are sent, with concurrent calls made through a pool of persistent connections,
+with rate limiting and retries. identity_mock.py can stand in for the API.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+import tf_generator
+
+# google-auth is only needed to get credentials when no access token is provided
+try:
+  import google.auth
+  import google.auth.transport.requests
+except ImportError:
+  google = None
+
+API_URL = 'https://cloudidentity.googleapis.com'
+API_SCOPES = ['https://www.googleapis.com/auth/cloud-identity.groups']
+# errors worth retrying: quota exceeded and server side errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+GROUP_LABELS = {'cloudidentity.googleapis.com/groups.discussion_forum': ''}
+
+class ApiError(Exception):
+  """
+  Raised when an API call fails, after retries if the error can be retried.
+  """
+  def __init__(self, status, message):
+    Exception.__init__(self, 'HTTP %d: %s' % (status, message))
+    self.status = status
+
+class RateLimiter(object):
+  """
+  Token bucket shared by all the threads making calls. Each call takes one token,
+  and tokens are refilled at a fixed rate, up to a burst of one second of calls.
+  """
+
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.tokens = self.rate
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      # take the token now, and wait for it outside of the lock if it is not there yet
+      self.tokens -= 1
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+    if wait > 0:
+      time.sleep(wait)
+
+class ConnectionPool(object):
+  """
+  Persistent HTTP connections to the API, reused by the threads making calls.
+  Connections are created when needed, up to the size of the pool.
+  """
+
+  def __init__(self, api_url, size, timeout=60):
+    url = urllib.parse.urlparse(api_url)
+    self.conn_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    self.host = url.hostname
+    self.port = url.port
+    self.timeout = timeout
+    self.idle = queue.LifoQueue()
+    self.slots = threading.BoundedSemaphore(size)
+
+  def get(self):
+    self.slots.acquire()
+    try:
+      return self.idle.get_nowait()
+    except queue.Empty:
+      return self.conn_class(self.host, self.port, timeout=self.timeout)
+
+  def put(self, conn, reusable=True):
+    if reusable:
+      self.idle.put(conn)
+    else:
+      conn.close()
+    self.slots.release()
+
+class IdentityClient(object):
+  """
+  Minimal client for the Cloud Identity groups and memberships API.
+  """
+
+  def __init__(self, api_url=API_URL, token=None, pool_size=8, rate=0, max_retries=5, backoff=0.5):
+    self.pool = ConnectionPool(api_url, pool_size)
+    self.limiter = RateLimiter(rate) if rate else None
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.token = token
+    self.credentials = None
+    self.lock = threading.Lock()
+    self.stats = {'calls': 0, 'retries': 0}
+    if not token and api_url == API_URL:
+      if google is None:
+        logging.error('google-auth is not installed: an access token must be provided')
+        sys.exit(1)
+      self.credentials, _ = google.auth.default(scopes=API_SCOPES)
+
+  def headers(self):
+    headers = {'Content-Type': 'application/json'}
+    if self.credentials:
+      with self.lock:
+        if not self.credentials.valid:
+          self.credentials.refresh(google.auth.transport.requests.Request())
+        headers['Authorization'] = 'Bearer ' + self.credentials.token
+    elif self.token:
+      headers['Authorization'] = 'Bearer ' + self.token
+    return headers
+
+  def count(self, key):
+    with self.lock:
+      self.stats[key] += 1
+
+  def request(self, method, path, params=None, body=None):
+    """
+    Calls the API and returns the decoded response. Calls failing with an error
+    that can be retried, or with a connection error, are retried with exponential
+    backoff and jitter, honoring the Retry-After header if present.
+    A failed call may have been applied anyway (e.g. when the response was lost):
+    if the retry of a POST fails because the resource already exists, or the retry
+    of a DELETE because it does not exist anymore, an empty response is returned
+    instead of an error.
+    """
+    url = '/v1/' + path
+    if params:
+      url += '?' + urllib.parse.urlencode(params)
+    payload = json.dumps(body).encode('utf-8') if body is not None else None
+    attempt = 0
+    while True:
+      if self.limiter:
+        self.limiter.acquire()
+      self.count('calls')
+      conn = self.pool.get()
+      retry_after = None
+      try:
+        conn.request(method, url, body=payload, headers=self.headers())
+        response = conn.getresponse()
+        content = response.read()
+        status = response.status
+        retry_after = response.getheader('Retry-After')
+        self.pool.put(conn, not response.will_close)
+      except (OSError, http.client.HTTPException) as e:
+        self.pool.put(conn, False)
+        status, content = None, str(e).encode('utf-8')
+      if status is not None and status < 300:
+        return json.loads(content.decode('utf-8')) if content else {}
+      if attempt > 0 and ((status == 409 and method == 'POST') or (status == 404 and method == 'DELETE')):
+        logging.debug('%s %s already applied by a previous attempt' % (method, url))
+        return {}
+      if (status is not None and not status in RETRY_STATUS) or attempt >= self.max_retries:
+        try:
+          message = json.loads(content.decode('utf-8'))['error']['message']
+        except (ValueError, KeyError, TypeError):
+          message = content.decode('utf-8', 'replace')
+        raise ApiError(status or 0, '%s %s: %s' % (method, url, message))
+      delay = random.uniform(0, self.backoff * (2 ** attempt))
+      if retry_after and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+      attempt += 1
+      self.count('retries')
+      logging.debug('retrying %s %s in %.2fs (%s)' % (method, url, delay, status))
+      time.sleep(delay)
+
+  def list_pages(self, path, params, key):
+    items = []
+    params = dict(params, pageSize=200)
+    while True:
+      result = self.request('GET', path, params)
+      items.extend(result.get(key, []))
+      if not result.get('nextPageToken'):
+        return items
+      params['pageToken'] = result['nextPageToken']
+
+  def list_groups(self, parent):
+    return self.list_pages('groups', {'parent': parent, 'view': 'FULL'}, 'groups')
+
+  def list_memberships(self, group_name):
+    return self.list_pages(group_name + '/memberships', {'view': 'FULL'}, 'memberships')
+
+  def create_group(self, unique_id, display_name, parent):
+    body = {'groupKey': {'id': unique_id}, 'displayName': display_name, 'parent': parent, 'labels': GROUP_LABELS}
+    # the owners are part of the desired memberships, the caller is not added as owner
+    operation = self.request('POST', 'groups', {'initialGroupConfig': 'EMPTY'}, body)
+    if operation.get('done') and 'name' in operation.get('response', {}):
+      return operation['response']['name']
+    # the operation is still running, or was applied by a previous attempt: get the
+    # name from the group key
+    return self.request('GET', 'groups:lookup', {'groupKey.id': unique_id})['name']
+
+  def update_group(self, group_name, display_name):
+    self.request('PATCH', group_name, {'updateMask': 'displayName'}, {'displayName': display_name})
+
+  def delete_group(self, group_name):
+    self.request('DELETE', group_name)
+
+  def add_membership(self, group_name, member_id, roles):
+    body = {'preferredMemberKey': {'id': member_id}, 'roles': [{'name': r} for r in roles]}
+    self.request('POST', group_name + '/memberships', body=body)
+
+  def remove_membership(self, membership_name):
+    self.request('DELETE', membership_name)
+
+  def modify_roles(self, membership_name, add_roles, remove_roles):
+    body = {}
+    if add_roles:
+      body['addRoles'] = [{'name': r} for r in add_roles]
+    if remove_roles:
+      body['removeRoles'] = remove_roles
+    self.request('POST', membership_name + ':modifyMembershipRoles', body=body)
+
+def fetch_current(client, executor, parent):
+  """
+  Reads the groups of a parent and their memberships. Returns the groups in the
+  format of tf_generator.load_identity_snapshot, the resource name of each group,
+  and the resource name of each (group, member) membership.
+  """
+  groups = client.list_groups(parent)
+  group_names = dict([(g['groupKey']['id'].lower(), g['name']) for g in groups])
+  current = {}
+  membership_names = {}
+  all_memberships = executor.map(client.list_memberships, [g['name'] for g in groups])
+  for group, memberships in zip(groups, all_memberships):
+    unique_id = group['groupKey']['id'].lower()
+    membership = {}
+    for m in memberships:
+      member_id = m['preferredMemberKey']['id'].lower()
+      roles = 0
+      for role in m.get('roles', []):
+        roles |= tf_generator.ROLE_BITS.get(role['name'], 0)
+      membership[member_id] = roles
+      membership_names[(unique_id, member_id)] = m['name']
+    current[unique_id] = {'display_name': group.get('displayName'), 'membership': membership}
+  return current, group_names, membership_names
+
+def run_calls(executor, calls):
+  """
+  Runs (description, function, arguments) calls concurrently. Returns the list of
+  failed calls, with their error.
+  """
+  futures = dict([(executor.submit(func, *func_args), desc) for desc, func, func_args in calls])
+  failures = []
+  for future in concurrent.futures.as_completed(futures):
+    try:
+      future.result()
+    except ApiError as e:
+      logging.error('%s failed: %s' % (futures[future], e))
+      failures.append((futures[future], str(e)))
+  return failures
+
+def apply_plan(client, executor, plan, desired, parent, group_names, membership_names):
+  """
+  Applies the changes computed by tf_generator.diff_groups: creates the new groups,
+  then updates groups and memberships, and deletes the groups that are not defined
+  anymore.
+  Calls of each phase run concurrently. Returns the list of failed calls.
+  """
+  failures = []
+  # new groups are needed before their memberships can be added
+  futures = dict([(executor.submit(client.create_group, u, desired[u]['full_name'], parent), u)
+                  for u in plan['create_groups']])
+  for future in concurrent.futures.as_completed(futures):
+    try:
+      group_names[futures[future]] = future.result()
+    except ApiError as e:
+      logging.error('create group %s failed: %s' % (futures[future], e))
+      failures.append(('create group %s' % (futures[future]), str(e)))
+  calls = [('update group %s' % (u), client.update_group, (group_names[u], desired[u]['full_name']))
+           for u in plan['update_groups']]
+  for unique_id, member_id, roles in plan['add_members']:
+    if unique_id in group_names:
+      calls.append(('add member %s to %s' % (member_id, unique_id), client.add_membership,
+                    (group_names[unique_id], member_id, tf_generator.ROLE_NAMES[roles])))
+  for unique_id, member_id, old_roles, roles in plan['change_roles']:
+    add_roles = [r for r in tf_generator.ROLE_NAMES[roles] if not r in tf_generator.ROLE_NAMES[old_roles]]
+    remove_roles = [r for r in tf_generator.ROLE_NAMES[old_roles] if not r in tf_generator.ROLE_NAMES[roles]]
+    calls.append(('change roles of %s in %s' % (member_id, unique_id), client.modify_roles,
+                  (membership_names[(unique_id, member_id)], add_roles, remove_roles)))
+  deleted = set(plan['delete_groups'])
+  for unique_id, member_id, roles in plan['remove_members']:
+    # memberships are deleted with their group
+    if not unique_id in deleted:
+      calls.append(('remove member %s from %s' % (member_id, unique_id), client.remove_membership,
+                    (membership_names[(unique_id, member_id)],)))
+  failures.extend(run_calls(executor, calls))
+  failures.extend(run_calls(executor, [('delete group %s' % (u), client.delete_group, (group_names[u],))
+                                       for u in plan['delete_groups']]))
+  return failures
+
+def main(args):
+  if not os.path.isdir(args.resources):
+    logging.error('the provided resource path does not exist or is not a folder: ' + args.resources)
+    sys.exit(1)
+  tf_config = tf_generator.get_config(args.config, ['group_domain', 'group_parent'])
+  domain = tf_config['group_domain']
+  parent = tf_config['group_parent']
+  desired = tf_generator.load_group_model(args.resources, domain, duplicate_groups=args.duplicate_groups)
+  if desired is None:
+    sys.exit(1)
+  token = args.access_token or os.environ.get('CLOUD_IDENTITY_TOKEN')
+  client = IdentityClient(args.api_url, token, args.workers, args.rate, args.max_retries)
+  start = time.time()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+    current, group_names, membership_names = fetch_current(client, executor, parent)
+    read_time = time.time() - start
+    known_prefixes = tf_generator.load_managed_prefixes(args.managed_prefixes)
+    plan = tf_generator.diff_groups(desired, current, domain, known_prefixes)
+    tf_generator.print_plan(plan, detailed=args.detailed)
+    if args.dry_run:
+      return
+    if args.managed_prefixes:
+      tf_generator.save_managed_prefixes(args.managed_prefixes, tf_generator.managed_prefixes(desired) | set(known_prefixes))
+    start = time.time()
+    failures = apply_plan(client, executor, plan, desired, parent, group_names, membership_names)
+  logging.info('read %d groups in %.2fs, applied changes in %.2fs (%d calls, %d retries)' %
+               (len(current), read_time, time.time() - start, client.stats['calls'], client.stats['retries']))
+  if failures:
+    logging.error('%d changes failed' % (len(failures)))
+    sys.exit(1)
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--config', required=True,
+                      help='yaml file containing the common configuration settings')
+  parser.add_argument('--resources', required=True,
+                      help='folder containing the group configuration files')
+  parser.add_argument('--api-url', default=API_URL,
+                      help='base URL of the Cloud Identity API (use the URL of identity_mock.py for tests)')
+  parser.add_argument('--access-token', required=False,
+                      help='OAuth access token (default: CLOUD_IDENTITY_TOKEN, or the application default credentials)')
+  parser.add_argument('--workers', type=int, default=16,
+                      help='number of concurrent API calls')
+  parser.add_argument('--rate', type=float, default=10,
+                      help='maximum number of API calls per second (0: no limit)')
+  parser.add_argument('--max-retries', type=int, default=5,
+                      help='number of retries of calls failing with a quota or server error')
+  parser.add_argument('--duplicate-groups', choices=['warn', 'error'], default='warn',
+                      help='what to do when a group is defined more than once')
+  parser.add_argument('--managed-prefixes', required=False,
+                      help='json file where the prefixes of the group names are kept between runs, so that the '
+                           'groups of deleted tenants and business units are deleted')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='only print the changes that would be made')
+  parser.add_argument('--detailed', action='store_true',
+                      help='print every change, not only the summary')
+  parser.add_argument('--log-level', required=False,
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                      default='INFO',
+                      help='set log level')
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  logging.getLogger().setLevel(getattr(logging, args.log_level))
+  FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+  logging.basicConfig(format=FORMAT)
+  main(args)
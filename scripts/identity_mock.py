@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+"""Local stand-in for the Cloud Identity Groups API, used for testing and benchmarking
+identity_apply.py without a Google Cloud organization. Only the calls made by
+identity_apply.py are supported. State is kept in memory, and can be seeded from a
+snapshot written by 'tf_generator.py plan --write-snapshot'.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class IdentityState(object):
+  """
+  In memory groups and memberships, indexed like the API resources.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # groups by resource name (groups/<id>), and resource names by group key
+    self.groups = {}
+    self.group_names = {}
+    # memberships by group name, then by membership name
+    self.memberships = {}
+    self.next_id = 1
+    self.requests = 0
+
+  def new_id(self):
+    self.next_id += 1
+    return '%08x' % (self.next_id)
+
+  def add_group(self, group):
+    name = 'groups/' + self.new_id()
+    group = dict(group, name=name)
+    self.groups[name] = group
+    self.group_names[group['groupKey']['id'].lower()] = name
+    self.memberships[name] = {}
+    return group
+
+  def add_membership(self, group_name, membership):
+    name = group_name + '/memberships/' + self.new_id()
+    membership = dict(membership, name=name)
+    self.memberships[group_name][name] = membership
+    return membership
+
+  def load_snapshot(self, snapshot):
+    for group in snapshot.get('groups', []):
+      memberships = group.get('memberships', [])
+      created = self.add_group(dict([(k, v) for k, v in group.items() if k != 'memberships']))
+      for membership in memberships:
+        self.add_membership(created['name'], membership)
+
+  def snapshot(self):
+    groups = []
+    for name in sorted(self.groups):
+      group = dict(self.groups[name])
+      group['memberships'] = list(self.memberships[name].values())
+      groups.append(group)
+    return {'groups': groups}
+
+class IdentityHandler(BaseHTTPRequestHandler):
+  """
+  Handles the API calls. The server holds the state and the fault injection settings.
+  """
+  protocol_version = 'HTTP/1.1'
+  # headers and body are written separately: avoid waiting for the delayed ACK
+  disable_nagle_algorithm = True
+  # set for the calls that are applied but fail (see --lost-reply-rate)
+  lost_reply = False
+
+  def log_message(self, format, *args):
+    logging.debug('%s %s' % (self.address_string(), format % args))
+
+  def reply(self, status, body):
+    if self.lost_reply and status < 300:
+      # the call was applied, but the client gets an error
+      status, body = 503, {'error': {'code': 503, 'message': 'injected error after the call'}}
+    content = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    if status == 429:
+      self.send_header('Retry-After', '0')
+    self.end_headers()
+    self.wfile.write(content)
+
+  def error(self, status, message):
+    self.reply(status, {'error': {'code': status, 'message': message}})
+
+  def read_body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+  def page(self, items, params, key):
+    size = int(params.get('pageSize', ['200'])[0])
+    start = int(params.get('pageToken', ['0'])[0] or 0)
+    result = {key: items[start:start + size]}
+    if start + size < len(items):
+      result['nextPageToken'] = str(start + size)
+    return result
+
+  def handle_call(self, method):
+    server = self.server
+    body = self.read_body() if method in ('POST', 'PATCH') else None
+    if server.latency:
+      time.sleep(server.latency)
+    url = urllib.parse.urlparse(self.path)
+    params = urllib.parse.parse_qs(url.query)
+    path = url.path
+    state = server.state
+    with state.lock:
+      state.requests += 1
+      self.lost_reply = False
+      if server.error_rate and random.random() < server.error_rate:
+        return self.error(random.choice([429, 503]), 'injected error')
+      self.lost_reply = method != 'GET' and server.lost_reply_rate and random.random() < server.lost_reply_rate
+      if path == '/snapshot' and method == 'GET':
+        return self.reply(200, state.snapshot())
+      if path == '/v1/groups:lookup' and method == 'GET':
+        name = state.group_names.get(params.get('groupKey.id', [''])[0].lower())
+        if not name:
+          return self.error(404, 'group not found')
+        return self.reply(200, {'name': name})
+      if path == '/v1/groups' and method == 'GET':
+        groups = [g for g in state.groups.values() if g.get('parent') == params.get('parent', [None])[0]]
+        return self.reply(200, self.page(groups, params, 'groups'))
+      if path == '/v1/groups' and method == 'POST':
+        if body['groupKey']['id'].lower() in state.group_names:
+          return self.error(409, 'group already exists')
+        return self.reply(200, {'done': True, 'response': state.add_group(body)})
+      parts = path[len('/v1/'):].split('/') if path.startswith('/v1/groups/') else []
+      if len(parts) == 2 and method == 'PATCH':
+        group_name = '/'.join(parts)
+        if not group_name in state.groups:
+          return self.error(404, 'group not found')
+        for field in params.get('updateMask', [''])[0].split(','):
+          if field in body:
+            state.groups[group_name][field] = body[field]
+        return self.reply(200, {'done': True, 'response': state.groups[group_name]})
+      if len(parts) == 2 and method == 'DELETE':
+        group_name = '/'.join(parts)
+        if not group_name in state.groups:
+          return self.error(404, 'group not found')
+        group = state.groups.pop(group_name)
+        state.group_names.pop(group['groupKey']['id'].lower(), None)
+        state.memberships.pop(group_name, None)
+        return self.reply(200, {'done': True})
+      if len(parts) >= 3 and parts[2] == 'memberships':
+        group_name = '/'.join(parts[:2])
+        if not group_name in state.groups:
+          return self.error(404, 'group not found')
+        memberships = state.memberships[group_name]
+        if len(parts) == 3 and method == 'GET':
+          return self.reply(200, self.page(list(memberships.values()), params, 'memberships'))
+        if len(parts) == 3 and method == 'POST':
+          member_id = body['preferredMemberKey']['id'].lower()
+          if any([m['preferredMemberKey']['id'].lower() == member_id for m in memberships.values()]):
+            return self.error(409, 'membership already exists')
+          return self.reply(200, {'done': True, 'response': state.add_membership(group_name, body)})
+        if len(parts) == 4:
+          member_name, _, action = '/'.join(parts).partition(':')
+          if not member_name in memberships:
+            return self.error(404, 'membership not found')
+          if method == 'DELETE' and not action:
+            memberships.pop(member_name)
+            return self.reply(200, {'done': True})
+          if method == 'POST' and action == 'modifyMembershipRoles':
+            membership = memberships[member_name]
+            removed = set(body.get('removeRoles', []))
+            roles = [r for r in membership['roles'] if not r['name'] in removed]
+            roles.extend([r for r in body.get('addRoles', []) if not r['name'] in [x['name'] for x in roles]])
+            membership['roles'] = roles
+            return self.reply(200, {'membership': membership})
+      return self.error(404, 'unsupported call: %s %s' % (method, path))
+
+  def do_GET(self):
+    self.handle_call('GET')
+
+  def do_POST(self):
+    self.handle_call('POST')
+
+  def do_PATCH(self):
+    self.handle_call('PATCH')
+
+  def do_DELETE(self):
+    self.handle_call('DELETE')
+
+def start_server(port=0, snapshot=None, latency=0, error_rate=0, lost_reply_rate=0):
+  """
+  Starts the server in a background thread. Returns the server, whose
+  server_address gives the port actually used.
+  """
+  server = ThreadingHTTPServer(('127.0.0.1', port), IdentityHandler)
+  server.daemon_threads = True
+  server.state = IdentityState()
+  server.latency = latency
+  server.error_rate = error_rate
+  server.lost_reply_rate = lost_reply_rate
+  if snapshot:
+    server.state.load_snapshot(snapshot)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+  parser.add_argument('--snapshot', required=False,
+                      help='initial groups and memberships, in the format written by tf_generator.py plan --write-snapshot')
+  parser.add_argument('--latency', type=float, default=0,
+                      help='seconds added to each call, to simulate network round trips')
+  parser.add_argument('--error-rate', type=float, default=0,
+                      help='fraction of calls that fail with a 429 or 503 error')
+  parser.add_argument('--lost-reply-rate', type=float, default=0,
+                      help='fraction of the calls changing the state that are applied, but fail with a 503 error')
+  parser.add_argument('--log-level', required=False,
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                      default='INFO',
+                      help='set log level')
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  logging.getLogger().setLevel(getattr(logging, args.log_level))
+  FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+  logging.basicConfig(format=FORMAT)
+  snapshot = None
+  if args.snapshot:
+    with open(args.snapshot, 'r') as f:
+      snapshot = json.load(f)
+  server = start_server(args.port, snapshot, args.latency, args.error_rate, args.lost_reply_rate)
+  logging.info('listening on http://127.0.0.1:%d' % (server.server_address[1]))
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+"""Timing and profiling support shared by the scripts. Named spans accumulate the
+time spent in each phase, and counters record what was done (files parsed, blocks
+rendered, bytes written, cache hits...). Both are written as a JSON report with
+--timing-report, and --profile runs the command under cProfile or tracemalloc.
+Spans and counters are only recorded in the main process: the work done by the
+worker processes of tf_generator --jobs is accounted for in the spans that wait
+for it.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+# resource is not available on all platforms
+try:
+  import resource
+except ImportError:
+  resource = None
+
+REPORT_VERSION = 1
+PROFILE_TOP = 30
+
+spans = {}
+counters = {}
+lock = threading.Lock()
+started = time.perf_counter()
+
+class lazy(object):
+  """
+  Defers an expensive computation used in a log message until the message is
+  actually formatted: logging.debug('graph: %s', lazy(json.dumps, graph)).
+  """
+
+  def __init__(self, func, *args, **kwargs):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+
+  def __str__(self):
+    return str(self.func(*self.args, **self.kwargs))
+
+def add_span(name, seconds, calls=1):
+  with lock:
+    span_stats = spans.setdefault(name, {'count': 0, 'seconds': 0.0})
+    span_stats['count'] += calls
+    span_stats['seconds'] += seconds
+
+@contextlib.contextmanager
+def span(name):
+  """
+  Adds the time spent in the with block to the named span.
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    add_span(name, time.perf_counter() - start)
+
+def count(name, value=1):
+  with lock:
+    counters[name] = counters.get(name, 0) + value
+
+def reset():
+  global started
+  with lock:
+    spans.clear()
+    counters.clear()
+    started = time.perf_counter()
+
+def report():
+  """
+  Returns the spans and counters recorded since the start (or the last reset).
+  """
+  with lock:
+    result = {
+      'version': REPORT_VERSION,
+      'command': os.path.basename(sys.argv[0]),
+      'total_seconds': time.perf_counter() - started,
+      'spans': dict([(k, dict(v)) for k, v in spans.items()]),
+      'counters': dict(counters),
+    }
+  if resource:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    result['peak_rss_kb'] = rss // 1024 if sys.platform == 'darwin' else rss
+  return result
+
+def write_report(report_file):
+  """
+  Writes the report as JSON to a file, or to std error if report_file is '-'.
+  """
+  content = json.dumps(report(), indent=2, sort_keys=True) + '\n'
+  if report_file == '-':
+    sys.stderr.write(content)
+  else:
+    with open(report_file, 'w') as f:
+      f.write(content)
+
+def add_arguments(parser):
+  parser.add_argument('--timing-report', required=False,
+                      help='write the time spent in each phase and the work counters to this JSON file (- for std error)')
+  parser.add_argument('--profile', required=False, choices=['cpu', 'memory'],
+                      help='run under cProfile (cpu) or tracemalloc (memory)')
+  parser.add_argument('--profile-out', required=False, default='profile',
+                      help='prefix of the profiling output files: PREFIX.prof and PREFIX.txt for cpu, '
+                           'PREFIX.mem.txt for memory')
+
+def write_cpu_profile(profiler, prefix):
+  profiler.dump_stats(prefix + '.prof')
+  with open(prefix + '.txt', 'w') as f:
+    stats = pstats.Stats(profiler, stream=f)
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+    stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+
+def write_memory_profile(snapshot, peak, prefix):
+  with open(prefix + '.mem.txt', 'w') as f:
+    f.write('peak traced memory: %d KiB\n\n' % (peak // 1024))
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+      f.write('%s\n' % (stat))
+
+def run(args, func, *func_args):
+  """
+  Calls func(*func_args) with the profiling requested in the command line options
+  added by add_arguments, and writes the timing report if requested, even if the
+  command fails. Returns the result of func.
+  """
+  profiler = None
+  if args.profile == 'cpu':
+    profiler = cProfile.Profile()
+    profiler.enable()
+  elif args.profile == 'memory':
+    tracemalloc.start()
+  try:
+    return func(*func_args)
+  finally:
+    if profiler:
+      profiler.disable()
+      write_cpu_profile(profiler, args.profile_out)
+    elif args.profile == 'memory':
+      snapshot = tracemalloc.take_snapshot()
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      write_memory_profile(snapshot, peak, args.profile_out)
+    if args.timing_report:
+      write_report(args.timing_report)
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+"""Index of the files of a folder tree, shared by tf_generator, tf_dep_finder and
+codeowners_gen. The tree is walked once with os.scandir, and the files are
+classified by type: group configuration files (yaml), terraform files (tf),
+terraform variable files (tfvars) and OWNERS files. Like recursive globs, hidden files and folders are ignored.
+Indexes are kept for the lifetime of the process, so that tools running in the
+same process (tf_pipeline.py, watch mode) share them. Writers must call
+invalidate() on the folders they modify.
+A snapshot of the tree can be saved between runs with use_snapshot(): the folders
+whose modification time did not change since the snapshot are not listed again,
+since adding, removing or renaming a file always updates the modification time of
+its folder. Modifying a file does not, so the sizes and modification times of the
+files are only returned by stat() for the folders listed by the current process.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import instrumentation
+
+# bump this whenever the layout of the snapshot changes
+SNAPSHOT_VERSION = 1
+# folders modified less than this before the snapshot was taken are listed again,
+# since they could have changed within the resolution of their modification time
+RACY_NS = 2 * 10**9
+
+# indexes by normalized root folder, and snapshot files by root folder
+indexes = {}
+snapshot_files = {}
+
+def file_type(name):
+  if name.endswith('.yaml'):
+    return 'yaml'
+  if name.endswith('.tf'):
+    return 'tf'
+  if name.endswith('.tfvars'):
+    return 'tfvars'
+  if name == 'OWNERS':
+    return 'owners'
+  return None
+
+class RepoIndex(object):
+  """
+  Files of a folder tree. For each folder, relative to the root ('' for the root
+  itself), the index keeps its modification time, its sub-folders, and its files
+  with their size and modification time.
+  """
+
+  def __init__(self, root):
+    self.root = os.path.normpath(root)
+    self.dirs = {}
+    self.scanned = 0
+    # folders listed by this process, the others come from a snapshot
+    self.listed = set()
+
+  def scan(self, previous=None):
+    """
+    Walks the tree. Folders found unchanged in the previous index are not listed
+    again.
+    """
+    reusable = previous is not None and previous.root == self.root
+    self.dirs = {}
+    self.listed = set()
+    self.scanned = time.time_ns()
+    pending = ['']
+    while pending:
+      rel = pending.pop()
+      path = os.path.join(self.root, rel) if rel else self.root
+      try:
+        mtime = os.stat(path).st_mtime_ns
+      except OSError:
+        continue
+      prev = previous.dirs.get(rel) if reusable else None
+      if prev and prev['mtime'] == mtime and mtime < previous.scanned - RACY_NS:
+        entry = prev
+      else:
+        self.listed.add(rel)
+        entry = {'mtime': mtime, 'dirs': [], 'files': {}}
+        try:
+          with os.scandir(path) as it:
+            for e in it:
+              if e.name.startswith('.'):
+                continue
+              if e.is_dir():
+                entry['dirs'].append(e.name)
+              elif e.is_file():
+                st = e.stat()
+                entry['files'][e.name] = [st.st_size, st.st_mtime_ns]
+        except OSError as e:
+          logging.warning('could not list folder \'%s\': %s' % (path, e))
+        entry['dirs'].sort()
+      self.dirs[rel] = entry
+      pending.extend([rel + '/' + d if rel else d for d in entry['dirs']])
+    instrumentation.count('fs.dirs_listed', len(self.listed))
+    instrumentation.count('fs.dirs_reused', len(self.dirs) - len(self.listed))
+    return self
+
+  def files(self, ftype, under=''):
+    """
+    Returns the relative paths of the files of a type found in a folder (relative
+    to the root) and its sub-folders, sorted.
+    """
+    found = []
+    for rel, entry in self.dirs.items():
+      if under and rel != under and not rel.startswith(under + '/'):
+        continue
+      for name in entry['files']:
+        if file_type(name) == ftype:
+          found.append(rel + '/' + name if rel else name)
+    return sorted(found)
+
+  def stat(self, rel_path):
+    """
+    Returns the (size, modification time in ns) of a file, or None if it is not in
+    the index or its folder was not listed by this process.
+    """
+    rel_dir, name = os.path.split(rel_path)
+    entry = self.dirs.get(rel_dir) if rel_dir in self.listed else None
+    return tuple(entry['files'][name]) if entry and name in entry['files'] else None
+
+  def to_json(self):
+    return {'version': SNAPSHOT_VERSION, 'root': self.root, 'scanned': self.scanned, 'dirs': self.dirs}
+
+  @classmethod
+  def from_json(cls, data):
+    index = cls(data['root'])
+    index.scanned = data['scanned']
+    index.dirs = data['dirs']
+    return index
+
+def load_snapshot(snapshot_file):
+  if not snapshot_file or not os.path.exists(snapshot_file):
+    return None
+  try:
+    with open(snapshot_file, 'r') as f:
+      data = json.load(f)
+  except (IOError, ValueError) as e:
+    logging.warning('ignoring unreadable file system snapshot \'%s\': %s' % (snapshot_file, e))
+    return None
+  if data.get('version') != SNAPSHOT_VERSION:
+    return None
+  return RepoIndex.from_json(data)
+
+def save_snapshot(snapshot_file, index):
+  """
+  Saves the index for the next runs. The file is replaced atomically.
+  """
+  dirname = os.path.dirname(snapshot_file) or '.'
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(snapshot_file) + '.')
+  with os.fdopen(fd, 'w') as f:
+    json.dump(index.to_json(), f, sort_keys=True)
+  os.replace(tmp_name, snapshot_file)
+
+def use_snapshot(root, snapshot_file):
+  """
+  Keeps a snapshot of the index of a folder in a file, to speed up the next runs.
+  """
+  if snapshot_file:
+    snapshot_files[os.path.normpath(root)] = snapshot_file
+
+def get_index(root):
+  """
+  Returns the index of a folder, walking it if it has not been indexed yet, and
+  the path of the folder relative to the root of the index. Indexes of parent
+  folders are used when available.
+  """
+  root = os.path.normpath(root)
+  for indexed, index in indexes.items():
+    if indexed == root:
+      return index, ''
+    if root.startswith(indexed + os.sep):
+      return index, root[len(indexed) + 1:]
+  with instrumentation.span('fs.walk'):
+    snapshot_file = snapshot_files.get(root)
+    index = RepoIndex(root).scan(load_snapshot(snapshot_file))
+    if snapshot_file:
+      save_snapshot(snapshot_file, index)
+  indexes[root] = index
+  return index, ''
+
+def find_files(folder, ftype):
+  """
+  Returns the files of a type found in a folder and its sub-folders, sorted. Paths
+  start with the folder as given, like the results of a recursive glob.
+  """
+  index, under = get_index(folder)
+  prefix = len(under) + 1 if under else 0
+  return [folder + '/' + rel[prefix:] for rel in index.files(ftype, under)]
+
+def file_stat(path):
+  """
+  Returns the (size, modification time in ns) of a file, from the index of its
+  folder if it is up to date, or from the file system otherwise.
+  """
+  path = os.path.normpath(path)
+  for indexed, index in indexes.items():
+    if path.startswith(indexed + os.sep):
+      st = index.stat(path[len(indexed) + 1:])
+      if st:
+        return st
+      break
+  st = os.stat(path)
+  return st.st_size, st.st_mtime_ns
+
+def invalidate(folder):
+  """
+  Drops the indexes that include files of a folder, after files were added,
+  removed or modified in it.
+  """
+  folder = os.path.normpath(folder)
+  for indexed in list(indexes):
+    if indexed == folder or indexed == '.' or folder.startswith(indexed + os.sep) or indexed.startswith(folder + os.sep):
+      indexes.pop(indexed)
+
+def refresh(root):
+  """
+  Lists all the folders of a tree again, and replaces its index. Returns the new
+  index.
+  """
+  root = os.path.normpath(root)
+  with instrumentation.span('fs.walk'):
+    indexes[root] = RepoIndex(root).scan()
+  return indexes[root]
+
+def changed_files(previous, index, ftypes):
+  """
+  Returns the paths of the files of the given types that were added, removed or
+  modified between two indexes of the same tree, sorted.
+  """
+  changed = set()
+  for old, new in [(previous, index), (index, previous)]:
+    for rel_dir, entry in new.dirs.items():
+      old_entry = old.dirs.get(rel_dir)
+      old_files = old_entry['files'] if old_entry else {}
+      for name, stat in entry['files'].items():
+        if file_type(name) in ftypes and old_files.get(name) != stat:
+          changed.add(os.path.join(index.root, rel_dir, name))
+  return sorted(changed)
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+"""Run terraform on the build waves computed by 'tf_dep_finder.py --waves json'.
+The packages of each wave are processed concurrently by a bounded pool of workers,
+and waves are processed one after the other. When a package fails, no new package
+is started, and the packages that were already running are allowed to finish.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+import concurrent.futures
+
+INIT_SUCCESS = 'Terraform has been successfully initialized'
+
+def run_command(command, tf_conf, log):
+  """
+  Run a command in a terraform configuration folder, appending its output to the
+  package log. Returns True if the command succeeded.
+  """
+  log.append('$ %s' % (' '.join(command)))
+  try:
+    proc = subprocess.run(command, cwd=tf_conf, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+  except OSError as e:
+    log.append('could not run %s: %s' % (command[0], e))
+    return False, ''
+  log.append(proc.stdout)
+  return proc.returncode == 0, proc.stdout
+
+def run_package(terraform, action, tf_conf):
+  """
+  Run the same terraform commands as the Cloud Build pipeline on one package:
+  init, fmt, and then plan or apply. Returns (success, package log).
+  """
+  log = []
+  ok, out = run_command([terraform, 'init', '-no-color'], tf_conf, log)
+  if not ok or not INIT_SUCCESS in out:
+    log.append('terraform init did not succeed.')
+    return False, log
+  ok, out = run_command([terraform, 'fmt'], tf_conf, log)
+  if not ok:
+    return False, log
+  if action == 'apply':
+    ok, out = run_command([terraform, 'apply', '-auto-approve', '-no-color'], tf_conf, log)
+  else:
+    ok, out = run_command([terraform, 'plan', '-no-color'], tf_conf, log)
+  return ok, log
+
+def write_package_log(output_log, tf_conf, log):
+  """
+  Write the log of a package in one piece, so that the outputs of packages that
+  ran at the same time are not mixed.
+  """
+  output_log.write('*****************************************************************\n')
+  output_log.write('* Processing terrform configuration %s\n' % (tf_conf))
+  output_log.write('*****************************************************************\n')
+  for line in log:
+    output_log.write(line if line.endswith('\n') else line + '\n')
+  output_log.write('\n')
+  output_log.flush()
+
+def run_waves(waves, terraform, action, jobs, output_log):
+  """
+  Run all the waves in order. Returns the list of packages that failed; packages
+  that were not started because of a failure are not listed.
+  """
+  failed = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    for number, wave in enumerate(waves):
+      logging.info('wave %d/%d: %d package(s)' % (number + 1, len(waves), len(wave)))
+      futures = dict([(executor.submit(run_package, terraform, action, tf_conf), tf_conf) for tf_conf in wave])
+      for future in concurrent.futures.as_completed(futures):
+        tf_conf = futures[future]
+        if future.cancelled():
+          continue
+        ok, log = future.result()
+        write_package_log(output_log, tf_conf, log)
+        if ok:
+          logging.info('%s: %s succeeded' % (tf_conf, action))
+        else:
+          logging.error('%s: %s failed' % (tf_conf, action))
+          failed.append(tf_conf)
+          # do not start the packages of this wave that are still waiting
+          for other in futures:
+            other.cancel()
+      if failed:
+        skipped = len([f for f in futures if f.cancelled()]) + sum([len(w) for w in waves[number + 1:]])
+        logging.error('stopping after wave %d, %d package(s) not processed' % (number + 1, skipped))
+        break
+  return failed
+
+def main(args):
+  with open(args.waves, 'r') as f:
+    waves = json.load(f)
+  if not isinstance(waves, list) or not all([isinstance(w, list) for w in waves]):
+    logging.error('file provided in --waves must be a json list of lists of packages')
+    sys.exit(1)
+  jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+  if args.output_log:
+    output_log = open(args.output_log, 'a')
+  else:
+    output_log = sys.stdout
+  failed = run_waves(waves, args.terraform, args.action, jobs, output_log)
+  if output_log != sys.stdout:
+    output_log.close()
+  if failed:
+    logging.error('failed packages: %s' % (', '.join(failed)))
+    sys.exit(1)
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--waves', required=True,
+                      help='build waves, as written by tf_dep_finder.py --waves json')
+  parser.add_argument('--action', required=False, choices=['plan', 'apply'], default='apply',
+                      help='terraform command to run on each package')
+  parser.add_argument('--jobs', required=False, type=int, default=4,
+                      help='number of packages processed at the same time (0 for one per CPU)')
+  parser.add_argument('--terraform', required=False, default='terraform',
+                      help='terraform binary to use')
+  parser.add_argument('--output-log', required=False,
+                      help='append the terraform outputs to this file instead of std output')
+  parser.add_argument('--log-level', required=False,
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                      default='INFO',
+                      help='set log level')
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  logging.getLogger().setLevel(getattr(logging, args.log_level))
+  FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+  logging.basicConfig(format=FORMAT)
+  main(args)
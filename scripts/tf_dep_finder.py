@@ -13,172 +13,489 @@ import os
 import sys
 import logging
 import re
-import glob
+import json
+import hashlib
+import tempfile
+import shutil
+import instrumentation
+import repo_index
+import changelog_parser
 from collections import defaultdict
 
-def parse_modules(tf_content, current_path):
-  """
-  Look for module declarations. These blocks have the following structure:
-  module "program" {
-    source = "../../../modules/program"
-    param_1 = "${var.param_1}"
-    ...
-  }
-  fortunately, "source" is a reserved keywork in terraform, so we can assume
-  that all "source" elements are pointers to othe rmodules.
-  """
-  result = []
-  p = re.compile(r'\Wsource\s*=\s*"([^"]+)"')
-  result = p.findall(tf_content)
-  # remove duplicates
-  if len(result) > 1:
-    res_set = set(result)
-    result = list(res_set)
-  # return the canonical path to the modules
-  # i.e. change this: 'programs/it/cloud/../../../modules/program'
-  # to this: 'modules/program'
-  result = [os.path.normpath(current_path + '/' + element) for element in result]
-  return result
+# bump this whenever parse_tf changes the results it returns, so cached results from
+# previous versions are not used.
+PARSE_CACHE_VERSION = 3
+# version of the format of the dependency graph snapshots
+GRAPH_SNAPSHOT_VERSION = 1
+# where the configurations used for destroying deleted packages are written
+DESTROY_ROOT = '.tf_destroy'
+# top level blocks of the files that only configure a package (backend, providers
+# and their variables). These files are kept for destroying the package.
+SETTINGS_BLOCKS = ('terraform', 'provider', 'variable')
+
+# tokens of terraform code, outside of strings
+TF_TOKEN = re.compile(r"""
+  (?P<NEWLINE>\n) | (?P<SPACE>[ \t\r]+) | (?P<COMMENT>\#[^\n]*|//[^\n]*|/\*.*?\*/) |
+  (?P<HEREDOC><<-?(?P<MARKER>[A-Za-z_][A-Za-z0-9_]*)[ \t]*\r?\n) | (?P<QUOTE>") |
+  (?P<LBRACE>\{) | (?P<RBRACE>\}) | (?P<IDENT>[A-Za-z_][A-Za-z0-9_\-]*) | (?P<DOT>\.) |
+  (?P<EQ>=(?![=>])|:) | (?P<COMMA>,) | (?P<OTHER>.)""", re.S | re.X)
+# pieces of a string literal. The escaped sequences $${ and %%{ are literals, not
+# the start of an interpolation or a directive.
+TF_STRING_PIECE = re.compile(r'[^\\"$%]+|\\.|\$\$\{|%%\{|[$%]\{|"|[$%]', re.S)
+# remote state references found in heredoc strings
+HEREDOC_REF = re.compile(r'data\.terraform_remote_state\.([A-Za-z_][A-Za-z0-9_\-]*)\.')
 
-def parse_data_refs(tf_content):
+def tokenize_tf(tf_content):
   """
-  Look for references to other remote states. These references look like this:
-  gcp_org_id = "${data.terraform_remote_state.foundation.org_id}"
+  Split terraform code into tokens, in a single pass over the content. Yields
+  (kind, value) tuples, where kind is one of:
+   - IDENT: identifiers and keywords
+   - STRING: literal strings. The value is None for strings with interpolations.
+   - LBRACE / RBRACE: braces that open or close blocks and objects
+   - EQ: '=' or ':' assignments
+   - DOT / NEWLINE / COMMA
+   - OTHER: any other character (numbers, operators, brackets...)
+  Comments are skipped. Identifiers and dots found in string interpolations
+  ("${...}") are reported too, before the string itself, but nothing else from
+  them, so they never change the structure of the code.
   """
-  result = []
-  p = re.compile(r'data\.terraform_remote_state\.([_a-z][_\-0-9a-z]*)\.')
-  result = p.findall(tf_content)
-  # remove duplicates
-  if len(result) > 1:
-    res_set = set(result)
-    result = list(res_set)
-  
-  return result
+  i = 0
+  n = len(tf_content)
+  # open strings and interpolations. Strings are ['STR', parts, has_interpolations]
+  # and interpolations are ['INTERP', depth of the braces opened inside]
+  modes = []
+  while i < n:
+    if modes and modes[-1][0] == 'STR':
+      # inside a string literal
+      m = TF_STRING_PIECE.match(tf_content, i)
+      piece = m.group()
+      i = m.end()
+      if piece == '"':
+        mode = modes.pop()
+        if not modes:
+          yield ('STRING', None if mode[2] else ''.join(mode[1]))
+      elif piece == '${' or piece == '%{':
+        modes[-1][2] = True
+        modes.append(['INTERP', 0])
+      else:
+        modes[-1][1].append(piece)
+      continue
+    m = TF_TOKEN.match(tf_content, i)
+    kind = m.lastgroup
+    i = m.end()
+    in_interp = len(modes) > 0
+    if kind == 'SPACE' or kind == 'COMMENT':
+      continue
+    if kind == 'QUOTE':
+      modes.append(['STR', [], False])
+    elif kind == 'LBRACE' and in_interp:
+      modes[-1][1] += 1
+    elif kind == 'RBRACE' and in_interp:
+      if modes[-1][1] == 0:
+        # end of the interpolation, back to the string
+        modes.pop()
+      else:
+        modes[-1][1] -= 1
+    elif kind == 'HEREDOC':
+      # heredoc string: <<EOT or <<-EOT, up to a line containing only the marker
+      end = re.compile(r'^[ \t]*' + m.group('MARKER') + r'[ \t]*$', re.M).search(tf_content, i)
+      body = tf_content[i:end.start() if end else n]
+      i = end.end() if end else n
+      # heredocs are not tokenized, but may still reference remote states
+      for ref in HEREDOC_REF.findall(body):
+        for token in [('IDENT', 'data'), ('DOT', '.'), ('IDENT', 'terraform_remote_state'), ('DOT', '.'),
+                      ('IDENT', ref), ('DOT', '.')]:
+          yield token
+      if not in_interp:
+        yield ('STRING', None if '${' in body.replace('$${', '') else body)
+    elif kind == 'IDENT' or kind == 'DOT':
+      yield (kind, m.group())
+    elif not in_interp:
+      # only identifiers and dots are reported from interpolations
+      yield (kind, m.group())
 
-def parse_backends(tf_content):
+def parse_tf(tf_content, current_path):
   """
-  Look for backend blocks. These blocks have the following structure:
-  terraform {
-    backend "gcs" {
-      bucket = "tf-bootstrap-vdf"
-      prefix = "terraform/tenants/it/programs/cloud"
-    }
-  }
+  Parse the content of a terraform file and extract, in a single pass:
+   - BACKENDS: GCS url of the state of the package, from the backend block of
+     the terraform block. Ex.: 'gs://tf-bootstrap-vdf/terraform/foundation/gcs.tfstate'
+   - RS_DEF: remote state definitions, as (name, GCS url) tuples.
+   - RS_REF: names of the remote states referenced (data.terraform_remote_state.NAME.)
+   - MD_REF: canonical path of the modules referenced by module blocks.
+   - SETTINGS: whether the file only holds SETTINGS_BLOCKS blocks.
+  Blocks are matched by following the nesting of braces, so any number of nested
+  blocks is supported.
   """
-  result = []
-  p = re.compile(r'terraform\s+\{[^\{\}]*backend\s+"[^"]+"\s*\{[^\}]+\}\s+\}')
-  backends = p.findall(tf_content)
-  if len(backends) == 0:
+  result = {'BACKENDS' : [], 'RS_DEF' : [], 'RS_REF' : [], 'MD_REF' : [], 'SETTINGS' : False}
+  # most files (like the ones holding the groups) have none of these
+  if not 'backend' in tf_content and not 'terraform_remote_state' in tf_content and \
+     not 'module' in tf_content and not 'provider' in tf_content and not 'variable' in tf_content:
     return result
-  # for each backend, get the bucket name and prefix
-  p_bucket = re.compile(r'bucket\s*=\s*"([^"]+)"')
-  p_prefix = re.compile(r'prefix\s*=\s*"([^"]+)"')
-  p_name = re.compile(r'backend\s*"([^"]+)"')
-  for backend in backends:
-    gcs_object = ''
-    m = p_bucket.search(backend)
-    if m:
-      gcs_object = 'gs://' + m.group(1)
-    m = p_prefix.search(backend)
-    if m:
-      gcs_object = gcs_object + '/' + m.group(1)
-    m = p_name.search(backend)
-    if m:
-      gcs_object = gcs_object + '/' + m.group(1) + '.tfstate'
-    result.append(gcs_object)
+  # types of the top level blocks, and whether anything else was found at the top level
+  top_blocks = set()
+  top_other = False
+  # open blocks and objects. Each frame holds the block type and labels, or the
+  # name of the attribute for objects, and the literal attributes found.
+  stack = []
+  header = []
+  # last tokens seen, used for finding remote state references
+  window = []
+  # name of the attribute being assigned, if any
+  attr = None
+  at_start = True
+  for kind, value in tokenize_tf(tf_content):
+    # references to remote states: data.terraform_remote_state.NAME.
+    window.append((kind, value))
+    if len(window) > 6:
+      window.pop(0)
+    if len(window) == 6 and window[5][0] == 'DOT' and \
+       [t[1] for t in window[0:4]] == ['data', '.', 'terraform_remote_state', '.'] and window[4][0] == 'IDENT':
+      if not window[4][1] in result['RS_REF']:
+        result['RS_REF'].append(window[4][1])
+
+    if kind == 'LBRACE':
+      if attr is not None:
+        # object assigned to an attribute: config = { ... }
+        stack.append({'attr' : attr, 'attrs' : {}, 'blocks' : []})
+      elif at_start and len(header) > 0 and header[0][0] == 'IDENT':
+        stack.append({'type' : header[0][1], 'labels' : [h[1] for h in header[1:]], 'attrs' : {}, 'blocks' : []})
+        if len(stack) == 1:
+          top_blocks.add(header[0][1])
+      else:
+        top_other = top_other or len(stack) == 0
+        stack.append({'attrs' : {}, 'blocks' : []})
+      header = []
+      attr = None
+      at_start = True
+      continue
+    if kind == 'RBRACE':
+      if len(stack) == 0:
+        continue
+      frame = stack.pop()
+      # remote state definitions need their nested config block
+      if len(stack) > 0 and stack[-1].get('type') == 'data':
+        stack[-1]['blocks'].append(frame)
+      close_tf_frame(frame, stack, current_path, result)
+      header = []
+      attr = None
+      at_start = True
+      continue
+    if kind == 'NEWLINE' or kind == 'COMMA':
+      header = []
+      attr = None
+      at_start = True
+      continue
+    if not at_start:
+      continue
+    if kind == 'EQ' and len(header) == 1 and header[0][0] == 'IDENT':
+      attr = header[0][1]
+      header = []
+      top_other = top_other or len(stack) == 0
+      continue
+    if attr is not None:
+      # value of an attribute. Only literal strings are recorded.
+      if kind == 'STRING' and value is not None and len(stack) > 0:
+        stack[-1]['attrs'][attr] = value
+      attr = None
+      at_start = False
+      continue
+    if kind == 'IDENT' or (kind == 'STRING' and len(header) > 0):
+      header.append((kind, value))
+    else:
+      at_start = False
+  result['SETTINGS'] = len(top_blocks) > 0 and not top_other and top_blocks.issubset(SETTINGS_BLOCKS)
   return result
-  
-def parse_remote_states(tf_content):
-  """
-  Parse remote states configurations from the provided file content. Returns a list of
-  tuples. Ex.: ('foundation', 'gc://tf-bootstrap-vdf/terraform/foundation')
-  Sample configuration:
-  data "terraform_remote_state" "foundation" {
-    backend = "gcs"
-    config {
-      bucket = "tf-bootstrap-vdf"
-      prefix = "terraform/foundation"
-    }
-  }
-  """
-  result = []
-  p = re.compile(r'data\s+\"terraform_remote_state\"\s+\"[^\"]+\"\s*\{[^\{\}]*backend\s*=\s*\"gcs\"\s*config\s*=?\s*\{[^\}]+\}\s+\}')
-  r_states = p.findall(tf_content)
-  if len(r_states) == 0:
-    return result
-  # for each remote state, get the bucket name and prefix
-  p_name = re.compile(r'data\s+"terraform_remote_state"\s+"([^"]+)"\s*\{')
-  p_backend_type = re.compile(r'backend\s*=\s*"([^"]+)"')
-  p_bucket = re.compile(r'bucket\s*=\s*"([^"]+)"')
-  p_prefix = re.compile(r'prefix\s*=\s*"([^"]+)"')
-  for r_state in r_states:
-    rs_name = ''
-    m = p_name.search(r_state)
-    if m:
-      rs_name = m.group(1)
+
+def close_tf_frame(frame, stack, current_path, result):
+  """
+  Record the information found in a block or object once it is closed.
+  """
+  block_type = frame.get('type')
+  labels = frame.get('labels', [])
+  if block_type == 'backend' and len(labels) == 1 and len(stack) > 0 and stack[-1].get('type') == 'terraform':
+    # terraform { backend "gcs" { bucket = "..." prefix = "..." } }
     gcs_object = ''
-    m = p_bucket.search(r_state)
-    if m:
-      gcs_object = 'gs://' + m.group(1)
-    m = p_prefix.search(r_state)
-    if m:
-      gcs_object = gcs_object + '/' + m.group(1)
-    m = p_backend_type.search(r_state)
-    if m:
-      gcs_object = gcs_object + '/' + m.group(1) + '.tfstate'
-    result.append((rs_name, gcs_object))
-  return result
+    if 'bucket' in frame['attrs']:
+      gcs_object = 'gs://' + frame['attrs']['bucket']
+    if 'prefix' in frame['attrs']:
+      gcs_object = gcs_object + '/' + frame['attrs']['prefix']
+    gcs_object = gcs_object + '/' + labels[0] + '.tfstate'
+    result['BACKENDS'].append(gcs_object)
+  elif block_type == 'data' and len(labels) == 2 and labels[0] == 'terraform_remote_state':
+    # data "terraform_remote_state" "name" { backend = "gcs" config = { ... } }
+    config = [b for b in frame['blocks'] if b.get('attr') == 'config' or b.get('type') == 'config']
+    if frame['attrs'].get('backend') != 'gcs' or len(config) == 0:
+      return
+    gcs_object = ''
+    if 'bucket' in config[0]['attrs']:
+      gcs_object = 'gs://' + config[0]['attrs']['bucket']
+    if 'prefix' in config[0]['attrs']:
+      gcs_object = gcs_object + '/' + config[0]['attrs']['prefix']
+    gcs_object = gcs_object + '/' + frame['attrs']['backend'] + '.tfstate'
+    result['RS_DEF'].append((labels[1], gcs_object))
+  elif block_type == 'module' and 'source' in frame['attrs']:
+    # module "name" { source = "../../modules/name" }
+    module_path = os.path.normpath(current_path + '/' + frame['attrs']['source'])
+    if not module_path in result['MD_REF']:
+      result['MD_REF'].append(module_path)
 
-def topology_sort(vertex, adjacency_list, visited_list, output_stack):
+class DependencyCycleError(Exception):
   """
-  Sort build dependencies using depth-first search, as described in
-  https://en.wikipedia.org/wiki/Topological_sorting
+  Raised when the terraform packages to build depend on each other in a cycle.
   """
-  if not visited_list[vertex]:
-      visited_list[vertex] = True
-      for neighbor in adjacency_list[vertex]:
-          topology_sort(neighbor, adjacency_list, visited_list, output_stack)
-      output_stack.insert(0, vertex)
+  def __init__(self, cycle):
+    Exception.__init__(self, 'dependency cycle between packages: %s' % (' -> '.join(cycle)))
+    self.cycle = cycle
 
-def get_build_chain(deps, build_root):
+def get_build_chain(deps, build_roots):
   """
-  Get the full depth list of builds depending from a build node.
+  Get the set of packages that must be built when the given packages change: the
+  packages themselves and all the packages depending on them, directly or not.
+  Each package is expanded once, even when it is reachable through several paths.
   """
-  build_chain = [build_root]
-  if build_root in deps:
-    for dep in deps[build_root]:
-      build_chain.extend(get_build_chain(deps, dep))
+  build_chain = set(build_roots)
+  pending = list(build_chain)
+  while pending:
+    for dep in deps.get(pending.pop(), []):
+      if not dep in build_chain:
+        build_chain.add(dep)
+        pending.append(dep)
   return build_chain
 
-def compute_deps(tf_root):
+def find_cycle(deps, packages):
   """
-  Walk through all the terraform files in a root folder, parse each file and compute
-  dependencies between terraform packages (independent tf config sets).
+  Find a dependency cycle among packages that could not be ordered. Each of them
+  has at least one provider among the others, so walking up providers from any
+  of them must come back to an already visited package.
+  """
+  providers = defaultdict(list)
+  for pkg in packages:
+    for dep in deps.get(pkg, []):
+      if dep in packages:
+        providers[dep].append(pkg)
+  path = []
+  position = {}
+  pkg = min(packages)
+  while not pkg in position:
+    position[pkg] = len(path)
+    path.append(pkg)
+    pkg = min(providers[pkg])
+  # show the cycle in build order: providers before their dependents
+  cycle = path[position[pkg]:]
+  cycle.reverse()
+  return cycle + [cycle[0]]
+
+def build_waves(deps, packages):
+  """
+  Split the packages to build in waves, using Kahn's algorithm
+  (https://en.wikipedia.org/wiki/Topological_sorting) one level at a time. Each
+  wave only contains packages that depend on packages from previous waves, so all
+  the packages of a wave can be built concurrently. Packages are sorted inside each
+  wave, so the result does not depend on the order in which files were found.
+  Raises DependencyCycleError if the packages depend on each other in a cycle.
+  """
+  in_degree = dict([(pkg, 0) for pkg in packages])
+  dependents = {}
+  for pkg in packages:
+    dependents[pkg] = [dep for dep in set(deps.get(pkg, [])) if dep in in_degree]
+    for dep in dependents[pkg]:
+      in_degree[dep] += 1
+  wave = sorted([pkg for pkg in packages if in_degree[pkg] == 0])
+  waves = []
+  built = 0
+  while wave:
+    waves.append(wave)
+    built += len(wave)
+    next_wave = []
+    for pkg in wave:
+      for dep in dependents[pkg]:
+        in_degree[dep] -= 1
+        if in_degree[dep] == 0:
+          next_wave.append(dep)
+    wave = sorted(next_wave)
+  if built < len(in_degree):
+    raise DependencyCycleError(find_cycle(deps, set([pkg for pkg in in_degree if in_degree[pkg] > 0])))
+  return waves
+
+class PathTrie(object):
+  """
+  Set of folder paths stored as a tree of path components, so that all the paths
+  under a given folder can be found without looking at the other ones.
+  """
+
+  def __init__(self, paths=None):
+    self.root = {}
+    for path in paths or []:
+      self.add(path)
+
+  @staticmethod
+  def split(path):
+    path = os.path.normpath(path)
+    return [] if path == '.' else path.split(os.sep)
+
+  def add(self, path):
+    node = self.root
+    for part in self.split(path):
+      node = node.setdefault(part, {})
+    # None can not be a path component, so it marks the end of a path
+    node[None] = os.path.normpath(path)
+
+  def find(self, path):
+    node = self.root
+    for part in self.split(path):
+      node = node.get(part)
+      if node is None:
+        return None
+    return node
+
+  def __contains__(self, path):
+    node = self.find(path)
+    return node is not None and None in node
+
+  def under(self, path):
+    """
+    Returns all the paths of the set that are equal to or below a folder.
+    """
+    found = []
+    node = self.find(path)
+    pending = [node] if node is not None else []
+    while pending:
+      node = pending.pop()
+      for part, child in node.items():
+        if part is None:
+          found.append(child)
+        else:
+          pending.append(child)
+    return found
+
+def tainted_packages(changes, packages):
+  """
+  Find the packages affected by a list of changes, as returned by changelog_parser.read_changelog.
+  A package is tainted when one of its .tf or .tfvars files changed, or when it is
+  inside a changed folder (untracked folders are not expanded by git status).
+  """
+  tainted = set()
+  for path, is_folder in changes:
+    if is_folder:
+      tainted.update(packages.under(path))
+    elif path.endswith('.tf') or path.endswith('.tfvars'):
+      if os.path.dirname(path) in packages:
+        tainted.add(os.path.dirname(path))
+  return tainted
+
+def load_parse_cache(cache_file):
+  """
+  Load the results of parse_tf saved by previous runs. Returns an empty cache if
+  the file does not exist, cannot be read or was written by another version.
+  """
+  if not cache_file or not os.path.exists(cache_file):
+    return {}
+  try:
+    with open(cache_file, 'r') as f:
+      cache = json.load(f)
+  except (IOError, ValueError) as e:
+    logging.warning('ignoring unreadable cache file \'%s\': %s' % (cache_file, e))
+    return {}
+  if cache.get('version') != PARSE_CACHE_VERSION:
+    logging.info('ignoring cache file \'%s\' from a different version' % (cache_file))
+    return {}
+  return cache.get('files', {})
+
+def save_parse_cache(cache_file, files):
+  """
+  Save the results of parse_tf for the next runs. The file is replaced atomically.
+  """
+  dirname = os.path.dirname(cache_file) or '.'
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(cache_file) + '.')
+  with os.fdopen(fd, 'w') as f:
+    json.dump({'version' : PARSE_CACHE_VERSION, 'files' : files}, f, sort_keys=True)
+  os.replace(tmp_name, cache_file)
+
+def cached_parse_tf(tf_file, tf_folder, cache, stats):
+  """
+  Returns the result of parse_tf for a file, using the cache when possible. Cache
+  entries are keyed by path, and are used without reading the file when its size
+  and modification time did not change. Otherwise, the content hash is checked,
+  so files that were only touched (e.g. by a fresh git checkout) are not parsed
+  again. The cache entry of the file is updated.
+  """
+  size, mtime = repo_index.file_stat(tf_file)
+  entry = cache.get(tf_file)
+  if entry and entry['size'] == size and entry['mtime'] == mtime:
+    stats['stat_hits'] += 1
+    tf_refs = entry['refs']
+  else:
+    with open(tf_file, 'rb') as f:
+      content = f.read()
+    content_hash = hashlib.sha256(content).hexdigest()
+    if entry and entry['hash'] == content_hash:
+      stats['hash_hits'] += 1
+      tf_refs = entry['refs']
+    else:
+      stats['parsed'] += 1
+      tf_refs = parse_tf(content.decode('utf-8'), tf_folder)
+    entry = {'size' : size, 'mtime' : mtime, 'hash' : content_hash, 'refs' : tf_refs}
+    cache[tf_file] = entry
+  # remote state definitions are stored as lists in the json cache
+  return dict(tf_refs, RS_DEF=[tuple(rs_def) for rs_def in tf_refs['RS_DEF']])
+
+def scan_packages(tf_root, cache_file=None):
+  """
+  Walk through all the terraform files in a root folder and parse each file. Returns
+  the references found in each terraform package (independent tf config sets), and
+  the package of each remote state backend.
+  If a cache file is provided, the parsing results of the files that did not change
+  since the previous run are taken from it.
   """
   backend2package = {}
   tf_packages = {}
-  for tf_file in glob.iglob(tf_root + '/**/*.tf', recursive=True):
+  cache = load_parse_cache(cache_file)
+  # keep only the entries of the files that still exist
+  new_cache = {}
+  stats = {'stat_hits' : 0, 'hash_hits' : 0, 'parsed' : 0}
+  for tf_file in repo_index.find_files(tf_root, 'tf'):
     tf_file = os.path.normpath(tf_file)
     # all the .tf files in the same folder are part of the same configuration
     tf_folder = os.path.dirname(tf_file)
     if not tf_folder in tf_packages:
-      tf_packages[tf_folder] = {'RS_DEF' : [], 'RS_REF' : [], 'MD_REF' : [], 'LINKERS' : []}
-    f = open(tf_file, "r")
-    tf_content = f.read()
+      tf_packages[tf_folder] = {'RS_DEF' : [], 'RS_REF' : [], 'MD_REF' : [], 'LINKERS' : [], 'SETTINGS' : []}
+    # get backends, remote states and module references in a single pass
+    if tf_file in cache:
+      new_cache[tf_file] = cache[tf_file]
+    tf_refs = cached_parse_tf(tf_file, tf_folder, new_cache, stats)
     # find the GCS url of the current remote storage backend
-    if 'backend' in tf_content:
-      for backend in parse_backends(tf_content):
-        backend2package[backend] = tf_folder
-    if '"terraform_remote_state"' in tf_content:
-      tf_packages[tf_folder]['RS_DEF'].extend(parse_remote_states(tf_content))
-    if 'module ' in tf_content:
-      tf_packages[tf_folder]['MD_REF'].extend(parse_modules(tf_content, tf_folder))
-    if 'data.terraform_remote_state.' in tf_content:
-      tf_packages[tf_folder]['RS_REF'].extend(parse_data_refs(tf_content))
-    f.close()
-  logging.debug('backends found: %s' % str(backend2package))
-  logging.debug('refs found: %s' % str(tf_packages))
+    for backend in tf_refs['BACKENDS']:
+      backend2package[backend] = tf_folder
+    tf_packages[tf_folder]['RS_DEF'].extend(tf_refs['RS_DEF'])
+    tf_packages[tf_folder]['MD_REF'].extend(tf_refs['MD_REF'])
+    tf_packages[tf_folder]['RS_REF'].extend(tf_refs['RS_REF'])
+    if tf_refs['SETTINGS']:
+      tf_packages[tf_folder]['SETTINGS'].append(tf_file)
+  # variable files loaded automatically by terraform configure the package too
+  for tfvars_file in repo_index.find_files(tf_root, 'tfvars'):
+    tfvars_file = os.path.normpath(tfvars_file)
+    name = os.path.basename(tfvars_file)
+    if os.path.dirname(tfvars_file) in tf_packages and (name == 'terraform.tfvars' or name.endswith('.auto.tfvars')):
+      tf_packages[os.path.dirname(tfvars_file)]['SETTINGS'].append(tfvars_file)
+  if cache_file:
+    save_parse_cache(cache_file, new_cache)
+    logging.info('parse cache: %d unchanged, %d touched but identical, %d parsed' %
+                 (stats['stat_hits'], stats['hash_hits'], stats['parsed']))
+  instrumentation.count('tf_files.parsed', stats['parsed'])
+  instrumentation.count('tf_files.stat_hits', stats['stat_hits'])
+  instrumentation.count('tf_files.hash_hits', stats['hash_hits'])
+  instrumentation.count('packages', len(tf_packages))
+  logging.debug('backends found: %s', backend2package)
+  logging.debug('refs found: %s', tf_packages)
+  return tf_packages, backend2package
 
+def link_packages(tf_packages, backend2package):
+  """
+  Compute the dependencies between the packages returned by scan_packages. Returns,
+  for each package used by others, the list of packages that depend on it.
+  """
   # compute package dependencies
   for tf_package in tf_packages:
     # keep only the remote states that are curently being used
@@ -193,6 +510,9 @@ def compute_deps(tf_root):
     tf_packages[tf_package].pop('RS_DEF') 
     # subscribe as dependent from used packages
     for rs_ref in tf_packages[tf_package]['RS_REF']:
+      if not rs_ref in backend2package:
+        logging.warn('remote state \'%s\' referenced from package \'%s\' not found.' % (rs_ref, tf_package))
+        continue
       provider = backend2package[rs_ref]
       if not tf_package in tf_packages[provider]['LINKERS']:
         tf_packages[provider]['LINKERS'].append(tf_package)
@@ -212,56 +532,165 @@ def compute_deps(tf_root):
       dependencies[pk] = tf_packages[pk]['LINKERS']
       logging.debug('PAK: ' + str(pk))
       logging.debug(tf_packages[pk]['LINKERS'])
-  logging.debug('dependecy graph: %s' % str(dependencies))
+  logging.debug('dependecy graph: %s', dependencies)
   return dependencies
 
-def compute_build_steps(changelog, tf_root):
+def compute_deps(tf_root, cache_file=None):
+  """
+  Walk through all the terraform files in a root folder, parse each file and compute
+  dependencies between terraform packages (independent tf config sets).
+  """
+  return link_packages(*scan_packages(tf_root, cache_file))
+
+def load_graph_snapshot(snapshot_file):
+  """
+  Load the dependency graph saved by the previous run: for each package, its
+  remote state backends and the packages that depend on it.
+  """
+  if not snapshot_file or not os.path.exists(snapshot_file):
+    return {}
+  with open(snapshot_file, 'r') as f:
+    snapshot = json.load(f)
+  if snapshot.get('version') != GRAPH_SNAPSHOT_VERSION:
+    logging.warning('ignoring graph snapshot \'%s\' from a different version' % (snapshot_file))
+    return {}
+  return snapshot.get('packages', {})
+
+def save_graph_snapshot(snapshot_file, tf_packages, backend2package, deps):
+  """
+  Save the dependency graph of the current packages for the next run, with the
+  content of their settings files (backend, providers and variables), needed for
+  destroying them once they are deleted.
+  """
+  packages = dict([(pkg, {'backends' : [], 'dependents' : sorted(deps.get(pkg, [])), 'settings' : {}})
+                   for pkg in tf_packages])
+  for backend in sorted(backend2package):
+    packages[backend2package[backend]]['backends'].append(backend)
+  for pkg in tf_packages:
+    for settings_file in tf_packages[pkg]['SETTINGS']:
+      with open(settings_file, 'r') as f:
+        packages[pkg]['settings'][os.path.basename(settings_file)] = f.read()
+  dirname = os.path.dirname(snapshot_file) or '.'
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(snapshot_file) + '.')
+  with os.fdopen(fd, 'w') as f:
+    json.dump({'version' : GRAPH_SNAPSHOT_VERSION, 'packages' : packages}, f, indent=2, sort_keys=True)
+  os.replace(tmp_name, snapshot_file)
+
+def write_destroy_config(destroy_root, tf_package, backends, settings=None):
+  """
+  Write a configuration that only declares the remote state backend and the
+  settings files (providers, with the service account they impersonate, and their
+  variables) of a deleted package. Applying it destroys all the resources that
+  are still in the state. Returns the folder of the configuration, or None if the
+  backend is unknown.
+  """
+  # backends are recorded as gs://<bucket>[/<prefix>]/<name>.tfstate
+  gcs_backends = [b for b in backends if b.startswith('gs://')]
+  if len(gcs_backends) != 1:
+    logging.warning('cannot destroy deleted package \'%s\': no unique gcs backend in snapshot' % (tf_package))
+    return None
+  if not settings:
+    logging.warning('no provider settings recorded for deleted package \'%s\': destroying it with the default '
+                    'provider and credentials' % (tf_package))
+  location = gcs_backends[0][len('gs://'):gcs_backends[0].rfind('/')]
+  bucket, _, prefix = location.partition('/')
+  destroy_dir = os.path.normpath(destroy_root + '/' + tf_package)
+  if os.path.isdir(destroy_dir):
+    shutil.rmtree(destroy_dir)
+  os.makedirs(destroy_dir)
+  for name, content in sorted((settings or {}).items()):
+    with open(destroy_dir + '/' + name, 'w') as f:
+      f.write(content)
+  # the backend is usually declared by one of the settings files
+  if any([parse_tf(content, destroy_dir)['BACKENDS'] for name, content in (settings or {}).items()
+          if name.endswith('.tf')]):
+    return destroy_dir
+  with open(destroy_dir + '/destroy.tf', 'w') as f:
+    f.write('terraform {\n')
+    f.write('  backend "gcs" {\n')
+    f.write('    bucket = "%s"\n' % (bucket))
+    if prefix:
+      f.write('    prefix = "%s"\n' % (prefix))
+    f.write('  }\n')
+    f.write('}\n')
+  return destroy_dir
+
+def destroy_waves(snapshot, tf_packages, destroy_root):
+  """
+  Find the packages of the previous snapshot that do not exist anymore, and return
+  the waves of destroy configurations to apply for them. A deleted package is
+  destroyed after the deleted packages that depended on it.
+  """
+  deleted = set([pkg for pkg in snapshot if not pkg in tf_packages])
+  if not deleted:
+    return []
+  logging.info('deleted packages: %s' % (', '.join(sorted(deleted))))
+  prev_deps = dict([(pkg, snapshot[pkg].get('dependents', [])) for pkg in snapshot])
+  waves = []
+  for wave in reversed(build_waves(prev_deps, deleted)):
+    destroy_dirs = [write_destroy_config(destroy_root, pkg, snapshot[pkg].get('backends', []), snapshot[pkg].get('settings'))
+                    for pkg in wave]
+    destroy_dirs = [d for d in destroy_dirs if d]
+    if destroy_dirs:
+      waves.append(destroy_dirs)
+  return waves
+
+def compute_build_steps(changelog, tf_root, cache_file=None, waves=False, changelog_format='porcelain',
+                        snapshot_file=None, destroy_root=DESTROY_ROOT):
   """
   From a list of modified files and a terraform configuration root, walk through
   all the terraform folders, infer dependencies by looking at the tf files and
-  generate an ordered build list.
-  The providfed change log file must be in the format produced by the 
-  'git status --porcelain' command. Example:
+  generate an ordered build list. If waves is set, the list of build waves (see
+  build_waves) is returned instead.
+  The provided change log file must be in one of the formats supported by
+  changelog_parser.read_changelog. Example for 'git status --porcelain':
   ?? terraform/programs/it/cloud/iam_bindings.tf
   ?? terraform/modules/program/iam.tf
-  ?? terraform/modules/tenant/iam.tf
-  """
-  tainted_packages = []
-  regex = r'^.*(' + tf_root + '\/.+\.(tf|tfvars))$'
-  p = re.compile(regex)
-  with open(changelog) as f:
-    expanded_lines = []
-    for line in f.readlines():
-      line = line.strip()
-      if line.endswith('/'):
-        for fn in glob.iglob(line[line.find(' ')+1:] + '**', recursive=True):
-          expanded_lines.append(fn)
-      else:
-        expanded_lines.append(line)
-    for line in expanded_lines:
-      m = p.match(line)
-      if m:
-        changed_tf_pkg = os.path.dirname(m.group(1))
-        if not changed_tf_pkg in tainted_packages:
-          tainted_packages.append(changed_tf_pkg)
-  logging.debug('Tainted: ' + str(tainted_packages))
+  ?? terraform/modules/tenant/
+  If a snapshot file is provided, the packages found in the previous run that do
+  not exist anymore are destroyed first, using configurations written under
+  destroy_root. The snapshot is then updated with the current graph.
+  """
+  changes = changelog_parser.read_changelog(changelog, changelog_format)
+  return plan_build_steps(changes, tf_root, cache_file, waves, snapshot_file, destroy_root)
+
+def plan_build_steps(changes, tf_root, cache_file=None, waves=False, snapshot_file=None,
+                     destroy_root=DESTROY_ROOT):
+  """
+  Same as compute_build_steps, from the changed paths returned by changelog_parser.parse_changelog.
+  """
+  with instrumentation.span('deps.scan'):
+    tf_packages, backend2package = scan_packages(tf_root, cache_file)
+  with instrumentation.span('deps.taint'):
+    tainted = tainted_packages(changes, PathTrie(tf_packages))
+  instrumentation.count('changes', len(changes))
+  logging.debug('Tainted: %s', instrumentation.lazy(sorted, tainted))
   # arrange the order of the builds
-  deps = compute_deps(tf_root)
-  # get the list of nodes that must be touched
-  adjacency_list = defaultdict()
-  visited_list = defaultdict()
-  for pkg in tainted_packages:
-    build_chain = get_build_chain(deps, pkg)
-    logging.debug('build chain [%s]: %s' %(pkg, ' -> '.join(build_chain)))
-    for node in build_chain:
-      adjacency_list[node] = deps.get(node, '')
-      visited_list[node] = False
-  output_stack = []
-  for vertex in visited_list:
-    topology_sort(vertex, adjacency_list, visited_list, output_stack)
-  return output_stack
-
-def main(changelog, tf_root, output):
+  with instrumentation.span('deps.link'):
+    deps = link_packages(tf_packages, backend2package)
+  snapshot = load_graph_snapshot(snapshot_file)
+  # packages that depended on a deleted package must be built after it is destroyed
+  for pkg in snapshot:
+    if not pkg in tf_packages:
+      tainted.update([dep for dep in snapshot[pkg].get('dependents', []) if dep in tf_packages])
+  # get the list of nodes that must be touched, and sort them
+  with instrumentation.span('deps.order'):
+    build_chain = get_build_chain(deps, tainted)
+    logging.debug('build chain: %s', instrumentation.lazy(sorted, build_chain))
+    build_steps = build_waves(deps, build_chain)
+  instrumentation.count('packages.built', len(build_chain))
+  if snapshot_file:
+    with instrumentation.span('deps.snapshot'):
+      build_steps = destroy_waves(snapshot, tf_packages, destroy_root) + build_steps
+      save_graph_snapshot(snapshot_file, tf_packages, backend2package, deps)
+  if waves:
+    return build_steps
+  return [pkg for wave in build_steps for pkg in wave]
+
+def main(changelog, tf_root, output, cache_file=None, waves=None, changelog_format='porcelain',
+         snapshot_file=None, destroy_root=DESTROY_ROOT):
   tf_root = os.path.normpath(tf_root)
   if not os.path.isdir(tf_root):
     logging.error('directory provided in --tf-root does not exist: ' + tf_root)
@@ -269,13 +698,26 @@ def main(changelog, tf_root, output):
   if not os.path.exists(changelog):
     logging.error('file provided in --changelog does not exist: ' + changelog)
     sys.exit(1)
-  build_steps = compute_build_steps(changelog, tf_root)
+  try:
+    build_steps = compute_build_steps(changelog, tf_root, cache_file, waves != None, changelog_format,
+                                      snapshot_file, destroy_root)
+  except DependencyCycleError as e:
+    logging.error(str(e))
+    sys.exit(1)
+  if waves == 'json':
+    # [["pkg_a", "pkg_b"], ["pkg_c"]]
+    lines = [json.dumps(build_steps, indent=2)]
+  elif waves == 'lines':
+    # one wave per line, packages separated by spaces
+    lines = [' '.join(wave) for wave in build_steps]
+  else:
+    lines = build_steps
   if output:
     output_file = open(output, 'w')
-    for bs in build_steps:
+    for bs in lines:
       output_file.write(bs + '\n')
   else: 
-    for bs in build_steps:
+    for bs in lines:
       print(bs)
 
 def parse_args(argv):
@@ -284,8 +726,25 @@ def parse_args(argv):
                       help='directory where to look for program folders')
   parser.add_argument('--changelog', required=True,
                       help='list of files that were modified (git status --porcelain)')
+  parser.add_argument('--changelog-format', required=False, choices=changelog_parser.CHANGELOG_FORMATS,
+                      default='porcelain',
+                      help='format of the changelog: git status --porcelain, git status --porcelain -z '
+                           'or git diff --name-status -z')
   parser.add_argument('--output', required=False,
                       help='write build order to this file instead of std output')
+  parser.add_argument('--cache', required=False,
+                      help='file where the parsing results of the terraform files are cached between runs')
+  parser.add_argument('--snapshot', required=False,
+                      help='file where the dependency graph is kept between runs, used to destroy deleted packages')
+  parser.add_argument('--destroy-root', required=False, default=DESTROY_ROOT,
+                      help='folder where the configurations used to destroy deleted packages are written')
+  parser.add_argument('--waves', required=False, choices=['lines', 'json'],
+                      help='write the build order as waves of packages that can be built concurrently, '
+                           'one wave per line or as a json list of lists')
+  parser.add_argument('--fs-snapshot', required=False,
+                      help='file where the listing of the tf root folder is kept between runs, so that only the '
+                           'folders that changed are listed again')
+  instrumentation.add_arguments(parser)
   parser.add_argument('--log-level', required=False,
                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                       default='INFO',
@@ -297,4 +756,6 @@ if __name__ == '__main__':
   logging.getLogger().setLevel(getattr(logging, args.log_level))
   FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
   logging.basicConfig(format=FORMAT)
-  main(args.changelog, args.tf_root, args.output)
+  repo_index.use_snapshot(args.tf_root, args.fs_snapshot)
+  instrumentation.run(args, main, args.changelog, args.tf_root, args.output, args.cache, args.waves,
+                      args.changelog_format, args.snapshot, args.destroy_root)
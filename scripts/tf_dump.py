@@ -1,4 +1,6 @@
 import sys
+import io
+import functools
 
 """Generate decently formated Terraform code from python code. See an example
 of usage in the main function.
@@ -33,6 +35,15 @@ class TFBlock(object):
     'resource/google_logging_project_sink' : ['project', 'name', 'destination', 'filter', 'include_children'],
   }
 
+  # instances only hold these attributes. Not having a __dict__ per block saves a lot
+  # of memory when generating hundreds of thousands of resources.
+  __slots__ = ('block_type', 'labels', 'elements')
+
+  # number of element orders kept by _order_for. Bounded, since the element keys
+  # of some blocks differ for each generated object, and the generator can keep
+  # running for hours in watch mode.
+  _ORDER_CACHE_SIZE = 4096
+
   def __init__(self, block_type=None, labels=None, elements=None):
     """
     Create a terraform object. 
@@ -92,122 +103,149 @@ class TFBlock(object):
   def order_elements(self, u_elements):
     """
     Gets a list of keys found in a terraform resource, and applies the preferred
-    order as defined in the _KEY_ORDER. 
+    order as defined in the _KEY_ORDER. The result is shared between blocks with
+    the same signature and should not be modified.
+    """
+    return self._element_order(u_elements)[0]
+
+  def _element_order(self, u_elements):
+    """
+    Returns the ordered list of keys and the length of the longest key. Results
+    are computed once per block type, first label and list of keys.
     """
+    label = self.labels[0] if self.labels else None
+    # keys usually come in the same insertion order for a given kind of block, which
+    # makes a tuple a cheaper cache key than a set
+    return TFBlock._order_for(self.block_type, label, tuple(u_elements))
+
+  @staticmethod
+  @functools.lru_cache(maxsize=_ORDER_CACHE_SIZE)
+  def _order_for(block_type, label, keys):
+    u_elements = set(keys)
     order_types = []
     o_elements = []
+    found = set()
     # most specific order type takes priority (e.g. 'resource/google_compute_disk')
-    if self.block_type and self.labels:
-      order_types.append(self.block_type + '/' + self.labels[0])
+    if block_type and label:
+      order_types.append(block_type + '/' + label)
     # specific order type comes next (e.g. 'resource')
-    if self.block_type:
-      order_types.append(self.block_type)
+    if block_type:
+      order_types.append(block_type)
     # pile in keys as they appear in order type configurations
     for ot in order_types:
-      if ot in self._KEY_ORDER:
-        for k in self._KEY_ORDER[ot]:
-          if k in u_elements and not k in o_elements:
-            o_elements.append(k)
+      for k in TFBlock._KEY_ORDER.get(ot, []):
+        if k in u_elements and not k in found:
+          o_elements.append(k)
+          found.add(k)
     # remaining keys will be added in alphabetical order
-    for k in sorted(u_elements):
-      if k in u_elements and not k in o_elements:
-        o_elements.append(k) 
-    return o_elements
+    for k in sorted(u_elements - found):
+      o_elements.append(k)
+    max_length = max([len(x) for x in o_elements]) if o_elements else 0
+    return (o_elements, max_length)
 
   def dump_tf(self, context=None, indent=' '):
     """
-    Returns the terraform code resulting from the current structure. This
-    function will traverse the block's elements recursively and return the
-    full terraform code of the resource by producing the terraform output of
-    each one of the elements. The elements can be:
+    Returns the terraform code resulting from the current structure. This is a
+    wrapper around write_tf that collects the output in a string. If a list is
+    provided as context, the terraform code for the list is returned instead.
+    """
+    stream = io.StringIO()
+    if not context or type(context) is dict or isinstance(context, TFBlock):
+      self.write_tf(stream, indent)
+    elif type(context) is list:
+      self.write_list_tf(stream, context, indent)
+    return stream.getvalue()
+
+  def write_tf(self, stream, indent=' ', prefix=''):
+    """
+    Writes the terraform code resulting from the current structure to a stream
+    (an open file or an io.StringIO). This function will traverse the block's
+    elements recursively and write the full terraform code of the resource by
+    producing the terraform output of each one of the elements. The elements can be:
      - Primitives: strings / booleans
      - Blocks: with or without block type and labels
      - Lists: typically containing anonymous blocks or strings
+    Output is written directly, without building intermediate strings:
+     - indent: indentation added to the lines of the nested blocks.
+     - prefix: indentation already added by the enclosing blocks, written after
+       each line break.
     """
-    # If no context was provided, this function was called on the objects itself.
-    # Context is provided for printing non block elements (strings, booleans, lists)
-    if not context:
-      context = self
-    # For ease of use, we allow passing anonymous blocks as plain dict structures.
-    # We convert these to TFBlockhere to simplify the logic.
-    if type(context) is dict:
-      context = TFBlock(elements=context)
-    # This is where we will concatenate the output for each element.
-    output = ''
+    write = stream.write
+    newline = '\n' + prefix
     INDENT = '  '
-    if isinstance(context, TFBlock):
-      # block opening:
-      # resource "google_compute_instance" "sap-hana-single-1561556081-tf" {
-      if self.block_type:
-        output += self.block_type + ' '
-      if self.labels:
-        for l in self.labels:
-          output += '"' + l + '" '
-      output += '{\n'
-
-      # print arguments and blocks included in the block. these can be contained
-      # under the 'ELEMENTS' key, or just plain in the comntext if no other
-      # metadata was needed for this block.
-      if len(self.elements) > 0:
-        # ket a sorted list of the element keys
-        s_elements = self.order_elements(self.elements.keys())
-        # get max key length for padding
-        max_length = max([len(x) for x in s_elements])
-        # print out each key followed by its associated value or block
-        for k in s_elements:
-          v = self.elements[k]
-          # convert plain dict structs to TFBlock
-          if type(v) is dict:
-            v = TFBlock(elements=v)
-          if isinstance(v, TFBlock):
-            output += INDENT
-            # blocks with block type are printed without 'key ='
-            if v.is_anonymous():
-              output += k.ljust(max_length) + ' = '
-            sub_block = v.dump_tf(indent=indent + INDENT)
-            output += sub_block.replace('\n', '\n' + indent)
-            output += '\n'
-            continue
-          if type(v) is list and len(v) > 0:
-            if type(v[0]) is TFBlock and k == v[0].block_type:
-              for ve in v:
-                sub_block = ve.dump_tf(indent=indent)
-                output += sub_block.replace('\n', '\n' + indent)
-                output += '\n'
-            else:
-              output += INDENT
-              output += k.ljust(max_length) + ' = '
-              sub_block = self.dump_tf(v, indent=indent + INDENT)
-              output += sub_block.replace('\n', '\n' + indent)
-              output += '\n'
-            continue
-
-          # convert integers to strings. Terraform does not take integers.
-          if type(v) is int:
-            v = str(v)
-          if type(v) is str:
-            output += INDENT + k.ljust(max_length) + ' = '
-            output += v + '\n'
-            #output += '"' + v + '"\n'
-          elif type(v) is bool:
-            output += INDENT + k.ljust(max_length) + ' = '
-            if v:
-              output += 'true\n'
-            else:
-              output += 'false\n'
-      output += '}'
-    elif type(context) is list:
-      output += '[\n'
-      for v in context:
+    # block opening:
+    # resource "google_compute_instance" "sap-hana-single-1561556081-tf" {
+    if self.block_type:
+      write(self.block_type + ' ')
+    if self.labels:
+      for l in self.labels:
+        write('"' + l + '" ')
+    write('{' + newline)
+
+    # print arguments and blocks included in the block.
+    if len(self.elements) > 0:
+      # ket a sorted list of the element keys, and the max key length for padding
+      s_elements, max_length = self._element_order(self.elements.keys())
+      # print out each key followed by its associated value or block
+      for k in s_elements:
+        v = self.elements[k]
+        # convert plain dict structs to TFBlock
         if type(v) is dict:
           v = TFBlock(elements=v)
+        if isinstance(v, TFBlock):
+          write(INDENT)
+          # blocks with block type are printed without 'key ='
+          if v.is_anonymous():
+            write(k.ljust(max_length) + ' = ')
+          v.write_tf(stream, indent + INDENT, prefix + indent)
+          write(newline)
+          continue
+        if type(v) is list and len(v) > 0:
+          if type(v[0]) is TFBlock and k == v[0].block_type:
+            for ve in v:
+              ve.write_tf(stream, indent, prefix + indent)
+              write(newline)
+          else:
+            write(INDENT + k.ljust(max_length) + ' = ')
+            self.write_list_tf(stream, v, indent + INDENT, prefix + indent)
+            write(newline)
+          continue
+
+        # convert integers to strings. Terraform does not take integers.
+        if type(v) is int:
+          v = str(v)
         if type(v) is str:
-          output += '  "' + v + '",\n'
-        elif isinstance(v, TFBlock):
-          sub_block = v.dump_tf(indent=indent+INDENT)
-          output += INDENT + sub_block.replace('\n', '\n' + indent) + ',\n'
-      output += ']'
-    return output
+          # multi-line values get the indentation of the enclosing blocks
+          if prefix and '\n' in v:
+            v = v.replace('\n', newline)
+          write(INDENT + k.ljust(max_length) + ' = ' + v + newline)
+        elif type(v) is bool:
+          if v:
+            write(INDENT + k.ljust(max_length) + ' = true' + newline)
+          else:
+            write(INDENT + k.ljust(max_length) + ' = false' + newline)
+    write('}')
+
+  def write_list_tf(self, stream, elements, indent=' ', prefix=''):
+    """
+    Writes the terraform code of a list of strings or anonymous blocks to a stream.
+    """
+    write = stream.write
+    newline = '\n' + prefix
+    INDENT = '  '
+    write('[' + newline)
+    for v in elements:
+      if type(v) is dict:
+        v = TFBlock(elements=v)
+      if type(v) is str:
+        if prefix and '\n' in v:
+          v = v.replace('\n', newline)
+        write('  "' + v + '",' + newline)
+      elif isinstance(v, TFBlock):
+        write(INDENT)
+        v.write_tf(stream, indent + INDENT, prefix + indent)
+        write(',' + newline)
+    write(']')
 
 if __name__ == '__main__':
   test_block = TFBlock(block_type='resource', labels=['google_compute_instance', 'sap-hana-single'])
@@ -8,16 +8,108 @@ agreement with Google.
 """
 import os
 import sys
-import shutil
 import argparse
 import logging
 import yaml
 import json
 import jinja2
 import tf_dump
-import glob
+import group_index
+import instrumentation
+import repo_index
+import codeowners_gen
+import hashlib
+import concurrent.futures
+import time
+import tempfile
+
+# use the libyaml based loader when available, it is several times faster than the
+# pure python one. Both only build standard YAML types.
+try:
+  from yaml import CSafeLoader as YamlLoader
+except ImportError:
+  from yaml import SafeLoader as YamlLoader
 
 conf_cache = {}
+# jinja environments and template listings, by template folder
+jinja_envs = {}
+template_lists = {}
+# content hashes of the files read by this process, by path, with the (size,
+# modification time) of the file when it was hashed
+file_hashes = {}
+
+# bump this whenever the layout of the manifest or the generated code changes in a
+# way that requires regenerating all the terraform files.
+MANIFEST_VERSION = 3
+MANIFEST_FILE = '.ci_groups_manifest.json'
+# file holding the import and removed blocks of the groups moved between states
+SHARD_MOVES_FILE = 'shard_moves.tf'
+# ways of splitting the groups of a folder in several terraform states
+SHARDING_MODES = ['folder', 'file', 'group', 'max_resources']
+
+# the number of folder components to be used in the group prefix
+PREFIX_LENGTH = 2
+
+# fields accepted in a group definition, and whether they hold a list of members
+GROUP_FIELDS = {
+  'name' : False,
+  'description' : False,
+  'owners' : True,
+  'managers' : True,
+  'members' : True,
+}
+
+# layout of the group and membership resources, as produced by tf_dump.TFBlock. Used
+# by the fast rendering path, which must produce exactly the same code.
+TF_GROUP_FORMAT = (
+  'resource "google_cloud_identity_group" "%(full_name)s" {\n'
+  '  display_name         = "%(full_name)s"\n'
+  '  group_key {\n'
+  '   id = "%(unique_id)s"\n'
+  ' }\n'
+  '  initial_group_config = "WITH_INITIAL_OWNER"\n'
+  '  labels               = {\n'
+  '   "cloudidentity.googleapis.com/groups.discussion_forum" = ""\n'
+  ' }\n'
+  '  parent               = "%(parent)s"\n'
+  '}'
+)
+TF_MEMBER_FORMAT = (
+  'resource "google_cloud_identity_group_membership" "%(label)s" {\n'
+  '  group                = google_cloud_identity_group.%(group_id)s.id\n'
+  '  preferred_member_key {\n'
+  '   id = "%(member_id)s"\n'
+  ' }\n'
+  '%(roles)s'
+  '}'
+)
+TF_ROLE_FORMAT = (
+  'roles {\n'
+  '   name = "%s"\n'
+  ' }\n'
+)
+
+# membership roles, as bits of the value stored for each member in the membership
+# index of a group. Every member has the MEMBER role.
+ROLE_MEMBER = 1
+ROLE_OWNER = 2
+ROLE_MANAGER = 4
+# group fields holding members with the role they grant, in the order used to list
+# the members of a group
+ROLE_FIELDS = [('members', ROLE_MEMBER), ('managers', ROLE_MANAGER), ('owners', ROLE_OWNER)]
+# role bits of the role names used by the Cloud Identity API
+ROLE_BITS = {'MEMBER': ROLE_MEMBER, 'OWNER': ROLE_OWNER, 'MANAGER': ROLE_MANAGER}
+# list of role names for each combination of role bits, in the order they are written
+ROLE_NAMES = [
+  ['MEMBER'] + [name for bit, name in [(ROLE_OWNER, 'OWNER'), (ROLE_MANAGER, 'MANAGER')] if mask & bit]
+  for mask in range(8)
+]
+
+class GroupFileError(Exception):
+  """
+  Raised when a group configuration file cannot be loaded.
+  """
+  pass
 
 def parse_args(argv):
   parser = argparse.ArgumentParser()
@@ -29,6 +121,20 @@ def parse_args(argv):
   parser.add_argument('--revert-forced-updates', action='store_true',
                       help='set to false any existing force_updates flag found in requests file')
   parser.add_argument('--resources', help='yaml file containing the resources to create')
+  parser.add_argument('--incremental', action='store_true',
+                      help='only regenerate the terraform files whose source yaml files changed since the last run')
+  parser.add_argument('--template-cache', required=False,
+                      help='folder where compiled templates are cached between runs')
+  parser.add_argument('--fast-render', action='store_true',
+                      help='write group and membership resources from fixed templates instead of using tf_dump')
+  parser.add_argument('--duplicate-groups', choices=['warn', 'error'], default='warn',
+                      help='what to do when a group is defined more than once: use the definition from the first file in path order, or fail')
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='number of worker processes used for parsing and rendering the group files (0: one per CPU)')
+  parser.add_argument('--fs-snapshot', required=False,
+                      help='file where the listing of the resources folder is kept between runs, so that only the '
+                           'folders that changed are listed again')
+  instrumentation.add_arguments(parser)
   parser.add_argument('--log-level', required=False,
                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                       default='INFO',
@@ -40,6 +146,27 @@ def parse_args(argv):
   log_config = subparsers.add_parser('ci-groups', help='generates cloud identity groups')
   log_config.set_defaults(func=cmd_ci_groups)
 
+  plan_parser = subparsers.add_parser('plan', help='compares the groups with a snapshot of Cloud Identity, without terraform')
+  plan_parser.add_argument('--snapshot', help='json snapshot of the groups and memberships that exist in Cloud Identity')
+  plan_parser.add_argument('--detailed', action='store_true', help='print every change, not only the summary')
+  plan_parser.add_argument('--plan-out', help='write the list of changes to this json file')
+  plan_parser.add_argument('--write-snapshot', help='write the groups defined in the resources folder as a snapshot')
+  plan_parser.add_argument('--managed-prefixes',
+                           help='json file where the prefixes of the group names are kept between runs, so that the '
+                                'groups of deleted tenants and business units are destroyed')
+  plan_parser.set_defaults(func=cmd_plan)
+
+  watch_parser = subparsers.add_parser('watch', help='regenerates the terraform files each time the group files change')
+  watch_parser.add_argument('--interval', type=float, default=0.5, help='seconds between two checks for changes')
+  watch_parser.add_argument('--codeowners-out',
+                            help='also keep this CODEOWNERS file up to date with the OWNERS files of the resources folder')
+  watch_parser.set_defaults(func=cmd_watch)
+
+  moves_parser = subparsers.add_parser('moves-applied', help='drops the pending group moves once their states were applied')
+  moves_parser.add_argument('--build-steps', required=True,
+                            help='file listing the terraform configurations applied successfully, one per line')
+  moves_parser.set_defaults(func=cmd_moves_applied)
+
   return parser.parse_args(argv)
 
 def get_config(config_file, mandatory_fields):
@@ -53,7 +180,7 @@ def get_config(config_file, mandatory_fields):
       return conf_cache[config_file]
   # open the requests file, which is in YAML format
   stream = open(config_file, "r")
-  config_stream = yaml.load_all(stream, Loader=yaml.FullLoader)
+  config_stream = yaml.load_all(stream, Loader=YamlLoader)
   config_params = {}
   # YAML files can have multiple "documents" go through the file and append all the
   # elements in a single map
@@ -73,24 +200,244 @@ def get_config(config_file, mandatory_fields):
   conf_cache[config_file] = config_params
   return config_params
 
-def generate_tf_files(template_dir, tf_out, tpl_type, context, replace, prefix=None):
+def content_hash(content):
+  """
+  Returns the hex digest used to fingerprint source and output files.
+  """
+  if type(content) is str:
+    content = content.encode('utf-8')
+  return hashlib.sha256(content).hexdigest()
+
+def cached_file_hash(file_name):
+  """
+  Returns the hash of a file computed earlier by this process, or None if the file
+  changed since, or was never hashed.
+  """
+  entry = file_hashes.get(file_name)
+  if not entry:
+    return None
+  try:
+    return entry[1] if entry[0] == repo_index.file_stat(file_name) else None
+  except OSError:
+    return None
+
+def record_file_hash(file_name, stat, file_hash):
+  # a file modified very recently could change again without changing its
+  # modification time, its hash is computed again next time
+  if stat[1] < time.time_ns() - repo_index.RACY_NS:
+    file_hashes[file_name] = (stat, file_hash)
+
+def file_hash(file_name):
+  """
+  Returns the content hash of a file, only reading it if it changed since it was
+  last hashed by this process.
+  """
+  known_hash = cached_file_hash(file_name)
+  if known_hash:
+    return known_hash
+  stat = repo_index.file_stat(file_name)
+  with open(file_name, 'rb') as f:
+    result = content_hash(f.read())
+  record_file_hash(file_name, stat, result)
+  return result
+
+def build_fingerprint(config_file, template_dir):
+  """
+  Computes a hash of everything that affects all the generated files at once: the
+  manifest version, the config file and the templates. If any of these changes, all
+  the terraform files need to be regenerated.
+  """
+  h = hashlib.sha256(('manifest-v%d\n' % (MANIFEST_VERSION)).encode('utf-8'))
+  with open(config_file, 'rb') as f:
+    h.update(f.read())
+  for dirpath, dirnames, filenames in os.walk(template_dir):
+    dirnames.sort()
+    for fn in sorted(filenames):
+      tpl_file = os.path.join(dirpath, fn)
+      h.update(os.path.relpath(tpl_file, template_dir).encode('utf-8') + b'\0')
+      with open(tpl_file, 'rb') as f:
+        h.update(f.read())
+  return h.hexdigest()
+
+def load_manifest(manifest_file, fingerprint):
+  """
+  Loads the manifest written by a previous run. Returns an empty manifest if the
+  file does not exist, cannot be read, or was produced with a different config,
+  templates or manifest version, which forces a full rebuild.
+  """
+  manifest = {'version': MANIFEST_VERSION, 'fingerprint': fingerprint, 'sources': {}}
+  if not os.path.exists(manifest_file):
+    logging.info('no previous manifest found. Full rebuild needed.')
+    return manifest, False
+  try:
+    with open(manifest_file, 'r') as f:
+      previous = json.load(f)
+  except (IOError, ValueError) as e:
+    logging.warning('could not read manifest \'%s\': %s. Full rebuild needed.' % (manifest_file, e))
+    return manifest, False
+  if previous.get('version') != MANIFEST_VERSION or previous.get('fingerprint') != fingerprint:
+    logging.info('manifest version, config or templates changed. Full rebuild needed.')
+    # keep the list of sources so that stale outputs can still be removed
+    manifest['sources'] = previous.get('sources', {})
+    manifest['move_files'] = previous.get('move_files', [])
+    manifest['moves'] = previous.get('moves', {})
+    return manifest, False
+  manifest['sources'] = previous.get('sources', {})
+  manifest['move_files'] = previous.get('move_files', [])
+  manifest['moves'] = previous.get('moves', {})
+  return manifest, True
+
+def save_manifest(manifest_file, manifest):
+  """
+  Writes the manifest next to the generated terraform files.
+  """
+  dirname = os.path.dirname(manifest_file)
+  if dirname and not os.path.exists(dirname):
+    os.makedirs(dirname)
+  write_file(manifest_file, json.dumps(manifest, indent=1, sort_keys=True) + '\n')
+
+def write_file(file_name, content):
+  """
+  Writes content to a file only if it differs from the current content of the
+  file. The file is replaced atomically, so readers never see a partially written
+  file, and unchanged files keep their modification time. Returns True if the file
+  was written.
+  """
+  if type(content) is str:
+    content = content.encode('utf-8')
+  if os.path.isfile(file_name):
+    with open(file_name, 'rb') as f:
+      if f.read() == content:
+        logging.debug('unchanged file: \'%s\'' % (file_name))
+        instrumentation.count('files.unchanged')
+        return False
+  tmp_file, tmp_name = open_temp_file(file_name, 'wb')
+  try:
+    with tmp_file:
+      tmp_file.write(content)
+    replace_file(tmp_name, file_name)
+  except:
+    os.remove(tmp_name)
+    raise
+  instrumentation.count('files.written')
+  instrumentation.count('bytes.written', len(content))
+  return True
+
+def open_temp_file(file_name, mode='w'):
+  """
+  Opens a temporary file in the folder of the given file, so that it can later be
+  moved in place atomically with replace_file. Returns the open file and its name.
+  """
+  dirname = os.path.dirname(file_name) or '.'
+  fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(file_name) + '.')
+  if 'b' in mode:
+    return os.fdopen(fd, mode), tmp_name
+  return os.fdopen(fd, mode, encoding='utf-8', newline=''), tmp_name
+
+def replace_file(tmp_name, file_name):
+  """
+  Moves a temporary file in place of the target file.
+  """
+  # mkstemp creates private files, use the usual permissions instead
+  umask = os.umask(0)
+  os.umask(umask)
+  os.chmod(tmp_name, 0o666 & ~umask)
+  os.replace(tmp_name, file_name)
+
+def commit_temp_file(tmp_name, file_name):
+  """
+  Moves a temporary file in place of the target file if their contents differ, or
+  removes it otherwise. Returns whether the file was changed and the hash of its
+  content.
+  """
+  h = hashlib.sha256()
+  size = 0
+  same = os.path.isfile(file_name)
+  with open(tmp_name, 'rb') as new_file:
+    old_file = open(file_name, 'rb') if same else None
+    try:
+      while True:
+        chunk = new_file.read(65536)
+        h.update(chunk)
+        size += len(chunk)
+        if same:
+          same = old_file.read(len(chunk) or 1) == chunk
+        if not chunk:
+          break
+    finally:
+      if old_file:
+        old_file.close()
+  if same:
+    logging.debug('unchanged file: \'%s\'' % (file_name))
+    instrumentation.count('files.unchanged')
+    os.remove(tmp_name)
+    return False, h.hexdigest()
+  replace_file(tmp_name, file_name)
+  instrumentation.count('files.written')
+  instrumentation.count('bytes.written', size)
+  return True, h.hexdigest()
+
+def remove_stale_files(out_folder, keep):
+  """
+  Removes the files found in a folder that are not in the list of files to keep.
+  Sub-folders and hidden files are left untouched.
+  """
+  for entry in os.scandir(out_folder):
+    if entry.name.startswith('.') or not entry.is_file() or entry.name in keep:
+      continue
+    logging.debug('removing stale file: \'%s\'' % (entry.path))
+    os.remove(entry.path)
+
+def get_jinja_env(template_dir, cache_dir=None):
+  """
+  Returns the jinja2 environment for a template folder. The environment is created
+  once per run, so each template is only loaded and compiled once. If a cache folder
+  is provided, the compiled templates are also stored there and reused by later runs.
+  """
+  if template_dir in jinja_envs:
+    return jinja_envs[template_dir]
+  bytecode_cache = None
+  if cache_dir:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+  # templates do not change during a run, so there is no need to check them for updates
+  env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir), trim_blocks=True,
+                           bytecode_cache=bytecode_cache, auto_reload=False)
+  jinja_envs[template_dir] = env
+  return env
+
+def get_template_list(template_dir, tpl_type):
+  """
+  Returns the names of the templates of a given type (sub-folder of the templates
+  folder), ignoring hidden files. The folder is only listed once per run.
+  """
+  key = (template_dir, tpl_type)
+  if not key in template_lists:
+    template_list = []
+    if os.path.isdir(template_dir + '/' + tpl_type):
+      template_list = sorted([f for f in os.listdir(template_dir + '/' + tpl_type) if not f.startswith('.')])
+    template_lists[key] = template_list
+  return template_lists[key]
+
+def generate_tf_files(template_dir, tf_out, tpl_type, context, replace, prefix=None, keep=None):
   """
   Generates terraform files given a context and template folder.
   - template_dir: the folder containing the jinja templates to use.
   - tf_out: the folder where the resulting terraform files will be written.
   - tpl_type: the type of template to use (sub-folder of the templates folder).
   - comntext: the content object that will be passed to the jinja templates.
-  - replace: remove previous output files before writing new ones.
+  - replace: overwrite previous output files, and remove the ones that are not
+    generated anymore.
   - prefix: used when generating several terraform configurations in the same
     output folder (currently used for projects).
+  - keep: names of other files in the output folder that should not be removed
+    when replacing previous files.
   """
-  # initialize jinja2 environment for tf templates
-  env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir), trim_blocks=True)
+  # get the jinja2 environment for tf templates
+  env = get_jinja_env(template_dir)
   # check for templates with the current template type
-  template_list = []
-  if os.path.isdir(template_dir + '/' + tpl_type):
-    template_list = os.listdir(template_dir + '/' + tpl_type)
-  if len(template_list) == 0:
+  if len(get_template_list(template_dir, tpl_type)) == 0:
     logging.warning('no templates found for request of type \'%s\'' % (tpl_type))
     return False
 
@@ -99,32 +446,23 @@ def generate_tf_files(template_dir, tf_out, tpl_type, context, replace, prefix=N
   if prefix:
     out_folder += '/' + prefix
 
-  # if replace requested, remove previous files. If not requested but previous files
-  # present, return.
+  # if replace requested, previous files will be overwritten if they changed. If not
+  # requested but previous files present, return.
   if os.path.isdir(out_folder):
-    if replace:
-      shutil.rmtree(out_folder)
-      logging.debug('removing previous config: \'%s\'' %(out_folder))
-      os.mkdir(out_folder)
-    else:
+    if not replace:
       logging.info('ignoring request \'%s\'. Found previous terraform config folder.' % (out_folder))
       return False
   else:
     os.makedirs(out_folder)
 
   # apply the selected templates
-  logging.info('using context: %s' % (json.dumps(context, sort_keys=True)))
-  for ttype in ['common', tpl_type]:
-    template_list = []
-    if os.path.isdir(template_dir + '/' + ttype):
-      template_list = os.listdir(template_dir + '/' + ttype)
-    else:
-      continue
-
-    for tplfile in template_list:
-      # remove junk files
-      if tplfile.startswith('.'):
-        continue
+  logging.info('using context: %s', instrumentation.lazy(json.dumps, context, sort_keys=True))
+  generated = set()
+  tpl_types = ['common']
+  if tpl_type != 'common':
+    tpl_types.append(tpl_type)
+  for ttype in tpl_types:
+    for tplfile in get_template_list(template_dir, ttype):
       template = env.get_template(ttype + '/' + tplfile)
       out_file_name = out_folder + '/' + tplfile
       # remove jinjs2 extensions
@@ -133,146 +471,1085 @@ def generate_tf_files(template_dir, tf_out, tpl_type, context, replace, prefix=N
       logging.debug('generating config file: \'%s\'' % (out_file_name))
       rendered = template.render(context=context).strip()
       if len(rendered) > 0:
-        out_file = open(out_file_name, "w")
-        out_file.write(rendered)
-        out_file.close()
+        write_file(out_file_name, rendered)
+        generated.add(out_file_name)
       elif os.path.exists(out_file_name):
         logging.debug('empty output. Remving previous file: \'%s\'' % (out_file_name))
         os.remove(out_file_name)
+  # remove the files left by previous runs
+  if replace:
+    keep = set(keep or [])
+    keep.update([os.path.basename(f) for f in generated])
+    remove_stale_files(out_folder, keep)
+  return True
+
+def tf_group(group, parent):
+  """
+  Generates the terraform block for a group
+  """
+  tf_block = tf_dump.TFBlock(block_type='resource', labels=['google_cloud_identity_group', group['full_name']])
+  tf_block.add_element('display_name', '"%s"' % (group['full_name']))
+  tf_block.add_element('initial_group_config', '"WITH_INITIAL_OWNER"')
+  tf_block.add_element('parent', '"%s"' % (parent))
+  tf_key_block = tf_dump.TFBlock(block_type='group_key')
+  tf_key_block.add_element('id', '"%s"' % (group['unique_id']))
+  tf_block.add_block(tf_key_block)
+  labels = {
+    '"cloudidentity.googleapis.com/groups.discussion_forum"' : '""'
+  }
+  tf_block.add_element('labels', labels)
+  return tf_block
+
+def tf_member(group_id, member_id, roles):
+  """
+  Generates the terraform block for a group member
+  """
+  member_id = member_id.lower()
+  tf_block = tf_dump.TFBlock(block_type='resource', labels=['google_cloud_identity_group_membership', member_label(group_id, member_id)])
+  tf_block.add_element('group', 'google_cloud_identity_group.%s.id' % (group_id))
+  tf_key_block = tf_dump.TFBlock(block_type='preferred_member_key')
+  tf_key_block.add_element('id', '"%s"' % (member_id))
+  tf_block.add_block(tf_key_block)
+  for role in roles:
+    tf_roles_block = tf_dump.TFBlock(block_type='roles')
+    tf_roles_block.add_element('name', '"%s"' % (role))
+    tf_block.add_block(tf_roles_block)
+  return tf_block
+
+def nested_value(value):
+  """
+  Indents the line breaks of a value found in a nested block, like tf_dump does.
+  """
+  if '\n' in value:
+    return value.replace('\n', '\n ')
+  return value
+
+def write_tf_group(stream, group, parent):
+  """
+  Writes the terraform code for a group. Same output as tf_group, without building
+  the intermediate terraform blocks.
+  """
+  stream.write(TF_GROUP_FORMAT % {
+    'full_name' : group['full_name'],
+    'unique_id' : nested_value(group['unique_id']),
+    'parent' : parent,
+  })
+
+def write_tf_member(stream, group_id, member_id, roles):
+  """
+  Writes the terraform code for a group member. Same output as tf_member, without
+  building the intermediate terraform blocks.
+  """
+  member_id = member_id.lower()
+  roles_code = ''.join([TF_ROLE_FORMAT % (nested_value(role)) for role in roles])
+  # tf_dump indents a single roles block, but not a list of them
+  if len(roles) == 1:
+    roles_code = '  ' + roles_code
+  stream.write(TF_MEMBER_FORMAT % {
+    'label' : member_label(group_id, member_id),
+    'group_id' : group_id,
+    'member_id' : nested_value(member_id),
+    'roles' : roles_code,
+  })
+
+def check_group_node(node):
+  """
+  Checks the structure of a group configuration file before building any python
+  object from it. The file must contain a list of groups, and each group can only
+  have the fields listed in GROUP_FIELDS.
+  """
+  if not isinstance(node, yaml.SequenceNode):
+    raise yaml.constructor.ConstructorError(None, None,
+      'expected a list of groups, but found %s' % (node.id), node.start_mark)
+  for g_node in node.value:
+    if not isinstance(g_node, yaml.MappingNode):
+      raise yaml.constructor.ConstructorError(None, None,
+        'expected a group definition, but found %s' % (g_node.id), g_node.start_mark)
+    found = set()
+    for k_node, v_node in g_node.value:
+      if not isinstance(k_node, yaml.ScalarNode) or not k_node.value in GROUP_FIELDS:
+        raise yaml.constructor.ConstructorError('while checking a group definition', g_node.start_mark,
+          'unknown group field \'%s\'' % (k_node.value), k_node.start_mark)
+      if k_node.value in found:
+        raise yaml.constructor.ConstructorError('while checking a group definition', g_node.start_mark,
+          'field \'%s\' defined twice' % (k_node.value), k_node.start_mark)
+      found.add(k_node.value)
+      if GROUP_FIELDS[k_node.value]:
+        if not isinstance(v_node, yaml.SequenceNode) or \
+           not all([isinstance(m, yaml.ScalarNode) for m in v_node.value]):
+          raise yaml.constructor.ConstructorError('while checking a group definition', g_node.start_mark,
+            'field \'%s\' must be a list of members' % (k_node.value), v_node.start_mark)
+      elif not isinstance(v_node, yaml.ScalarNode):
+        raise yaml.constructor.ConstructorError('while checking a group definition', g_node.start_mark,
+          'field \'%s\' must be a string' % (k_node.value), v_node.start_mark)
+
+def load_group_file(conf_file, known_hash=None):
+  """
+  Reads a group configuration file and returns its hash and parsed content. The
+  content is not parsed if the file hash matches the known hash, in which case
+  None is returned instead. Runs in the worker processes when --jobs is used.
+  """
+  with open(conf_file, 'rb') as f:
+    content = f.read()
+  src_hash = content_hash(content)
+  if src_hash == known_hash:
+    return src_hash, None
+  loader = YamlLoader(content)
+  try:
+    node = loader.get_single_node()
+    # ignore empty files
+    if node is None:
+      return src_hash, []
+    check_group_node(node)
+    return src_hash, loader.construct_document(node)
+  except yaml.YAMLError as e:
+    raise GroupFileError('invalid group file %s: %s' % (conf_file, e))
+  finally:
+    loader.dispose()
+
+def member_label(group_id, member_id):
+  """
+  Returns the name of the terraform resource for a group membership.
+  """
+  return group_id + '_' + member_id.replace('@', '_').replace('.', '_')
+
+def index_members(group):
+  """
+  Builds the membership index of a group: member IDs, in lower case, mapped to the
+  role bits of the member. Members keep the order in which they first appear in
+  the members, managers and owners lists. Returns the index, followed by the
+  lists of warnings and errors found: members listed twice, or with different
+  spellings, are merged and reported as warnings; members that would produce
+  terraform resources with the same name are reported as errors.
+  """
+  index = {}
+  spellings = {}
+  labels = {}
+  warnings = []
+  errors = []
+  for field, role in ROLE_FIELDS:
+    listed = set()
+    for member in group.get(field) or []:
+      member = str(member)
+      member_id = member.lower()
+      if member_id in listed:
+        warnings.append('member \'%s\' listed twice in %s' % (member, field))
+        continue
+      listed.add(member_id)
+      if member_id in index:
+        if spellings[member_id] != member:
+          warnings.append('member \'%s\' also listed as \'%s\'' % (member, spellings[member_id]))
+        index[member_id] |= role
+        continue
+      label = member_label(group['full_name'], member_id)
+      if label in labels:
+        errors.append('members \'%s\' and \'%s\' would use the same resource name: %s' % (labels[label], member, label))
+        continue
+      labels[label] = member
+      spellings[member_id] = member
+      index[member_id] = ROLE_MEMBER | role
+  return index, warnings, errors
+
+def render_group_file(groups, parent, out_file, fast=False):
+  """
+  Writes the terraform code for all the groups defined in a configuration file,
+  using the membership index of each group (see index_members). Each resource is streamed to a temporary file, which replaces the output file
+  only if the content changed. Returns the hash of the generated code. Runs in
+  the worker processes when --jobs is used.
+  If fast is set, resources are written with write_tf_group and write_tf_member
+  instead of tf_dump.
+  """
+  tmp_file, tmp_name = open_temp_file(out_file)
+  try:
+    with tmp_file:
+      for group in groups:
+        if fast:
+          write_tf_group(tmp_file, group, parent)
+        else:
+          tf_group(group, parent).write_tf(tmp_file)
+        tmp_file.write('\n\n')
+        # one resource per member, with all the roles of the member
+        for member_id, roles in group['membership'].items():
+          if fast:
+            write_tf_member(tmp_file, group['full_name'], member_id, ROLE_NAMES[roles])
+          else:
+            tf_member(group['full_name'], member_id, ROLE_NAMES[roles]).write_tf(tmp_file)
+          tmp_file.write('\n\n')
+    changed, out_hash = commit_temp_file(tmp_name, out_file)
+  except:
+    if os.path.exists(tmp_name):
+      os.remove(tmp_name)
+    raise
+  return out_hash
+
+def group_prefix(g_path):
+  """
+  Returns the prefix of the names of the groups defined in a folder, made of the
+  first components of its path (tenant and business unit).
+  """
+  return '-'.join(g_path.lower().split('/')[0:PREFIX_LENGTH])
+
+def expand_group_file(resources_dir, conf_file, resources, domain):
+  """
+  Completes the group definitions read from a configuration file with their
+  names and unique IDs.
+  """
+  # the path of the file: remove the root folder and the file name
+  g_path = conf_file[len(resources_dir)+1:conf_file.rfind('/')]
+  g_prefix = group_prefix(g_path)
+  for group in resources or []:
+    if not 'name' in group:
+      raise GroupFileError('group definitions must have a name: ' + conf_file)
+    # create the unique ID for the group, which is composed of the prefix, plus the domain.
+    group['full_name'] = g_prefix + '-' + str(group['name'])
+    group['unique_id'] = group['full_name'] + '@' + domain
+    group['path'] = g_path
+    group['conf'] = conf_file
+  return resources or []
+
+def load_group_model(resources_dir, domain, executor=None, duplicate_groups='warn'):
+  """
+  Reads all the group configuration files of a folder and returns the groups that
+  would be generated, by lower case unique ID, with their membership index (see
+  index_members). Conflicts are solved like in cmd_ci_groups. Returns None if
+  errors were found.
+  """
+  conf_files = repo_index.find_files(resources_dir, 'yaml')
+  groups_index = group_index.GroupIndex()
+  parsed = {}
+  try:
+    for conf_file, (src_hash, resources) in zip(conf_files, pool_map(executor, load_group_file, conf_files)):
+      parsed[conf_file] = expand_group_file(resources_dir, conf_file, resources, domain)
+      groups_index.add_source(conf_file, [g['unique_id'] for g in parsed[conf_file]])
+  except GroupFileError as e:
+    logging.error(str(e))
+    return None
+  conflicts = groups_index.conflict_report()
+  for line in conflicts:
+    if duplicate_groups == 'error':
+      logging.error(line)
+    else:
+      logging.warning(line + '. Using the first one.')
+  if len(conflicts) > 0 and duplicate_groups == 'error':
+    return None
+  groups = {}
+  errors = 0
+  for conf_file in conf_files:
+    for position, group in enumerate(parsed[conf_file]):
+      if not groups_index.is_winner(group['unique_id'], conf_file, position):
+        continue
+      group['membership'], m_warnings, m_errors = index_members(group)
+      for msg in m_warnings:
+        logging.warning('group %s (%s): %s' % (group['unique_id'], conf_file, msg))
+      for msg in m_errors:
+        logging.error('group %s (%s): %s' % (group['unique_id'], conf_file, msg))
+      errors += len(m_errors)
+      # group keys are case insensitive in Cloud Identity, like member keys. The groups
+      # index compares them in lower case too, so there is only one winner per key.
+      groups[group['unique_id'].lower()] = group
+  if errors > 0:
+    logging.error('found %d invalid group memberships' % (errors))
+    return None
+  return groups
+
+def get_sharding(tf_config):
+  """
+  Reads the state sharding policy from the config. Returns the sharding mode and,
+  for the 'max_resources' mode, the maximum number of resources per state. Examples:
+  state_sharding: folder    # one state per folder (default)
+  state_sharding: file      # one state per group configuration file
+  state_sharding: group     # one state per group
+  state_sharding:
+    max_resources: 5000     # groups of a folder spread over 1, 2, 4... states
+  """
+  sharding = tf_config.get('state_sharding', 'folder')
+  if isinstance(sharding, dict) and list(sharding.keys()) == ['max_resources']:
+    max_resources = sharding['max_resources']
+    if not isinstance(max_resources, int) or max_resources < 1:
+      logging.error('state_sharding.max_resources must be a positive number')
+      sys.exit(1)
+    return 'max_resources', max_resources
+  if not sharding in SHARDING_MODES[:-1]:
+    logging.error('invalid state_sharding in config file: %s' % (str(sharding)))
+    sys.exit(1)
+  return sharding, None
+
+def shard_count(resources, max_resources):
+  """
+  Number of states used for a folder in the 'max_resources' mode. It is a power of
+  two, so that when it grows, each group either stays in its state or moves to a
+  new one.
+  """
+  count = 1
+  while count * max_resources < resources:
+    count *= 2
+  return count
+
+def group_shard(mode, conf_path, conf_file, group_name, unique_id, count=1):
+  """
+  Returns the folder, relative to the terraform output folder, of the terraform
+  root holding a group. Shard folders are created inside the folder of the
+  configuration file, with names that can not be mistaken for group folders.
+  """
+  if mode == 'file':
+    return conf_path + '/_file_' + os.path.splitext(os.path.basename(conf_file))[0]
+  if mode == 'group':
+    return conf_path + '/_group_' + group_name
+  if mode == 'max_resources':
+    # the position of a group only depends on its ID, not on the other groups
+    return conf_path + '/_shard_%d' % (int(hashlib.sha256(unique_id.encode('utf-8')).hexdigest()[:8], 16) % count)
+  return conf_path
+
+def moved_members(tf_out, prev_src, prev_shard, group):
+  """
+  Returns the members of a moved group that were declared in its previous state,
+  found in the terraform files generated for its source by the previous run, or
+  None if these files cannot be read.
+  """
+  prev_outputs = list(prev_src.get('outputs', {}))
+  if prev_src.get('output'):
+    prev_outputs.append(prev_src['output'])
+  prev_outputs = [o for o in prev_outputs if os.path.dirname(o) == prev_shard]
+  if not prev_outputs:
+    return None
+  code = []
+  for output in prev_outputs:
+    try:
+      with open(tf_out + '/' + output, 'r') as f:
+        code.append(f.read())
+    except IOError:
+      return None
+  code = '\n'.join(code)
+  return [member_id for member_id in group['membership']
+          if '"google_cloud_identity_group_membership" "%s"' % (member_label(group['full_name'], member_id)) in code]
+
+def tf_shard_import(group, members):
+  """
+  Generates the terraform blocks that import a group and the given memberships,
+  created by another state, in the state where the group is now declared. Group
+  and membership IDs are looked up from the group key and the member keys.
+  """
+  tf_blocks = []
+  group_id = group['full_name']
+  tf_lookup = tf_dump.TFBlock(block_type='data', labels=['google_cloud_identity_group_lookup', group_id])
+  tf_key_block = tf_dump.TFBlock(block_type='group_key')
+  tf_key_block.add_element('id', '"%s"' % (group['unique_id']))
+  tf_lookup.add_block(tf_key_block)
+  tf_blocks.append(tf_lookup)
+  tf_import = tf_dump.TFBlock(block_type='import')
+  tf_import.add_element('to', 'google_cloud_identity_group.%s' % (group_id))
+  tf_import.add_element('id', 'data.google_cloud_identity_group_lookup.%s.name' % (group_id))
+  tf_blocks.append(tf_import)
+  if len(members) == 0:
+    return tf_blocks
+  tf_members = tf_dump.TFBlock(block_type='data', labels=['google_cloud_identity_group_memberships', group_id])
+  tf_members.add_element('group', 'data.google_cloud_identity_group_lookup.%s.name' % (group_id))
+  tf_blocks.append(tf_members)
+  for member_id in members:
+    tf_import = tf_dump.TFBlock(block_type='import')
+    tf_import.add_element('to', 'google_cloud_identity_group_membership.%s' % (member_label(group_id, member_id)))
+    tf_import.add_element('id', 'one([for m in data.google_cloud_identity_group_memberships.%s.memberships : '
+                          'm.name if m.preferred_member_key[0].id == "%s"])' % (group_id, member_id))
+    tf_blocks.append(tf_import)
+  return tf_blocks
+
+def tf_shard_remove(group, members):
+  """
+  Generates the terraform blocks that remove a group and the given memberships
+  from the state where they were declared before, without destroying them.
+  """
+  addresses = ['google_cloud_identity_group.%s' % (group['full_name'])]
+  addresses.extend(['google_cloud_identity_group_membership.%s' % (member_label(group['full_name'], member_id))
+                    for member_id in members])
+  tf_blocks = []
+  for address in addresses:
+    tf_removed = tf_dump.TFBlock(block_type='removed')
+    tf_removed.add_element('from', address)
+    tf_lifecycle = tf_dump.TFBlock(block_type='lifecycle')
+    tf_lifecycle.add_element('destroy', 'false')
+    tf_removed.add_block(tf_lifecycle)
+    tf_blocks.append(tf_removed)
+  return tf_blocks
+
+def write_moves(tf_out, moves, prev_move_files):
+  """
+  Writes the terraform blocks of the pending group moves: imports in the state where
+  each group is now declared, and removals in the states where it was declared
+  before. Move files of the previous run that are not needed anymore are removed.
+  Returns the list of move files, relative to the output folder.
+  """
+  blocks = {}
+  for unique_id in sorted(moves):
+    move = moves[unique_id]
+    group = {'full_name': move['full_name'], 'unique_id': unique_id}
+    blocks.setdefault(move['to'], []).extend(tf_shard_import(group, move['members']))
+    for shard in move['from']:
+      blocks.setdefault(shard, []).extend(tf_shard_remove(group, move['members']))
+  move_files = []
+  for shard in sorted(blocks):
+    move_file = shard + '/' + SHARD_MOVES_FILE
+    if os.path.isdir(tf_out + '/' + shard):
+      write_file(tf_out + '/' + move_file, '\n\n'.join([b.dump_tf() for b in blocks[shard]]) + '\n')
+      move_files.append(move_file)
+    else:
+      logging.warning('state folder not found, group moves not recorded: %s' % (shard))
+  for move_file in prev_move_files:
+    if not move_file in move_files and os.path.exists(tf_out + '/' + move_file):
+      os.remove(tf_out + '/' + move_file)
+  return move_files
+
+def clear_moves(tf_out, applied):
+  """
+  Drops the pending group moves whose states were all applied. applied holds the
+  folders of these states, relative to the output folder. Returns the number of
+  moves dropped.
+  """
+  manifest_file = tf_out + '/' + MANIFEST_FILE
+  if not os.path.exists(manifest_file):
+    return 0
+  with open(manifest_file, 'r') as f:
+    manifest = json.load(f)
+  moves = manifest.get('moves', {})
+  done = [u for u, move in moves.items() if move['to'] in applied and all([s in applied for s in move['from']])]
+  if not done:
+    return 0
+  for unique_id in done:
+    logging.info('move of group %s to state %s applied' % (unique_id, moves[unique_id]['to']))
+    del moves[unique_id]
+  manifest['move_files'] = write_moves(tf_out, moves, manifest.get('move_files', []))
+  save_manifest(manifest_file, manifest)
+  repo_index.invalidate(tf_out)
+  return len(done)
+
+def model_to_snapshot(groups, parent=None):
+  """
+  Converts the groups returned by load_group_model to the snapshot format read by
+  load_identity_snapshot, which follows the resources of the Cloud Identity API:
+  {"groups": [{"groupKey": {"id": ...}, "displayName": ..., "memberships": [
+    {"preferredMemberKey": {"id": ...}, "roles": [{"name": "MEMBER"}, ...]}]}]}
+  """
+  snapshot = []
+  for unique_id in sorted(groups):
+    group = groups[unique_id]
+    memberships = [{'preferredMemberKey': {'id': member_id}, 'roles': [{'name': r} for r in ROLE_NAMES[roles]]}
+                   for member_id, roles in group['membership'].items()]
+    snapshot.append({'groupKey': {'id': unique_id}, 'displayName': group['full_name'], 'memberships': memberships})
+    if parent:
+      snapshot[-1]['parent'] = parent
+  return {'groups': snapshot}
+
+def load_identity_snapshot(snapshot_file):
+  """
+  Loads a snapshot of the groups that exist in Cloud Identity (see model_to_snapshot
+  for the format). Returns, by group ID, the display name of each group and its
+  membership index, in the format of index_members.
+  """
+  with open(snapshot_file, 'r') as f:
+    snapshot = json.load(f)
+  groups = {}
+  for group in snapshot.get('groups', []):
+    membership = {}
+    for m in group.get('memberships', []):
+      roles = 0
+      for role in m.get('roles', []):
+        roles |= ROLE_BITS.get(role['name'], 0)
+      membership[m['preferredMemberKey']['id'].lower()] = roles
+    groups[group['groupKey']['id'].lower()] = {'display_name': group.get('displayName'), 'membership': membership}
+  return groups
+
+def managed_prefixes(groups):
+  """
+  Returns the prefixes (<tenant>-<bu>-) of the names of the groups returned by
+  load_group_model.
+  """
+  return set([group_prefix(g['path']) + '-' for g in groups.values()])
+
+def load_managed_prefixes(prefixes_file):
+  """
+  Returns the group name prefixes recorded by previous runs in a prefixes file, or
+  an empty list if the file does not exist.
+  """
+  if not prefixes_file or not os.path.exists(prefixes_file):
+    return []
+  with open(prefixes_file, 'r') as f:
+    return json.load(f).get('prefixes', [])
+
+def save_managed_prefixes(prefixes_file, prefixes):
+  """
+  Records the group name prefixes managed by the group folder hierarchy, so that
+  the groups of a tenant or business unit that was deleted are still deleted by
+  the next runs.
+  """
+  write_file(prefixes_file, json.dumps({'prefixes': sorted(prefixes)}, indent=1) + '\n')
+
+def diff_groups(desired, current, domain, known_prefixes=()):
+  """
+  Computes the changes needed to go from the current groups (as returned by
+  load_identity_snapshot) to the desired ones (as returned by load_group_model).
+  Groups of the current snapshot that are not in the managed domain are ignored.
+  Only the groups whose name starts with the prefix of a folder of the desired
+  groups (<tenant>-<bu>-), or with one of known_prefixes, are deleted: the other
+  groups of the domain were not created from the group folder hierarchy.
+  Both sides are indexed by ID, so each group and membership is looked at once,
+  and the memberships of groups that did not change are compared as a whole.
+  Returns a dict of lists of changes.
+  """
+  plan = {'create_groups': [], 'delete_groups': [], 'update_groups': [],
+          'add_members': [], 'remove_members': [], 'change_roles': []}
+  for unique_id, group in desired.items():
+    existing = current.get(unique_id)
+    if existing is None:
+      plan['create_groups'].append(unique_id)
+      plan['add_members'].extend([(unique_id, m, r) for m, r in group['membership'].items()])
+      continue
+    if existing['display_name'] != group['full_name']:
+      plan['update_groups'].append(unique_id)
+    wanted = group['membership']
+    found = existing['membership']
+    if wanted == found:
+      continue
+    for member_id, roles in wanted.items():
+      if not member_id in found:
+        plan['add_members'].append((unique_id, member_id, roles))
+      elif found[member_id] != roles:
+        plan['change_roles'].append((unique_id, member_id, found[member_id], roles))
+    plan['remove_members'].extend([(unique_id, m, r) for m, r in found.items() if not m in wanted])
+  suffix = '@' + domain.lower()
+  prefixes = tuple(managed_prefixes(desired) | set(known_prefixes))
+  for unique_id, existing in current.items():
+    if unique_id.endswith(suffix) and unique_id.startswith(prefixes) and not unique_id in desired:
+      plan['delete_groups'].append(unique_id)
+      plan['remove_members'].extend([(unique_id, m, r) for m, r in existing['membership'].items()])
+  for changes in plan.values():
+    changes.sort()
+  return plan
+
+def print_plan(plan, stream=sys.stdout, detailed=False):
+  """
+  Prints a summary of the changes computed by diff_groups, and optionally every
+  change, with the symbols used by terraform plans.
+  """
+  if detailed:
+    for unique_id in plan['create_groups']:
+      stream.write('+ group %s\n' % (unique_id))
+    for unique_id in plan['update_groups']:
+      stream.write('~ group %s\n' % (unique_id))
+    for unique_id in plan['delete_groups']:
+      stream.write('- group %s\n' % (unique_id))
+    for unique_id, member_id, roles in plan['add_members']:
+      stream.write('+ member %s of %s [%s]\n' % (member_id, unique_id, ', '.join(ROLE_NAMES[roles])))
+    for unique_id, member_id, old_roles, roles in plan['change_roles']:
+      stream.write('~ member %s of %s [%s] -> [%s]\n' % (member_id, unique_id, ', '.join(ROLE_NAMES[old_roles]), ', '.join(ROLE_NAMES[roles])))
+    for unique_id, member_id, roles in plan['remove_members']:
+      stream.write('- member %s of %s\n' % (member_id, unique_id))
+  stream.write('Groups: %d to add, %d to change, %d to destroy.\n' %
+               (len(plan['create_groups']), len(plan['update_groups']), len(plan['delete_groups'])))
+  stream.write('Memberships: %d to add, %d to change, %d to destroy.\n' %
+               (len(plan['add_members']), len(plan['change_roles']), len(plan['remove_members'])))
+
+def cmd_plan(args):
+  """
+  Compares the groups defined in the group folder hierarchy with a snapshot of the
+  groups that exist in Cloud Identity, and prints the changes that applying the
+  generated terraform code would make, without running terraform.
+  """
+  if not os.path.exists(args.resources) or not os.path.isdir(args.resources):
+    logging.error('the provided resource path does not exist or is not a folder: ' + args.resources)
+    return False
+  tf_config = get_config(args.config, ['group_domain'])
+  domain = tf_config['group_domain']
+  executor = None
+  jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+  if jobs > 1:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+  start = time.time()
+  desired = load_group_model(args.resources, domain, executor, args.duplicate_groups)
+  if executor:
+    executor.shutdown()
+  if desired is None:
+    return False
+  instrumentation.add_span('plan.load', time.time() - start)
+  instrumentation.count('groups.loaded', len(desired))
+  logging.debug('%d groups loaded in %.3fs' % (len(desired), time.time() - start))
+  if args.write_snapshot:
+    write_file(args.write_snapshot, json.dumps(model_to_snapshot(desired, tf_config.get('group_parent')), indent=1) + '\n')
+    logging.info('desired groups written to %s' % (args.write_snapshot))
+  if not args.snapshot:
+    return True
+  if not os.path.exists(args.snapshot):
+    logging.error('snapshot file not found: ' + args.snapshot)
+    return False
+  start = time.time()
+  current = load_identity_snapshot(args.snapshot)
+  known_prefixes = load_managed_prefixes(args.managed_prefixes)
+  plan = diff_groups(desired, current, domain, known_prefixes)
+  if args.managed_prefixes:
+    save_managed_prefixes(args.managed_prefixes, managed_prefixes(desired) | set(known_prefixes))
+  instrumentation.add_span('plan.diff', time.time() - start)
+  logging.debug('%d groups compared in %.3fs' % (len(current), time.time() - start))
+  print_plan(plan, detailed=args.detailed)
+  if args.plan_out:
+    write_file(args.plan_out, json.dumps(plan, indent=1, sort_keys=True) + '\n')
   return True
 
+def pool_map(executor, func, *iterables):
+  """
+  Maps a function over the iterables using the process pool if one was created,
+  or serially in the current process otherwise. Results keep the input order.
+  """
+  if executor is None:
+    return map(func, *iterables)
+  return executor.map(func, *iterables, chunksize=16)
+
 def cmd_ci_groups(args):
   """
   Generates the terraform files for Cloud Identity groups based on the group folder hierarchy.
   """
-  def tf_group(group):
-    """
-    Generates the terraform code for a group
-    """
-    tf_block = tf_dump.TFBlock(block_type='resource', labels=['google_cloud_identity_group', group['full_name']])
-    tf_block.add_element('display_name', '"%s"' % (group['full_name']))
-    tf_block.add_element('initial_group_config', '"WITH_INITIAL_OWNER"')
-    tf_block.add_element('parent', '"%s"' % (parent))
-    tf_key_block = tf_dump.TFBlock(block_type='group_key')
-    tf_key_block.add_element('id', '"%s"' % (group['unique_id']))
-    tf_block.add_block(tf_key_block)
-    labels = {
-      '"cloudidentity.googleapis.com/groups.discussion_forum"' : '""'
-    }
-    tf_block.add_element('labels', labels)
-    return tf_block.dump_tf()
-
-  def tf_member(group_id, member_id, roles):
-    """
-    Generates the terraform code for a group member
-    """
-    member_id = member_id.lower()
-    tf_block = tf_dump.TFBlock(block_type='resource', labels=['google_cloud_identity_group_membership', group_id + '_' + member_id.lower().replace('@', '_').replace('.', '_')])
-    tf_block.add_element('group', 'google_cloud_identity_group.%s.id' % (group_id))
-    tf_key_block = tf_dump.TFBlock(block_type='preferred_member_key')
-    tf_key_block.add_element('id', '"%s"' % (member_id))
-    tf_block.add_block(tf_key_block)
-    for role in roles:
-      tf_roles_block = tf_dump.TFBlock(block_type='roles')
-      tf_roles_block.add_element('name', '"%s"' % (role))
-      tf_block.add_block(tf_roles_block)
-    return tf_block.dump_tf()
-
   # check that the resources provided is a folder
   if not os.path.exists(args.resources) or not os.path.isdir(args.resources):
     logging.error('the provided resource path does not exist or is not a folder: ' + args.resources)
     return False
 
-  all_groups = {}
   groups_by_src = {}
 
   # get the list of group configuration files
-  conf_files = glob.glob(args.resources + '/**/*.yaml', recursive=True)
+  conf_files = repo_index.find_files(args.resources, 'yaml')
 
   # read configuration file
   tf_config = get_config(args.config, ['gcs_bucket', 'group_domain', 'group_parent', 'tf_service_account'])
 
-  # the number of folder components to be used in the group prefix
-  prefix_length = 2
   domain = tf_config['group_domain']
   parent = tf_config['group_parent']
   rs_bucket = tf_config['gcs_bucket']
   tf_sa = tf_config['tf_service_account']
+  sharding, max_resources = get_sharding(tf_config)
+
+  # create the template environment, with the compiled templates cache if requested
+  get_jinja_env(args.template_dir, args.template_cache)
 
-  # parse group config files
+  # load the results of the previous run. Sources are tracked by their path relative
+  # to the resources folder, so the manifest does not depend on the working directory.
+  manifest_file = args.tf_out + '/' + MANIFEST_FILE
+  fingerprint = build_fingerprint(args.config, args.template_dir)
+  prev_manifest, reusable = load_manifest(manifest_file, fingerprint)
+  prev_sources = prev_manifest['sources']
+  if not args.incremental:
+    reusable = False
+  # folders for which the common terraform config was generated in a previous run
+  known_dirs = set()
+  if reusable:
+    for src in prev_sources.values():
+      for output in src.get('outputs', {}):
+        known_dirs.add(os.path.dirname(output))
+  # state of each group in the previous run. Manifests from previous versions had
+  # a single output per source, in the folder of its state.
+  prev_shards = {}
+  for src in prev_sources.values():
+    if 'shards' in src:
+      prev_shards.update(src['shards'])
+    elif src.get('output'):
+      prev_shards.update([(unique_id, os.path.dirname(src['output'])) for unique_id in src.get('produced', [])])
+  sources = {}
+  skipped_files = 0
+
+  # files are read, hashed and parsed in parallel if requested. Groups are then merged
+  # serially, in the order of the list of files, so that the result does not depend on
+  # the number of jobs.
+  executor = None
+  jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+  if jobs > 1:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    logging.debug('using %d worker processes' % (jobs))
+  known_hashes = []
   for conf_file in conf_files:
-    f = open(conf_file, "r")
-    resources = yaml.load(f, Loader=yaml.FullLoader)
-    # ignore empty files
-    if not resources:
-      continue
-    for group in resources:
-      if not 'name' in group:
-        logging.error('group definitions must have a name: ' + conf_file)
-        return False
-      g_name = group['name']
-      # the path of the file: remove the root folder and the file name
-      g_path = conf_file[len(args.resources)+1:conf_file.rfind('/')]
-      g_prefix = '-'.join(g_path.lower().split('/')[0:prefix_length])
-      # create the unique ID for the group, which is composed of the prefix, plus the domain.
-      group['full_name'] = g_prefix + '-' + g_name
-      g_unique_id = group['full_name'] + '@' + domain
-      group['unique_id'] = g_unique_id
-      group['path'] = g_path
-      group['conf'] = conf_file
-      # ignore entry if already exists
-      if g_unique_id in all_groups:
-        # TODO: need to kee a record of previously added groups because a new duplicate could appear before the existing one.
-        logging.warn('group ' + g_unique_id + ' was already defined in ' + all_groups[g_unique_id]['conf'] + '. Ignoring entry from ' + conf_file)
+    prev = prev_sources.get(conf_file[len(args.resources)+1:])
+    known_hashes.append(prev['hash'] if reusable and prev else None)
+  logging.debug('using yaml loader: %s' % (YamlLoader.__name__))
+  parse_start = time.time()
+  # the files hashed by a previous run of this process (watch command) are only read
+  # again if their size or modification time changed
+  to_load = [i for i, conf_file in enumerate(conf_files)
+             if not known_hashes[i] or cached_file_hash(conf_file) != known_hashes[i]]
+  load_stats = dict([(i, repo_index.file_stat(conf_files[i])) for i in to_load])
+
+  def load_files():
+    loaded = iter(pool_map(executor, load_group_file, [conf_files[i] for i in to_load],
+                           [known_hashes[i] for i in to_load]))
+    for i, conf_file in enumerate(conf_files):
+      if not i in load_stats:
+        yield known_hashes[i], None
         continue
-      # add the group to the list of groups by unique id
-      all_groups[g_unique_id] = group
-      # add the group to the list of groups by source file
-      if conf_file in groups_by_src:
+      src_hash, resources = next(loaded)
+      record_file_hash(conf_file, load_stats[i], src_hash)
+      yield src_hash, resources
+  loaded_files = load_files()
+
+  def expand_groups(conf_file, resources):
+    return expand_group_file(args.resources, conf_file, resources, domain)
+
+  # parse group config files. All the definitions are collected first, and conflicts
+  # are solved afterwards, so the result does not depend on the order of the files.
+  groups_index = group_index.GroupIndex()
+  parsed = {}
+  try:
+    for conf_file, (src_hash, resources) in zip(conf_files, loaded_files):
+      src_key = conf_file[len(args.resources)+1:]
+      prev = prev_sources.get(src_key)
+      if resources is None and reusable and prev and prev['hash'] == src_hash:
+        # the file did not change, use the list of groups recorded in the manifest
+        groups_index.add_source(src_key, prev['groups'])
+        continue
+      groups = expand_groups(conf_file, resources)
+      parsed[src_key] = groups
+      sources[src_key] = {'hash': src_hash, 'groups': [g['unique_id'] for g in groups],
+                          'produced': [], 'outputs': {}, 'shards': {}, 'resources': 0}
+      groups_index.add_source(src_key, sources[src_key]['groups'])
+
+    # report groups defined more than once
+    conflicts = groups_index.conflict_report()
+    if len(conflicts) > 0:
+      if args.duplicate_groups == 'error':
+        for line in conflicts:
+          logging.error(line)
+        logging.error('found %d groups defined more than once' % (len(conflicts)))
+        if executor:
+          executor.shutdown(cancel_futures=True)
+        return False
+      for line in conflicts:
+        logging.warning(line + '. Using the first one.')
+
+    def index_source(conf_file, src_key, produced):
+      """
+      Builds the membership index of the groups produced by a parsed source file.
+      Returns the number of membership errors found.
+      """
+      errors = 0
+      sources[src_key]['produced'] = produced
+      groups_by_src[conf_file] = []
+      for position, group in enumerate(parsed[src_key]):
+        g_unique_id = group['unique_id']
+        # ignore the entry if the group is defined somewhere else
+        if not groups_index.is_winner(g_unique_id, src_key, position):
+          continue
+        # consolidate the list of members, since each member can have multiple roles
+        group['membership'], m_warnings, m_errors = index_members(group)
+        for msg in m_warnings:
+          logging.warning('group %s (%s): %s' % (g_unique_id, conf_file, msg))
+        for msg in m_errors:
+          logging.error('group %s (%s): %s' % (g_unique_id, conf_file, msg))
+        errors += len(m_errors)
+        # one resource for the group, and one per member
+        sources[src_key]['resources'] += 1 + len(group['membership'])
         groups_by_src[conf_file].append(group)
+      return errors
+
+    def reparse_source(conf_file, src_key):
+      """
+      Parses a source file whose previous results cannot be reused after all.
+      """
+      prev = prev_sources[src_key]
+      src_hash, resources = load_group_file(conf_file)
+      parsed[src_key] = expand_groups(conf_file, resources)
+      sources[src_key] = {'hash': src_hash, 'groups': prev['groups'],
+                          'produced': [], 'outputs': {}, 'shards': {}, 'resources': 0}
+      return index_source(conf_file, src_key, groups_index.produced(src_key))
+
+    membership_errors = 0
+    for conf_file in conf_files:
+      src_key = conf_file[len(args.resources)+1:]
+      produced = groups_index.produced(src_key)
+      if not src_key in parsed:
+        # reuse the previous results as long as the file produces the same groups (a
+        # group could now be defined in another file) and the generated files were not
+        # modified or removed.
+        prev = prev_sources[src_key]
+        out_ok = True
+        for output, output_hash in prev.get('outputs', {}).items():
+          out_file = args.tf_out + '/' + output
+          out_ok = os.path.exists(out_file) and file_hash(out_file) == output_hash
+          if not out_ok:
+            break
+        if produced == prev['produced'] and out_ok:
+          sources[src_key] = prev
+          continue
+        # the previous results cannot be reused, we need to parse the file after all
+        membership_errors += reparse_source(conf_file, src_key)
       else:
-        groups_by_src[conf_file] = [group]
-
-  # create a terraform configuration for each one of the config folders
-  refreshed_configs = {}
-  for conf_file in groups_by_src.keys():
-    groups = groups_by_src[conf_file]
-    # the path of the file: remove the root folder and the file name
-    conf_path = conf_file[len(args.resources)+1:conf_file.rfind('/')]
-    out_dir = args.tf_out + '/' + conf_path
-    if not os.path.exists(out_dir):
-      os.makedirs(out_dir)
-    elif not out_dir in refreshed_configs:
+        membership_errors += index_source(conf_file, src_key, produced)
+
+    # assign each group to a terraform state. In the max_resources mode, the number
+    # of states of a folder depends on all the groups of the folder.
+    counts = {}
+    if sharding == 'max_resources':
+      folder_resources = {}
+      for src_key, src in sources.items():
+        conf_path = os.path.dirname(src_key)
+        folder_resources[conf_path] = folder_resources.get(conf_path, 0) + src['resources']
+      counts = dict([(conf_path, shard_count(res, max_resources)) for conf_path, res in folder_resources.items()])
+    for conf_file in conf_files:
+      src_key = conf_file[len(args.resources)+1:]
+      conf_path = os.path.dirname(src_key)
+      if conf_file in groups_by_src:
+        src = sources[src_key]
+        for group in groups_by_src[conf_file]:
+          src['shards'][group['unique_id']] = group_shard(sharding, conf_path, conf_file, str(group['name']),
+                                                          group['unique_id'], counts.get(conf_path, 1))
+        continue
+      # reused results are only valid if the groups stay in the same states. Group
+      # names are only needed by the 'group' mode, in which the state of a group
+      # can not change without a change of the config.
+      src = sources[src_key]
+      shards = dict([(u, group_shard(sharding, conf_path, conf_file, None, u, counts.get(conf_path, 1)))
+                     for u in src['produced']]) if sharding == 'max_resources' else src['shards']
+      if shards != src['shards']:
+        membership_errors += reparse_source(conf_file, src_key)
+        for group in groups_by_src[conf_file]:
+          sources[src_key]['shards'][group['unique_id']] = shards[group['unique_id']]
+      else:
+        skipped_files += 1
+  except GroupFileError as e:
+    logging.error(str(e))
+    if executor:
+      executor.shutdown(cancel_futures=True)
+    return False
+  if membership_errors > 0:
+    logging.error('found %d invalid group memberships' % (membership_errors))
+    if executor:
+      executor.shutdown(cancel_futures=True)
+    return False
+  parse_time = time.time() - parse_start
+  parsed_files = len(conf_files) - skipped_files
+  instrumentation.add_span('ci_groups.parse', parse_time)
+  instrumentation.count('group_files.parsed', parsed_files)
+  instrumentation.count('group_files.reused', skipped_files)
+  logging.debug('%d group files parsed in %.3fs (%.1f files/s)' % (parsed_files, parse_time, parsed_files / max(parse_time, 1e-6)))
+  logging.info('%d group files unchanged, %d to be generated' % (skipped_files, len(groups_by_src)))
+
+  # split the groups of each file by state. Each file produces one terraform file in
+  # the folder of each state holding its groups.
+  step_start = time.time()
+  render_srcs = []
+  out_files = []
+  render_groups = []
+  for conf_file, groups in groups_by_src.items():
+    src = sources[conf_file[len(args.resources)+1:]]
+    tf_file_name = conf_file[conf_file.rfind('/')+1:conf_file.rfind('.')] + '.tf'
+    by_shard = {}
+    for group in groups:
+      by_shard.setdefault(src['shards'][group['unique_id']], []).append(group)
+    for shard in sorted(by_shard):
+      render_srcs.append(conf_file)
+      out_files.append(shard + '/' + tf_file_name)
+      render_groups.append(by_shard[shard])
+
+  # find the groups moved to another state. They are imported in their new state
+  # and removed from the previous one, instead of being destroyed and created again.
+  # Only the memberships declared in the previous state are imported: the others are
+  # created. They are read from the files of the previous run, before they are removed.
+  # Moves stay pending, and are written again by each run, until clear_moves is told
+  # that their states were applied. A pending move is dropped if its group is deleted
+  # or moved back, and a group moved again is removed from all its previous states.
+  current_shards = {}
+  for src in sources.values():
+    current_shards.update(src.get('shards', {}))
+  prev_moves = prev_manifest.get('moves', {})
+  parsed_groups = dict([(g['unique_id'], g) for groups in groups_by_src.values() for g in groups])
+  moves = {}
+  for unique_id, move in prev_moves.items():
+    if current_shards.get(unique_id) != move['to']:
+      continue
+    if unique_id in parsed_groups:
+      # memberships removed from the group are not moved anymore
+      move = dict(move, members=[m for m in move['members'] if m in parsed_groups[unique_id]['membership']])
+    moves[unique_id] = move
+  move_errors = 0
+  prev_source_of = None
+  for conf_file, groups in groups_by_src.items():
+    src = sources[conf_file[len(args.resources)+1:]]
+    for group in groups:
+      prev_shard = prev_shards.get(group['unique_id'])
+      new_shard = src['shards'][group['unique_id']]
+      if prev_shard and prev_shard != new_shard:
+        if prev_source_of is None:
+          prev_source_of = dict([(u, prev) for prev in prev_sources.values() for u in prev.get('produced', [])])
+        members = moved_members(args.tf_out, prev_source_of.get(group['unique_id'], {}), prev_shard, group)
+        if members is None:
+          logging.error('cannot move group %s from state %s to %s: the terraform files of the previous run were '
+                        'not found' % (group['unique_id'], prev_shard, new_shard))
+          move_errors += 1
+          continue
+        logging.info('moving group %s from state %s to %s' % (group['unique_id'], prev_shard, new_shard))
+        prev_move = prev_moves.get(group['unique_id'], {'from': [], 'members': []})
+        members.extend([m for m in prev_move['members'] if m in group['membership'] and not m in members])
+        moves[group['unique_id']] = {
+          'full_name': group['full_name'],
+          'to': new_shard,
+          'from': sorted(set(prev_move['from'] + [prev_shard]) - set([new_shard])),
+          'members': members,
+        }
+        instrumentation.count('groups.moved')
+  if move_errors > 0:
+    if executor:
+      executor.shutdown(cancel_futures=True)
+    return False
+
+  # remove the files generated for sources that were deleted or do not produce
+  # any group anymore
+  current_outputs = set(out_files)
+  for src_key, src in sources.items():
+    if not args.resources + '/' + src_key in groups_by_src:
+      current_outputs.update(src['outputs'])
+  outputs_by_dir = {}
+  for output in current_outputs:
+    outputs_by_dir.setdefault(os.path.dirname(output), []).append(os.path.basename(output))
+  for src_key, prev in prev_sources.items():
+    prev_outputs = list(prev.get('outputs', {}))
+    if prev.get('output'):
+      prev_outputs.append(prev['output'])
+    for output in prev_outputs:
+      if not output in current_outputs:
+        out_file = args.tf_out + '/' + output
+        if os.path.exists(out_file):
+          logging.info('removing output of deleted group file: \'%s\'' % (out_file))
+          os.remove(out_file)
+
+  instrumentation.add_span('ci_groups.plan_outputs', time.time() - step_start)
+
+  # create a terraform configuration for each one of the states
+  step_start = time.time()
+  for shard in sorted(set([os.path.dirname(o) for o in out_files])):
+    out_dir = args.tf_out + '/' + shard
+    if not shard in known_dirs:
       # generate the terraform config file
       commons_context = {
         'gcs_bucket' : rs_bucket,
-        'gcs_prefix' : 'ci_groups/' + conf_path,
+        'gcs_prefix' : 'ci_groups/' + shard,
         'tf_sa' : tf_sa
       }
-      generate_tf_files(args.template_dir, out_dir, 'common', commons_context, True)
-      refreshed_configs[out_dir] = True
-    # the resulting file name: replace .yaml by .tf
-    tf_file_name = conf_file[conf_file.rfind('/')+1:conf_file.rfind('.')] + '.tf'
-    tf_output = ''
-    for group in groups:
-      tf_output += tf_group(group) + '\n\n'
-      # consolidate the list of members, since each member can have multiple roles
-      all_members = {}
-      # first, create the list with the MEMBER role for each member
-      for mtype in ['members', 'managers', 'owners']:
-        for member in group[mtype]:
-          if not member in all_members:
-            all_members[member] = ['MEMBER']
-      for member in group['owners']:
-        all_members[member].append('OWNER')
-      for member in group['managers']:
-        all_members[member].append('MANAGER')
-      for member in all_members:
-        tf_output += tf_member(group['full_name'], member, all_members[member]) + '\n\n'
-    # write the tf code for this file
-    f = open(out_dir + '/' + tf_file_name, 'w')
-    f.write(tf_output)
-    f.close()
+      generate_tf_files(args.template_dir, out_dir, 'common', commons_context, True,
+                        keep=outputs_by_dir.get(shard, []) + [SHARD_MOVES_FILE])
+    if not os.path.isdir(out_dir):
+      os.makedirs(out_dir)
+  instrumentation.add_span('ci_groups.common_files', time.time() - step_start)
+
+  # write the terraform code of each file (in parallel if requested)
+  step_start = time.time()
+  out_hashes = pool_map(executor, render_group_file, render_groups,
+                        [parent] * len(render_srcs), [args.tf_out + '/' + o for o in out_files],
+                        [args.fast_render] * len(render_srcs))
+  for conf_file, out_file, out_hash in zip(render_srcs, out_files, out_hashes):
+    src = sources[conf_file[len(args.resources)+1:]]
+    src['outputs'][out_file] = out_hash
+  if executor:
+    executor.shutdown()
+  instrumentation.add_span('ci_groups.render', time.time() - step_start)
+  instrumentation.count('tf_files.rendered', len(out_files))
+  instrumentation.count('groups.rendered', sum([len(g) for g in render_groups]))
+  instrumentation.count('resources.rendered', sum([1 + len(g['membership']) for groups in render_groups for g in groups]))
+
+  # write the pending moves
+  step_start = time.time()
+  move_files = write_moves(args.tf_out, moves, prev_manifest.get('move_files', []))
+
+  # record the results of this run for the next incremental build, unless nothing changed
+  manifest = {'version': MANIFEST_VERSION, 'fingerprint': fingerprint, 'sources': sources, 'move_files': move_files,
+              'moves': moves}
+  if not reusable or manifest != prev_manifest:
+    save_manifest(manifest_file, manifest)
+  # the listings of the output folder are out of date
+  repo_index.invalidate(args.tf_out)
+  instrumentation.add_span('ci_groups.manifest', time.time() - step_start)
+  return True
+
+def cmd_moves_applied(args):
+  """
+  Drops the pending group moves whose states were all applied, and removes their
+  import and removed blocks from the terraform files.
+  """
+  if not os.path.exists(args.build_steps):
+    logging.error('build steps file not found: ' + args.build_steps)
+    return False
+  with open(args.build_steps, 'r') as f:
+    applied = [os.path.relpath(line.strip(), args.tf_out) for line in f if line.strip()]
+  logging.info('%d group moves applied' % (clear_moves(args.tf_out, applied)))
+  return True
+
+def global_input_stats(args):
+  """
+  Returns the (size, modification time) of the files that affect all the generated
+  files: the config file and the templates.
+  """
+  stats = {}
+  for input_file in [args.config] + [os.path.join(d, f) for d, _, fs in os.walk(args.template_dir) for f in fs]:
+    try:
+      st = os.stat(input_file)
+      stats[input_file] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+      stats[input_file] = None
+  return stats
+
+def watch_generate(args):
+  """
+  Runs ci-groups, reporting the errors instead of exiting on them.
+  """
+  start = time.time()
+  try:
+    generated = cmd_ci_groups(args)
+  except SystemExit:
+    generated = False
+  if generated:
+    logging.info('terraform files updated in %.0fms' % ((time.time() - start) * 1000))
+  else:
+    logging.error('the terraform files were not updated, fix the errors above and save again')
+  return generated
+
+def cmd_watch(args):
+  """
+  Watches the resources folder, the config file and the templates, and regenerates
+  the terraform files (and the CODEOWNERS file if requested) when they change, until
+  interrupted. The files are checked by polling. The jinja environment, the OWNERS
+  index and the hashes of the group files stay in memory, so that only the group
+  files that changed are read again.
+  """
+  if not os.path.exists(args.resources) or not os.path.isdir(args.resources):
+    logging.error('the provided resource path does not exist or is not a folder: ' + args.resources)
+    return False
+  args.incremental = True
+  index = repo_index.refresh(args.resources)
+  inputs = global_input_stats(args)
+  owners = None
+  if args.codeowners_out:
+    owners = codeowners_gen.OwnersIndex()
+    codeowners_gen.scan_owners(owners, args.resources)
+    codeowners_gen.write_codeowners(args.codeowners_out, codeowners_gen.codeowners_lines(owners))
+  watch_generate(args)
+  logging.info('watching %s for changes, press Ctrl-C to stop' % (args.resources))
+  try:
+    while True:
+      time.sleep(args.interval)
+      previous = index
+      index = repo_index.refresh(args.resources)
+      changed = repo_index.changed_files(previous, index, ['yaml', 'owners'])
+      previous_inputs = inputs
+      inputs = global_input_stats(args)
+      if inputs != previous_inputs:
+        # the config and the templates are read again
+        logging.info('config file or templates changed, regenerating all the terraform files')
+        conf_cache.clear()
+        jinja_envs.clear()
+        template_lists.clear()
+      elif not changed:
+        continue
+      for path in changed:
+        logging.info('changed: %s' % (path))
+      owners_changes = [(path, False) for path in changed if os.path.basename(path) == codeowners_gen.OWNERS_FILE]
+      if owners is not None and owners_changes:
+        codeowners_gen.update_owners(owners, args.resources, owners_changes)
+        codeowners_gen.write_codeowners(args.codeowners_out, codeowners_gen.codeowners_lines(owners))
+      if inputs != previous_inputs or len(owners_changes) < len(changed):
+        watch_generate(args)
+  except KeyboardInterrupt:
+    logging.info('stopped watching %s' % (args.resources))
   return True
 
 if __name__ == '__main__':
@@ -280,4 +1557,8 @@ if __name__ == '__main__':
   logging.getLogger().setLevel(getattr(logging, args.log_level))
   FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
   logging.basicConfig(format=FORMAT)
-  args.func(args)
+  if args.resources:
+    repo_index.use_snapshot(args.resources, args.fs_snapshot)
+  # the build steps using the generated files must not run if the generation failed
+  if not instrumentation.run(args, args.func, args):
+    sys.exit(1)
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+
+"""Run the whole apply pipeline in one process: generate the terraform files from
+the group folder, find the changed files with git, compute the build waves, and
+run terraform on the packages of each wave concurrently. The output of terraform
+is streamed line by line, prefixed by its package, and the time taken by each
+phase is reported at the end.
+Must be run from the root of the git repository.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import time
+import shlex
+import asyncio
+import logging
+import argparse
+import tf_generator
+import tf_dep_finder
+import changelog_parser
+import tf_apply_waves
+import instrumentation
+
+async def run_command(command, tf_conf, log, stream):
+  """
+  Run a command in a terraform configuration folder. Its output is appended to the
+  package log, and written to the stream as it comes if one is provided. Returns
+  (success, output).
+  """
+  log.append('$ %s' % (' '.join(command)))
+  try:
+    proc = await asyncio.create_subprocess_exec(*command, cwd=tf_conf, stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT)
+  except OSError as e:
+    log.append('could not run %s: %s' % (command[0], e))
+    return False, ''
+  lines = []
+  while True:
+    line = await proc.stdout.readline()
+    if not line:
+      break
+    line = line.decode('utf-8', 'replace')
+    lines.append(line)
+    if stream:
+      stream.write('[%s] %s' % (tf_conf, line if line.endswith('\n') else line + '\n'))
+      stream.flush()
+  await proc.wait()
+  out = ''.join(lines)
+  log.append(out)
+  return proc.returncode == 0, out
+
+async def run_package(terraform, action, tf_conf, stream):
+  """
+  Same steps as tf_apply_waves.run_package: init, fmt, and then plan or apply.
+  Returns (success, package log).
+  """
+  log = []
+  ok, out = await run_command(terraform + ['init', '-no-color'], tf_conf, log, stream)
+  if not ok or not tf_apply_waves.INIT_SUCCESS in out:
+    log.append('terraform init did not succeed.')
+    return False, log
+  ok, out = await run_command(terraform + ['fmt'], tf_conf, log, stream)
+  if not ok:
+    return False, log
+  if action == 'apply':
+    ok, out = await run_command(terraform + ['apply', '-auto-approve', '-no-color'], tf_conf, log, stream)
+  else:
+    ok, out = await run_command(terraform + ['plan', '-no-color'], tf_conf, log, stream)
+  return ok, log
+
+async def run_waves(waves, terraform, action, jobs, output_log, stream, succeeded=None):
+  """
+  Run the waves in order, with at most jobs packages at the same time. After a
+  failure, no new package is started. Returns the list of failed packages. The
+  packages that succeeded are added to succeeded, if provided.
+  """
+  failed = []
+  slots = asyncio.Semaphore(jobs)
+
+  async def run_one(tf_conf):
+    async with slots:
+      if failed:
+        return
+      ok, log = await run_package(terraform, action, tf_conf, stream)
+      tf_apply_waves.write_package_log(output_log, tf_conf, log)
+      if ok:
+        logging.info('%s: %s succeeded' % (tf_conf, action))
+        if succeeded is not None:
+          succeeded.append(tf_conf)
+      else:
+        logging.error('%s: %s failed' % (tf_conf, action))
+        failed.append(tf_conf)
+
+  for number, wave in enumerate(waves):
+    logging.info('wave %d/%d: %d package(s)' % (number + 1, len(waves), len(wave)))
+    await asyncio.gather(*[run_one(tf_conf) for tf_conf in wave])
+    if failed:
+      logging.error('stopping after wave %d' % (number + 1))
+      break
+  return failed
+
+async def git_changes(tf_root):
+  """
+  Returns the paths changed under tf_root, from 'git status --porcelain -z'.
+  """
+  proc = await asyncio.create_subprocess_exec('git', 'status', '--porcelain', '-z', '--', tf_root,
+                                              stdout=asyncio.subprocess.PIPE)
+  out, _ = await proc.communicate()
+  if proc.returncode != 0:
+    return None
+  return changelog_parser.parse_changelog(out.decode('utf-8', 'surrogateescape'), 'status-z')
+
+async def run_pipeline(args, timings):
+  start = time.perf_counter()
+  if not args.skip_generate:
+    gen_args = tf_generator.parse_args(['--resources', args.resources, '--config', args.config,
+                                        '--template-dir', args.template_dir, '--tf-out', args.tf_out,
+                                        '--incremental', '--jobs', str(args.generator_jobs), 'ci-groups'])
+    try:
+      generated = gen_args.func(gen_args)
+    except SystemExit:
+      generated = False
+    timings.append(('generate', time.perf_counter() - start))
+    if not generated:
+      logging.error('terraform file generation failed')
+      return False
+
+  start = time.perf_counter()
+  changes = await git_changes(args.tf_out)
+  timings.append(('changes', time.perf_counter() - start))
+  if changes is None:
+    logging.error('could not get the list of changes from git')
+    return False
+  logging.info('%d changed path(s)' % (len(changes)))
+
+  start = time.perf_counter()
+  try:
+    waves = tf_dep_finder.plan_build_steps(changes, os.path.normpath(args.tf_out), args.cache, True,
+                                           args.snapshot)
+  except tf_dep_finder.DependencyCycleError as e:
+    logging.error(str(e))
+    return False
+  timings.append(('order', time.perf_counter() - start))
+
+  start = time.perf_counter()
+  if args.output_log:
+    output_log = open(args.output_log, 'w')
+  else:
+    output_log = sys.stdout
+  output_log.write('Running terraform %s on modified terraform configurations\n' % (args.action))
+  output_log.write('Build steps:\n')
+  for wave in waves:
+    for tf_conf in wave:
+      output_log.write(tf_conf + '\n')
+  stream = sys.stdout if args.output_log and not args.quiet else None
+  jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+  succeeded = []
+  failed = await run_waves(waves, shlex.split(args.terraform), args.action, jobs, output_log, stream, succeeded)
+  if output_log != sys.stdout:
+    output_log.close()
+  timings.append(('terraform', time.perf_counter() - start))
+  if args.action == 'apply':
+    # the group moves are kept by the generator until their states are applied
+    tf_generator.clear_moves(args.tf_out, [os.path.relpath(tf_conf, args.tf_out) for tf_conf in succeeded])
+  if failed:
+    logging.error('failed packages: %s' % (', '.join(failed)))
+    return False
+  return True
+
+def main(args):
+  timings = []
+  ok = asyncio.run(run_pipeline(args, timings))
+  for phase, elapsed in timings:
+    instrumentation.add_span('pipeline.' + phase, elapsed)
+    logging.info('%-10s %.3fs' % (phase, elapsed))
+  logging.info('%-10s %.3fs' % ('total', sum([t for p, t in timings])))
+  if not ok:
+    sys.exit(1)
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--resources', required=True,
+                      help='folder containing the group configuration files')
+  parser.add_argument('--config', required=True,
+                      help='yaml file containing the common configuration settings')
+  parser.add_argument('--template-dir', required=True,
+                      help='location of tf template files')
+  parser.add_argument('--tf-out', required=False, default='terraform',
+                      help='directory where the generated Terraform files are written')
+  parser.add_argument('--skip-generate', action='store_true',
+                      help='use the terraform files as they are, without running the generator')
+  parser.add_argument('--generator-jobs', type=int, default=1,
+                      help='number of worker processes used by the generator (0: one per CPU)')
+  parser.add_argument('--cache', required=False,
+                      help='file where the parsing results of the terraform files are cached between runs')
+  parser.add_argument('--snapshot', required=False,
+                      help='file where the dependency graph is kept between runs, used to destroy deleted packages')
+  parser.add_argument('--action', required=False, choices=['plan', 'apply'], default='apply',
+                      help='terraform command to run on each package')
+  parser.add_argument('--jobs', required=False, type=int, default=4,
+                      help='number of packages processed at the same time (0 for one per CPU)')
+  parser.add_argument('--terraform', required=False, default='terraform',
+                      help='terraform command to use (can include arguments, e.g. to run a fake terraform script)')
+  parser.add_argument('--output-log', required=False,
+                      help='write the terraform outputs to this file, one package at a time, '
+                           'and stream them to std output as they come')
+  parser.add_argument('--quiet', action='store_true',
+                      help='do not stream the terraform outputs when --output-log is used')
+  instrumentation.add_arguments(parser)
+  parser.add_argument('--log-level', required=False,
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                      default='INFO',
+                      help='set log level')
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  logging.getLogger().setLevel(getattr(logging, args.log_level))
+  FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+  logging.basicConfig(format=FORMAT)
+  instrumentation.run(args, main, args)
@@ -4,7 +4,7 @@
  * agreement with Google.  
  */
 locals {
-  terraform_builder = "hashicorp/terraform:1.0.1"
+  terraform_builder = "hashicorp/terraform:1.7.5"
   factory_config    = "config/config.yaml"
   requests_root     = "group_root"
 }
@@ -96,6 +96,7 @@ resource "google_cloudbuild_trigger" "tf_apply_trigger" {
         "--config=$${_FACTORY_CONFIG}",
         "--template-dir=/templates",
         "--tf-out=terraform",
+        "--incremental",
         "ci-groups",
       ]
       volumes {
@@ -113,7 +114,8 @@ resource "google_cloudbuild_trigger" "tf_apply_trigger" {
         <<-EOT
         set -x
         cd /git_tmp/tmp-requests
-        git status --porcelain | tee git_diff.txt
+        git status --porcelain
+        git status --porcelain -z > git_diff.txt
         EOT
       ]
       volumes {
@@ -130,6 +132,8 @@ resource "google_cloudbuild_trigger" "tf_apply_trigger" {
         "/tf_dep_finder.py",
         "--tf-root=terraform",
         "--changelog=git_diff.txt",
+        "--changelog-format=status-z",
+        "--snapshot=terraform/.tf_deps_snapshot.json",
         "--output=tf_build_steps.txt",
       ]
       volumes {
@@ -174,6 +178,22 @@ resource "google_cloudbuild_trigger" "tf_apply_trigger" {
       }
     }
 
+    # all the configurations were applied: the group moves they held are not needed anymore
+    step {
+      name = "gcr.io/$PROJECT_ID/prj-factory"
+      dir  = "/git_tmp/tmp-requests"
+      args = [
+        "/tf_generator.py",
+        "--tf-out=terraform",
+        "moves-applied",
+        "--build-steps=tf_build_steps.txt",
+      ]
+      volumes {
+        name = "git_tmp"
+        path = "/git_tmp"
+      }
+    }
+
     # push the changes to the current branch in the repo.
     step {
       name       = "gcr.io/google.com/cloudsdktool/cloud-sdk:slim"
@@ -0,0 +1,16 @@
+terraform {
+  backend "gcs" {
+    bucket = "golden-bucket"
+    prefix = "ci_groups/tnt1/bu1"
+  }
+
+  required_providers {
+    google = {
+      version = "~> 3.76"
+    }
+  }
+}
+
+provider "google" {
+  impersonate_service_account = var.terraform_service_account
+}
\ No newline at end of file
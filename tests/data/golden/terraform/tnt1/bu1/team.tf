@@ -0,0 +1,93 @@
+resource "google_cloud_identity_group" "tnt1-bu1-admins" {
+  display_name         = "tnt1-bu1-admins"
+  group_key {
+   id = "tnt1-bu1-admins@example.com"
+ }
+  initial_group_config = "WITH_INITIAL_OWNER"
+  labels               = {
+   "cloudidentity.googleapis.com/groups.discussion_forum" = ""
+ }
+  parent               = "customers/C0golden"
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu1-admins_carol_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu1-admins.id
+  preferred_member_key {
+   id = "carol@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu1-admins_dave_partner_org" {
+  group                = google_cloud_identity_group.tnt1-bu1-admins.id
+  preferred_member_key {
+   id = "dave@partner.org"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu1-admins_bob_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu1-admins.id
+  preferred_member_key {
+   id = "bob@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "MANAGER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu1-admins_alice_smith_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu1-admins.id
+  preferred_member_key {
+   id = "alice.smith@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "OWNER"
+ }
+roles {
+   name = "MANAGER"
+ }
+}
+
+resource "google_cloud_identity_group" "tnt1-bu1-readers" {
+  display_name         = "tnt1-bu1-readers"
+  group_key {
+   id = "tnt1-bu1-readers@example.com"
+ }
+  initial_group_config = "WITH_INITIAL_OWNER"
+  labels               = {
+   "cloudidentity.googleapis.com/groups.discussion_forum" = ""
+ }
+  parent               = "customers/C0golden"
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu1-readers_carol_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu1-readers.id
+  preferred_member_key {
+   id = "carol@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu1-readers_erin_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu1-readers.id
+  preferred_member_key {
+   id = "erin@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
@@ -0,0 +1,80 @@
+resource "google_cloud_identity_group" "tnt1-bu2-app1-devs" {
+  display_name         = "tnt1-bu2-app1-devs"
+  group_key {
+   id = "tnt1-bu2-app1-devs@example.com"
+ }
+  initial_group_config = "WITH_INITIAL_OWNER"
+  labels               = {
+   "cloudidentity.googleapis.com/groups.discussion_forum" = ""
+ }
+  parent               = "customers/C0golden"
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu2-app1-devs_grace_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu2-app1-devs.id
+  preferred_member_key {
+   id = "grace@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu2-app1-devs_heidi_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu2-app1-devs.id
+  preferred_member_key {
+   id = "heidi@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu2-app1-devs_frank_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu2-app1-devs.id
+  preferred_member_key {
+   id = "frank@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "OWNER"
+ }
+}
+
+resource "google_cloud_identity_group" "tnt1-bu2-app1-ops" {
+  display_name         = "tnt1-bu2-app1-ops"
+  group_key {
+   id = "tnt1-bu2-app1-ops@example.com"
+ }
+  initial_group_config = "WITH_INITIAL_OWNER"
+  labels               = {
+   "cloudidentity.googleapis.com/groups.discussion_forum" = ""
+ }
+  parent               = "customers/C0golden"
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu2-app1-ops_judy_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu2-app1-ops.id
+  preferred_member_key {
+   id = "judy@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt1-bu2-app1-ops_ivan_example_com" {
+  group                = google_cloud_identity_group.tnt1-bu2-app1-ops.id
+  preferred_member_key {
+   id = "ivan@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "MANAGER"
+ }
+}
+
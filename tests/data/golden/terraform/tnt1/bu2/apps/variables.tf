@@ -0,0 +1,4 @@
+variable "terraform_service_account" {
+  description = "Service account email of the account to impersonate to run Terraform."
+  type        = string
+}
\ No newline at end of file
@@ -0,0 +1,61 @@
+resource "google_cloud_identity_group" "tnt2-bu1-platform" {
+  display_name         = "tnt2-bu1-platform"
+  group_key {
+   id = "tnt2-bu1-platform@example.com"
+ }
+  initial_group_config = "WITH_INITIAL_OWNER"
+  labels               = {
+   "cloudidentity.googleapis.com/groups.discussion_forum" = ""
+ }
+  parent               = "customers/C0golden"
+}
+
+resource "google_cloud_identity_group_membership" "tnt2-bu1-platform_peggy_example_com" {
+  group                = google_cloud_identity_group.tnt2-bu1-platform.id
+  preferred_member_key {
+   id = "peggy@example.com"
+ }
+  roles {
+   name = "MEMBER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt2-bu1-platform_olivia_example_com" {
+  group                = google_cloud_identity_group.tnt2-bu1-platform.id
+  preferred_member_key {
+   id = "olivia@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "MANAGER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt2-bu1-platform_mallory_example_com" {
+  group                = google_cloud_identity_group.tnt2-bu1-platform.id
+  preferred_member_key {
+   id = "mallory@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "OWNER"
+ }
+}
+
+resource "google_cloud_identity_group_membership" "tnt2-bu1-platform_niaj_example_com" {
+  group                = google_cloud_identity_group.tnt2-bu1-platform.id
+  preferred_member_key {
+   id = "niaj@example.com"
+ }
+roles {
+   name = "MEMBER"
+ }
+roles {
+   name = "OWNER"
+ }
+}
+
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+"""Stand-in for the terraform binary, for running tf_apply_waves.py and
+tf_pipeline.py locally and in the tests. init prints the message the pipelines
+look for, plan and apply print a few lines after a delay. Environment variables:
+- FAKE_TERRAFORM_DELAY: seconds taken by plan and apply (default 0.1)
+- FAKE_TERRAFORM_FAIL: plan and apply fail in folders whose path contains this string
+- FAKE_TERRAFORM_LOG: file where the start and the end of each plan and apply are
+  recorded, as '<start|end> <command> <folder>' lines
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import time
+
+def record(event, command):
+  log_file = os.environ.get('FAKE_TERRAFORM_LOG')
+  if log_file:
+    with open(log_file, 'a') as f:
+      f.write('%s %s %s\n' % (event, command, os.getcwd()))
+
+def main(argv):
+  command = argv[0] if argv else ''
+  if command == 'init':
+    print('Initializing the backend...')
+    print('Terraform has been successfully initialized!')
+  elif command in ('plan', 'apply'):
+    tf_files = sorted([f for f in os.listdir('.') if f.endswith('.tf')])
+    print('Refreshing state of %d file(s)...' % (len(tf_files)))
+    sys.stdout.flush()
+    record('start', command)
+    time.sleep(float(os.environ.get('FAKE_TERRAFORM_DELAY', '0.1')))
+    record('end', command)
+    fail = os.environ.get('FAKE_TERRAFORM_FAIL')
+    if fail and fail in os.getcwd():
+      print('Error: fake failure in %s' % (os.getcwd()))
+      return 1
+    print('%s complete! Resources: 0 added, 0 changed, 0 destroyed.' % (command.capitalize()))
+  elif command != 'fmt':
+    print('unsupported command: %s' % (command))
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""Tests of the wave runner of tf_apply_waves, with the stub terraform of
+tests/fake_terraform.py.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import io
+import os
+import sys
+import stat
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_apply_waves
+
+FAKE_TERRAFORM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_terraform.py')
+
+class ApplyWavesTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.calls_log = os.path.join(self.work_dir, 'calls.log')
+    # tf_apply_waves runs a single binary, wrap the stub in a script
+    self.terraform = os.path.join(self.work_dir, 'terraform')
+    with open(self.terraform, 'w') as f:
+      f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, FAKE_TERRAFORM))
+    os.chmod(self.terraform, os.stat(self.terraform).st_mode | stat.S_IXUSR)
+    self.environ = dict(os.environ)
+    os.environ['FAKE_TERRAFORM_DELAY'] = '0.05'
+    os.environ['FAKE_TERRAFORM_LOG'] = self.calls_log
+    os.environ.pop('FAKE_TERRAFORM_FAIL', None)
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def packages(self, *names):
+    paths = []
+    for name in names:
+      path = os.path.join(self.work_dir, 'tf', name)
+      os.makedirs(path)
+      with open(os.path.join(path, 'main.tf'), 'w') as f:
+        f.write('')
+      paths.append(path)
+    return paths
+
+  def calls(self):
+    """
+    Returns the (event, command, package) recorded by the stub, in order.
+    """
+    if not os.path.exists(self.calls_log):
+      return []
+    with open(self.calls_log, 'r') as f:
+      return [tuple(line.split(' ', 2)) for line in f.read().splitlines()]
+
+  def test_waves_run_in_order(self):
+    a, b, c, d = self.packages('a', 'b', 'c', 'd')
+    output_log = io.StringIO()
+    failed = tf_apply_waves.run_waves([[a, b], [c], [d]], self.terraform, 'apply', 2, output_log)
+    self.assertEqual(failed, [])
+    calls = self.calls()
+    self.assertEqual(sorted([p for e, cmd, p in calls if e == 'end']), [a, b, c, d])
+    self.assertTrue(all([cmd == 'apply' for e, cmd, p in calls]))
+    # a package starts only once all the packages of the previous waves ended
+    position = dict([((e, p), i) for i, (e, cmd, p) in enumerate(calls)])
+    self.assertGreater(position[('start', c)], max(position[('end', a)], position[('end', b)]))
+    self.assertGreater(position[('start', d)], position[('end', c)])
+    # the packages of a wave run at the same time
+    self.assertLess(max(position[('start', a)], position[('start', b)]),
+                    min(position[('end', a)], position[('end', b)]))
+    for package in [a, b, c, d]:
+      self.assertIn('* Processing terrform configuration %s\n' % (package), output_log.getvalue())
+
+  def test_plan_action(self):
+    a, = self.packages('a')
+    self.assertEqual(tf_apply_waves.run_waves([[a]], self.terraform, 'plan', 1, io.StringIO()), [])
+    self.assertEqual(self.calls(), [('start', 'plan', a), ('end', 'plan', a)])
+
+  def test_failed_package_stops_next_waves(self):
+    a, bad, c = self.packages('a', 'bad', 'c')
+    os.environ['FAKE_TERRAFORM_FAIL'] = 'bad'
+    output_log = io.StringIO()
+    failed = tf_apply_waves.run_waves([[a, bad], [c]], self.terraform, 'apply', 2, output_log)
+    self.assertEqual(failed, [bad])
+    # the package running with the failed one finishes, the next wave is not run
+    self.assertEqual(sorted([p for e, cmd, p in self.calls() if e == 'end']), [a, bad])
+    self.assertIn('Error: fake failure in %s' % (bad), output_log.getvalue())
+
+  def test_failed_package_stops_its_wave(self):
+    bad, b, c = self.packages('bad', 'b', 'c')
+    os.environ['FAKE_TERRAFORM_FAIL'] = 'bad'
+    failed = tf_apply_waves.run_waves([[bad, b, c]], self.terraform, 'apply', 1, io.StringIO())
+    self.assertEqual(failed, [bad])
+    # the worker may pick the next package before the failure is seen, but the
+    # packages still waiting after it are not started
+    started = [p for e, cmd, p in self.calls() if e == 'start']
+    self.assertEqual(started[0], bad)
+    self.assertNotIn(c, started)
+
+  def test_main_jobs_per_cpu(self):
+    a, b = self.packages('a', 'b')
+    waves_file = os.path.join(self.work_dir, 'waves.json')
+    with open(waves_file, 'w') as f:
+      json.dump([[a], [b]], f)
+    output_log = os.path.join(self.work_dir, 'output.log')
+    tf_apply_waves.main(tf_apply_waves.parse_args(['--waves', waves_file, '--jobs', '0', '--terraform', self.terraform,
+                                                   '--output-log', output_log]))
+    self.assertEqual([p for e, cmd, p in self.calls() if e == 'end'], [a, b])
+    os.environ['FAKE_TERRAFORM_FAIL'] = 'tf/a'
+    with self.assertRaises(SystemExit) as raised:
+      tf_apply_waves.main(tf_apply_waves.parse_args(['--waves', waves_file, '--terraform', self.terraform,
+                                                     '--output-log', output_log]))
+    self.assertEqual(raised.exception.code, 1)
+
+if __name__ == '__main__':
+  unittest.main()
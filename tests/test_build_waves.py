@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+"""Tests of the build order of tf_dep_finder: the packages to build, their waves,
+and the detection of dependency cycles.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_dep_finder
+
+# each package maps to the packages depending on it
+DIAMOND = {
+  'foundation': ['tenant-b', 'tenant-a'],
+  'tenant-a': ['program'],
+  'tenant-b': ['program'],
+  'program': ['project'],
+}
+
+class BuildWavesTest(unittest.TestCase):
+
+  def test_diamond(self):
+    packages = tf_dep_finder.get_build_chain(DIAMOND, ['foundation'])
+    self.assertEqual(tf_dep_finder.build_waves(DIAMOND, packages),
+                     [['foundation'], ['tenant-a', 'tenant-b'], ['program'], ['project']])
+
+  def test_only_changed_packages(self):
+    packages = tf_dep_finder.get_build_chain(DIAMOND, ['tenant-b'])
+    self.assertEqual(sorted(packages), ['program', 'project', 'tenant-b'])
+    self.assertEqual(tf_dep_finder.build_waves(DIAMOND, packages), [['tenant-b'], ['program'], ['project']])
+    # the order does not depend on the order in which the packages are given
+    self.assertEqual(tf_dep_finder.build_waves(DIAMOND, ['project', 'tenant-a', 'tenant-b', 'foundation']),
+                     [['foundation', 'project'], ['tenant-a', 'tenant-b']])
+
+  def test_cycle(self):
+    # packages before and after the cycle are not part of it
+    deps = {'root': ['a'], 'a': ['b'], 'b': ['c'], 'c': ['a', 'c-dependent']}
+    with self.assertRaises(tf_dep_finder.DependencyCycleError) as raised:
+      tf_dep_finder.build_waves(deps, tf_dep_finder.get_build_chain(deps, ['root']))
+    self.assertEqual(raised.exception.cycle, ['b', 'c', 'a', 'b'])
+    self.assertEqual(str(raised.exception), 'dependency cycle between packages: b -> c -> a -> b')
+
+  def test_self_dependency(self):
+    with self.assertRaises(tf_dep_finder.DependencyCycleError) as raised:
+      tf_dep_finder.build_waves({'a': ['a']}, ['a'])
+    self.assertEqual(str(raised.exception), 'dependency cycle between packages: a -> a')
+
+  def test_deep_chain(self):
+    # longer than the recursion limit: the packages must not be walked recursively
+    depth = sys.getrecursionlimit() * 5
+    names = ['pkg%06d' % (i) for i in range(depth)]
+    deps = dict([(names[i], [names[i + 1]]) for i in range(depth - 1)])
+    packages = tf_dep_finder.get_build_chain(deps, [names[0]])
+    self.assertEqual(len(packages), depth)
+    waves = tf_dep_finder.build_waves(deps, packages)
+    self.assertEqual(waves, [[name] for name in names])
+    deps[names[-1]] = [names[0]]
+    with self.assertRaises(tf_dep_finder.DependencyCycleError) as raised:
+      tf_dep_finder.build_waves(deps, packages)
+    self.assertEqual(len(raised.exception.cycle), depth + 1)
+
+if __name__ == '__main__':
+  unittest.main()
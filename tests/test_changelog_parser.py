@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+"""Tests of the parsing of the lists of changed files, in each of the formats
+written by git.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import changelog_parser
+
+# (format, git output, expected changed paths)
+CHANGELOGS = [
+  ('porcelain', ' M tf/a/main.tf\n', [('tf/a/main.tf', False)]),
+  ('porcelain', 'D  tf/a/old.tf\n?? tf/d/\n', [('tf/a/old.tf', False), ('tf/d', True)]),
+  ('porcelain', 'R  tf/a/del.tf -> tf/b/new.tf\n', [('tf/a/del.tf', False), ('tf/b/new.tf', False)]),
+  ('porcelain', 'C  tf/a/main.tf -> tf/b/main.tf\n', [('tf/a/main.tf', False), ('tf/b/main.tf', False)]),
+  # paths with spaces or special characters are quoted, with C-style escapes
+  ('porcelain', ' M "tf/b c/x y.tf"\n', [('tf/b c/x y.tf', False)]),
+  ('porcelain', 'R  tf/a/del.tf -> "tf/b c/new name.tf"\n', [('tf/a/del.tf', False), ('tf/b c/new name.tf', False)]),
+  ('porcelain', 'A  "tf/a/new\\nline.tf"\n', [('tf/a/new\nline.tf', False)]),
+  ('porcelain', 'A  "tf/\\303\\251/f.tf"\n', [('tf/é/f.tf', False)]),
+  ('porcelain', 'A  "tf/a/\\"quoted\\".tf"\n', [('tf/a/"quoted".tf', False)]),
+  ('porcelain', '\n', []),
+  # paths are not quoted, renames and copies are followed by the original path
+  ('status-z', ' M tf/a/main.tf\0', [('tf/a/main.tf', False)]),
+  ('status-z', ' M tf/b c/x y.tf\0?? tf/d/\0', [('tf/b c/x y.tf', False), ('tf/d', True)]),
+  ('status-z', 'A  tf/a/new\nline.tf\0', [('tf/a/new\nline.tf', False)]),
+  ('status-z', 'R  tf/b c/new name.tf\0tf/a/del.tf\0 M tf/a/main.tf\0',
+   [('tf/b c/new name.tf', False), ('tf/a/del.tf', False), ('tf/a/main.tf', False)]),
+  ('status-z', 'C  tf/b/main.tf\0tf/a/main.tf\0', [('tf/b/main.tf', False), ('tf/a/main.tf', False)]),
+  # a rename pair must not be read as two entries, even if the original path looks like one
+  ('status-z', 'R  tf/b/new.tf\0M  tf/a.tf\0', [('tf/b/new.tf', False), ('M  tf/a.tf', False)]),
+  ('status-z', '', []),
+  # statuses and paths are separate fields, renames and copies have two paths
+  ('diff-z', 'M\0tf/a/main.tf\0', [('tf/a/main.tf', False)]),
+  ('diff-z', 'D\0tf/a/old.tf\0A\0tf/a/new\nline.tf\0', [('tf/a/old.tf', False), ('tf/a/new\nline.tf', False)]),
+  ('diff-z', 'R100\0tf/a/del.tf\0tf/b c/new name.tf\0M\0tf/b c/x y.tf\0',
+   [('tf/a/del.tf', False), ('tf/b c/new name.tf', False), ('tf/b c/x y.tf', False)]),
+  ('diff-z', 'C075\0tf/a/main.tf\0tf/b/main.tf\0', [('tf/a/main.tf', False), ('tf/b/main.tf', False)]),
+  ('diff-z', 'R100\0M\0A\0', [('M', False), ('A', False)]),
+  ('diff-z', '', []),
+]
+
+class ChangelogParserTest(unittest.TestCase):
+
+  def test_changelogs(self):
+    for changelog_format, content, expected in CHANGELOGS:
+      self.assertEqual(changelog_parser.parse_changelog(content, changelog_format), expected,
+                       '%s: %r' % (changelog_format, content))
+
+  def test_unknown_format(self):
+    with self.assertRaises(ValueError):
+      changelog_parser.parse_changelog('', 'json')
+
+  def test_read_changelog(self):
+    work_dir = tempfile.mkdtemp()
+    try:
+      changelog = os.path.join(work_dir, 'changelog.txt')
+      # paths that are not valid utf-8 are read as they are
+      with open(changelog, 'wb') as f:
+        f.write(b' M tf/a/main.tf\0?? tf/\xff.tf\0')
+      self.assertEqual(changelog_parser.read_changelog(changelog, 'status-z'),
+                       [('tf/a/main.tf', False), ('tf/\udcff.tf', False)])
+    finally:
+      shutil.rmtree(work_dir)
+
+class GitChangelogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.repo = tempfile.mkdtemp()
+    self.git(['init', '-q'])
+    for path in ['tf/a/main.tf', 'tf/a/old.tf', 'tf/b c/x y.tf']:
+      self.write_file(path, path + '\n')
+    self.git(['add', '.'])
+    self.git(['-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'init'])
+    self.git(['mv', 'tf/a/old.tf', 'tf/b c/new name.tf'])
+    self.write_file('tf/a/main.tf', 'changed\n')
+    self.write_file('tf/b c/x y.tf', 'changed\n')
+    self.write_file('tf/a/new\nline.tf', 'new\n')
+    self.git(['add', '.'])
+
+  def tearDown(self):
+    shutil.rmtree(self.repo)
+
+  def write_file(self, path, content):
+    path = os.path.join(self.repo, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def git(self, command):
+    proc = subprocess.run(['git'] + command, cwd=self.repo, check=True, stdout=subprocess.PIPE)
+    return proc.stdout.decode('utf-8', 'surrogateescape')
+
+  def test_same_paths_in_all_formats(self):
+    expected = sorted([('tf/a/main.tf', False), ('tf/a/new\nline.tf', False), ('tf/a/old.tf', False),
+                       ('tf/b c/new name.tf', False), ('tf/b c/x y.tf', False)])
+    for changelog_format, command in [('porcelain', ['status', '--porcelain']),
+                                      ('status-z', ['status', '--porcelain', '-z']),
+                                      ('diff-z', ['diff', '--name-status', '-z', 'HEAD'])]:
+      self.assertEqual(sorted(changelog_parser.parse_changelog(self.git(command), changelog_format)), expected,
+                       changelog_format)
+
+if __name__ == '__main__':
+  unittest.main()
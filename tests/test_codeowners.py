@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+"""Tests of the owners of each folder found by codeowners_gen, and of the lines of
+the CODEOWNERS file.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import codeowners_gen
+import repo_index
+
+OWNERS_FILES = {
+  'OWNERS': '@org/admins\n',
+  'tnt1/OWNERS': '# tenant owners\n@tnt1-owner  @tnt1-lead\n\n@tnt1-owner # listed twice\n',
+  'tnt1/bu1/OWNERS': '@bu1-owner\n',
+  'tnt1/bu2/OWNERS': 'set noparent\n@bu2-owner\n',
+  'tnt2/bu1/OWNERS': '@tnt2-bu1-owner\n',
+}
+
+class OwnersIndexTest(unittest.TestCase):
+
+  def index(self):
+    index = codeowners_gen.OwnersIndex()
+    index.set_owners('.', ['@org/admins'])
+    index.set_owners('tnt1', ['@tnt1-owner', '@tnt1-lead'])
+    index.set_owners('tnt1/bu1', ['@bu1-owner'])
+    index.set_owners('tnt1/bu2', ['@bu2-owner'], noparent=True)
+    return index
+
+  def test_inherited_owners(self):
+    index = self.index()
+    self.assertEqual(index.owners_of('README.md'), ['@org/admins'])
+    self.assertEqual(index.owners_of('tnt1'), ['@org/admins', '@tnt1-owner', '@tnt1-lead'])
+    self.assertEqual(index.owners_of('tnt1/bu1/team/team.yaml'), ['@org/admins', '@tnt1-owner', '@tnt1-lead', '@bu1-owner'])
+    # folders without OWNERS file have the owners of their parent
+    self.assertEqual(index.owners_of('tnt1/bu3/team.yaml'), ['@org/admins', '@tnt1-owner', '@tnt1-lead'])
+
+  def test_noparent(self):
+    index = self.index()
+    self.assertEqual(index.owners_of('tnt1/bu2/team.yaml'), ['@bu2-owner'])
+    # the owners given in the command line are added even with 'set noparent'
+    index.add_extra_owners('tnt1/bu2', ['@bu2-backup'])
+    self.assertEqual(index.owners_of('tnt1/bu2'), ['@bu2-owner', '@bu2-backup'])
+    index.add_extra_owners('.', ['@org/security'])
+    self.assertEqual(index.owners_of('tnt1/bu2'), ['@bu2-owner', '@bu2-backup'])
+    self.assertEqual(index.owners_of('tnt1/bu1'), ['@org/admins', '@org/security', '@tnt1-owner', '@tnt1-lead', '@bu1-owner'])
+
+  def test_remove_under(self):
+    index = self.index()
+    index.add_extra_owners('tnt1/bu1', ['@bu1-backup'])
+    index.remove_under('tnt1')
+    # only the owners read from OWNERS files are removed
+    self.assertEqual(index.owners_of('tnt1/bu1'), ['@org/admins', '@bu1-backup'])
+    self.assertEqual(index.owners_of('tnt1/bu2'), ['@org/admins'])
+    index.remove_under('unknown/folder')
+    self.assertEqual(index.owners_of('.'), ['@org/admins'])
+
+  def test_codeowners_lines(self):
+    index = self.index()
+    # the last matching line of CODEOWNERS takes precedence, so each line has all
+    # the owners of its folder, the owners of the root included
+    self.assertEqual(codeowners_gen.codeowners_lines(index), [
+      '* @org/admins\n',
+      '/tnt1 @org/admins @tnt1-owner @tnt1-lead\n',
+      '/tnt1/bu1 @org/admins @tnt1-owner @tnt1-lead @bu1-owner\n',
+      '/tnt1/bu2 @bu2-owner\n',
+    ])
+
+  def test_json(self):
+    index = self.index()
+    index.add_extra_owners('tnt1', ['@not-saved'])
+    self.assertEqual(index.to_json(), {
+      '.': {'owners': ['@org/admins'], 'noparent': False},
+      'tnt1': {'owners': ['@tnt1-owner', '@tnt1-lead'], 'noparent': False},
+      'tnt1/bu1': {'owners': ['@bu1-owner'], 'noparent': False},
+      'tnt1/bu2': {'owners': ['@bu2-owner'], 'noparent': True},
+    })
+
+class CodeownersTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.repo = os.path.join(self.work_dir, 'repo')
+    for path, content in OWNERS_FILES.items():
+      self.write_file(path, content)
+    self.write_file('tnt1/bu1/team.yaml', '')
+    self.index_file = os.path.join(self.work_dir, 'owners.json')
+    self.changelog = os.path.join(self.work_dir, 'changelog.txt')
+    self.codeowners = os.path.join(self.work_dir, 'CODEOWNERS')
+    # CODEOWNERS paths are relative to the root of the repository
+    self.cwd = os.getcwd()
+    os.chdir(self.repo)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    repo_index.invalidate('.')
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def write_file(self, path, content):
+    path = os.path.join(self.repo, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def generate(self, options=[]):
+    repo_index.invalidate('.')
+    args = codeowners_gen.parse_args(['--repo-root', '.', '--codeowners-out', self.codeowners,
+                                      '--index', self.index_file] + options)
+    codeowners_gen.parse_owners(args)
+    with open(self.codeowners, 'r') as f:
+      return f.read().splitlines()
+
+  def test_read_owners_file(self):
+    self.assertEqual(codeowners_gen.read_owners_file('tnt1/OWNERS'), (['@tnt1-owner', '@tnt1-lead'], False))
+    self.assertEqual(codeowners_gen.read_owners_file('tnt1/bu2/OWNERS'), (['@bu2-owner'], True))
+
+  def test_codeowners(self):
+    self.assertEqual(self.generate(['--add-owners', '*=@org/security;tnt2=@tnt2-owner']), [
+      '* @org/admins @org/security',
+      '/tnt1 @org/admins @org/security @tnt1-owner @tnt1-lead',
+      '/tnt1/bu1 @org/admins @org/security @tnt1-owner @tnt1-lead @bu1-owner',
+      '/tnt1/bu2 @bu2-owner',
+      '/tnt2 @org/admins @org/security @tnt2-owner',
+      '/tnt2/bu1 @org/admins @org/security @tnt2-owner @tnt2-bu1-owner',
+    ])
+
+  def test_changelog(self):
+    self.generate()
+    # the index is updated from the changed OWNERS files only
+    self.write_file('tnt1/bu1/OWNERS', 'set noparent\n@new-bu1-owner\n')
+    os.remove('tnt2/bu1/OWNERS')
+    self.write_file('tnt3/OWNERS', '@tnt3-owner\n')
+    with open(self.changelog, 'w') as f:
+      f.write(' M tnt1/bu1/OWNERS\n D tnt2/bu1/OWNERS\n?? tnt3/\n')
+    self.assertEqual(self.generate(['--changelog', self.changelog]), [
+      '* @org/admins',
+      '/tnt1 @org/admins @tnt1-owner @tnt1-lead',
+      '/tnt1/bu1 @new-bu1-owner',
+      '/tnt1/bu2 @bu2-owner',
+      '/tnt3 @org/admins @tnt3-owner',
+    ])
+    # a full scan finds the same owners
+    self.assertEqual(self.generate(['--rescan']), self.generate(['--changelog', self.changelog]))
+
+  def test_owners_of(self):
+    index = codeowners_gen.load_owners('.')
+    self.assertEqual(index.owners_of('tnt1/bu2/team.yaml'), ['@bu2-owner'])
+    self.assertEqual(index.owners_of('tnt2/bu1/team.yaml'), ['@org/admins', '@tnt2-bu1-owner'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+"""Tests of the configurations written by tf_dep_finder for destroying deleted packages.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_dep_finder
+import repo_index
+
+CONFIG_TF = """terraform {
+  backend "gcs" {
+    bucket = "test-bucket"
+    prefix = "ci_groups/%s"
+  }
+}
+
+provider "google" {
+  impersonate_service_account = var.terraform_service_account
+}
+"""
+
+VARIABLES_TF = """variable "terraform_service_account" {
+  type = string
+}
+"""
+
+GROUPS_TF = """resource "google_cloud_identity_group" "g" {
+  display_name = "g"
+}
+"""
+
+class DestroyTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.tf_root = os.path.join(self.work_dir, 'terraform')
+    self.destroy_root = os.path.join(self.work_dir, 'destroy')
+    self.snapshot_file = os.path.join(self.work_dir, 'graph.json')
+    for pkg in ['bu1', 'bu2']:
+      self.write_file(pkg + '/config.tf', CONFIG_TF % (pkg))
+      self.write_file(pkg + '/variables.tf', VARIABLES_TF)
+      self.write_file(pkg + '/terraform.tfvars', 'terraform_service_account = "tf-%s@test.iam.gserviceaccount.com"\n' % (pkg))
+      self.write_file(pkg + '/groups.tf', GROUPS_TF)
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def write_file(self, path, content):
+    path = os.path.join(self.tf_root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def plan(self):
+    repo_index.invalidate(self.tf_root)
+    return tf_dep_finder.plan_build_steps([], self.tf_root, waves=True, snapshot_file=self.snapshot_file,
+                                          destroy_root=self.destroy_root)
+
+  def test_settings_files(self):
+    self.assertTrue(tf_dep_finder.parse_tf(CONFIG_TF % ('bu1'), 'bu1')['SETTINGS'])
+    self.assertTrue(tf_dep_finder.parse_tf(VARIABLES_TF, 'bu1')['SETTINGS'])
+    self.assertFalse(tf_dep_finder.parse_tf(GROUPS_TF, 'bu1')['SETTINGS'])
+    self.assertFalse(tf_dep_finder.parse_tf(CONFIG_TF % ('bu1') + GROUPS_TF, 'bu1')['SETTINGS'])
+
+  def test_destroy_config_keeps_provider_settings(self):
+    self.assertEqual(self.plan(), [])
+    shutil.rmtree(os.path.join(self.tf_root, 'bu2'))
+    waves = self.plan()
+    self.assertEqual(waves, [[os.path.normpath(self.destroy_root + '/' + self.tf_root + '/bu2')]])
+    destroy_dir = waves[0][0]
+    self.assertEqual(sorted(os.listdir(destroy_dir)), ['config.tf', 'terraform.tfvars', 'variables.tf'])
+    with open(os.path.join(destroy_dir, 'config.tf'), 'r') as f:
+      self.assertEqual(f.read(), CONFIG_TF % ('bu2'))
+    with open(os.path.join(destroy_dir, 'terraform.tfvars'), 'r') as f:
+      self.assertIn('tf-bu2@test.iam.gserviceaccount.com', f.read())
+
+  def test_destroy_config_without_settings(self):
+    destroy_dir = tf_dep_finder.write_destroy_config(self.destroy_root, 'bu3', ['gs://test-bucket/ci_groups/bu3/gcs.tfstate'])
+    self.assertEqual(os.listdir(destroy_dir), ['destroy.tf'])
+    with open(os.path.join(destroy_dir, 'destroy.tf'), 'r') as f:
+      self.assertIn('prefix = "ci_groups/bu3"', f.read())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+"""Tests of the index of the group definitions, and of the detection of the groups
+defined more than once by ci-groups.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import group_index
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'tf_generator.py')
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+CONFIG = """
+gcs_bucket: test-bucket
+group_domain: example.com
+group_parent: customers/C0test
+tf_service_account: tf@test.iam.gserviceaccount.com
+"""
+
+CASE_VARIANTS = """
+- name: App
+  members:
+  - one@example.com
+- name: app
+  members:
+  - two@example.com
+"""
+
+class GroupIndexTest(unittest.TestCase):
+
+  def test_first_definition_wins(self):
+    index = group_index.GroupIndex()
+    index.add_source('b.yaml', ['g1@example.com', 'g2@example.com'])
+    index.add_source('a.yaml', ['g2@example.com'])
+    self.assertEqual(index.source_of('g1@example.com'), 'b.yaml')
+    self.assertEqual(index.source_of('g2@example.com'), 'a.yaml')
+    self.assertEqual(index.produced('b.yaml'), ['g1@example.com'])
+    self.assertEqual(index.conflict_report(), ['group g2@example.com defined in: a.yaml (#1), b.yaml (#2)'])
+
+  def test_case_insensitive_ids(self):
+    index = group_index.GroupIndex()
+    index.add_source('a.yaml', ['tnt1-bu1-App@example.com', 'tnt1-bu1-app@example.com'])
+    self.assertEqual(len(index), 1)
+    self.assertIn('TNT1-BU1-APP@example.com', index)
+    self.assertTrue(index.is_winner('tnt1-bu1-App@example.com', 'a.yaml', 0))
+    self.assertFalse(index.is_winner('tnt1-bu1-app@example.com', 'a.yaml', 1))
+    self.assertEqual(index.produced('a.yaml'), ['tnt1-bu1-App@example.com'])
+    self.assertEqual(list(index.conflicts()), ['tnt1-bu1-app@example.com'])
+
+class DuplicateGroupsTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.resources = os.path.join(self.work_dir, 'group_root')
+    self.tf_out = os.path.join(self.work_dir, 'terraform')
+    self.config = os.path.join(self.work_dir, 'config.yaml')
+    with open(self.config, 'w') as f:
+      f.write(CONFIG)
+    os.makedirs(os.path.join(self.resources, 'tnt1', 'bu1'))
+    with open(os.path.join(self.resources, 'tnt1', 'bu1', 'team.yaml'), 'w') as f:
+      f.write(CASE_VARIANTS)
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    tf_generator.conf_cache.clear()
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def generate(self, duplicate_groups):
+    args = tf_generator.parse_args(['--resources', self.resources, '--config', self.config,
+                                    '--template-dir', TEMPLATE_DIR, '--tf-out', self.tf_out,
+                                    '--duplicate-groups', duplicate_groups, 'ci-groups'])
+    return args.func(args)
+
+  def test_case_variants_are_duplicates(self):
+    self.assertFalse(self.generate('error'))
+    self.assertTrue(self.generate('warn'))
+    with open(os.path.join(self.tf_out, 'tnt1', 'bu1', 'team.tf'), 'r') as f:
+      code = f.read()
+    # only the first definition is used
+    self.assertEqual(code.count('resource "google_cloud_identity_group"'), 1)
+    self.assertIn('one@example.com', code)
+    self.assertNotIn('two@example.com', code)
+
+  def test_exit_status(self):
+    for duplicate_groups, returncode in [('error', 1), ('warn', 0)]:
+      proc = subprocess.run([sys.executable, SCRIPT, '--log-level', 'CRITICAL', '--resources', self.resources,
+                             '--config', self.config, '--template-dir', TEMPLATE_DIR, '--tf-out', self.tf_out,
+                             '--duplicate-groups', duplicate_groups, 'ci-groups'])
+      self.assertEqual(proc.returncode, returncode, duplicate_groups)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+"""Tests of identity_apply.py against identity_mock.py.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import identity_mock
+import identity_apply
+
+DOMAIN = 'example.com'
+PARENT = 'customers/C0test'
+
+GROUP_FILE = """
+- name: App%d
+  owners:
+  - owner%d@example.com
+  managers:
+  - manager@example.com
+  members:
+  - member%d@example.com
+  - member@example.com
+"""
+
+UNMANAGED = {'groupKey': {'id': 'payroll-admins@example.com'}, 'displayName': 'payroll-admins', 'parent': PARENT,
+             'memberships': [{'preferredMemberKey': {'id': 'boss@example.com'}, 'roles': [{'name': 'OWNER'}]}]}
+
+class IdentityApplyTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.work_dir, 'tnt1', 'bu1'))
+    with open(os.path.join(self.work_dir, 'tnt1', 'bu1', 'team.yaml'), 'w') as f:
+      f.write(''.join([GROUP_FILE % (i, i, i) for i in range(20)]))
+    self.desired = tf_generator.load_group_model(self.work_dir, DOMAIN)
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def apply(self, server):
+    """
+    Applies the desired groups. Returns the failures, and the changes left after.
+    """
+    client = identity_apply.IdentityClient('http://127.0.0.1:%d' % (server.server_address[1]), 'test', 4,
+                                           max_retries=10, backoff=0.001)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      current, group_names, membership_names = identity_apply.fetch_current(client, executor, PARENT)
+      plan = tf_generator.diff_groups(self.desired, current, DOMAIN)
+      failures = identity_apply.apply_plan(client, executor, plan, self.desired, PARENT, group_names, membership_names)
+      current = identity_apply.fetch_current(client, executor, PARENT)[0]
+    return failures, tf_generator.diff_groups(self.desired, current, DOMAIN), current
+
+  def test_apply_converges_and_keeps_unmanaged_groups(self):
+    server = identity_mock.start_server(snapshot={'groups': [UNMANAGED]})
+    try:
+      failures, left, current = self.apply(server)
+    finally:
+      server.shutdown()
+    self.assertEqual(failures, [])
+    self.assertEqual(sum([len(v) for v in left.values()]), 0, left)
+    self.assertIn('payroll-admins@example.com', current)
+
+  def test_retried_calls_applied_by_a_lost_reply(self):
+    server = identity_mock.start_server(error_rate=0.1, lost_reply_rate=0.3)
+    try:
+      failures, left, current = self.apply(server)
+      server.error_rate = server.lost_reply_rate = 0
+      # a second run has nothing to do
+      failures_again, left_again, current = self.apply(server)
+    finally:
+      server.shutdown()
+    self.assertEqual(failures, [])
+    self.assertEqual(sum([len(v) for v in left.values()]), 0, left)
+    self.assertEqual(failures_again, [])
+    self.assertEqual(len(current), 20)
+
+if __name__ == '__main__':
+  unittest.main()
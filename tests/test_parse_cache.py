@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+"""Tests of the cache of the parsing results of tf_dep_finder: an entry is reused
+only while its file did not change.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_dep_finder
+import repo_index
+
+BACKEND_TF = """terraform {
+  backend "gcs" {
+    bucket = "test-bucket"
+    prefix = "terraform/%s"
+  }
+}
+"""
+
+MTIME_NS = 1600000000 * 10**9
+
+class ParseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.tf_root = os.path.join(self.work_dir, 'terraform')
+    self.tf_file = os.path.join(self.tf_root, 'bu1', 'main.tf')
+    self.cache_file = os.path.join(self.work_dir, 'cache.json')
+    os.makedirs(os.path.dirname(self.tf_file))
+    self.write_tf('bu1', MTIME_NS)
+
+  def tearDown(self):
+    repo_index.invalidate(self.tf_root)
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def write_tf(self, prefix, mtime_ns):
+    with open(self.tf_file, 'w') as f:
+      f.write(BACKEND_TF % (prefix))
+    os.utime(self.tf_file, ns=(mtime_ns, mtime_ns))
+    repo_index.invalidate(self.tf_root)
+
+  def parse(self, cache):
+    stats = {'stat_hits' : 0, 'hash_hits' : 0, 'parsed' : 0}
+    tf_refs = tf_dep_finder.cached_parse_tf(self.tf_file, os.path.dirname(self.tf_file), cache, stats)
+    return tf_refs['BACKENDS'], [name for name in sorted(stats) if stats[name]]
+
+  def test_cache_entry(self):
+    cache = {}
+    self.assertEqual(self.parse(cache), (['gs://test-bucket/terraform/bu1/gcs.tfstate'], ['parsed']))
+    self.assertEqual(self.parse(cache), (['gs://test-bucket/terraform/bu1/gcs.tfstate'], ['stat_hits']))
+    # a file that was only touched is not parsed again
+    os.utime(self.tf_file, ns=(MTIME_NS + 10**9, MTIME_NS + 10**9))
+    repo_index.invalidate(self.tf_root)
+    self.assertEqual(self.parse(cache), (['gs://test-bucket/terraform/bu1/gcs.tfstate'], ['hash_hits']))
+    self.assertEqual(self.parse(cache), (['gs://test-bucket/terraform/bu1/gcs.tfstate'], ['stat_hits']))
+
+  def test_changed_mtime(self):
+    cache = {}
+    self.parse(cache)
+    # same size, new content and modification time
+    self.write_tf('bu2', MTIME_NS + 1)
+    self.assertEqual(self.parse(cache), (['gs://test-bucket/terraform/bu2/gcs.tfstate'], ['parsed']))
+    self.assertEqual(cache[self.tf_file]['mtime'], MTIME_NS + 1)
+
+  def test_changed_size(self):
+    cache = {}
+    self.parse(cache)
+    # new content, with the same modification time
+    self.write_tf('bu1/team', MTIME_NS)
+    self.assertEqual(self.parse(cache), (['gs://test-bucket/terraform/bu1/team/gcs.tfstate'], ['parsed']))
+
+  def test_cache_file(self):
+    tf_packages, backend2package = tf_dep_finder.scan_packages(self.tf_root, self.cache_file)
+    self.assertEqual(list(backend2package), ['gs://test-bucket/terraform/bu1/gcs.tfstate'])
+    self.write_tf('bu2', MTIME_NS + 1)
+    tf_packages, backend2package = tf_dep_finder.scan_packages(self.tf_root, self.cache_file)
+    self.assertEqual(list(backend2package), ['gs://test-bucket/terraform/bu2/gcs.tfstate'])
+    # the entries of deleted files are dropped
+    shutil.rmtree(os.path.dirname(self.tf_file))
+    repo_index.invalidate(self.tf_root)
+    tf_dep_finder.scan_packages(self.tf_root, self.cache_file)
+    self.assertEqual(tf_dep_finder.load_parse_cache(self.cache_file), {})
+
+  def test_cache_from_another_version(self):
+    tf_dep_finder.save_parse_cache(self.cache_file, {self.tf_file: {}})
+    self.assertEqual(len(tf_dep_finder.load_parse_cache(self.cache_file)), 1)
+    with open(self.cache_file, 'w') as f:
+      f.write('{"version": -1, "files": {}}')
+    self.assertEqual(tf_dep_finder.load_parse_cache(self.cache_file), {})
+    with open(self.cache_file, 'w') as f:
+      f.write('{"version"')
+    self.assertEqual(tf_dep_finder.load_parse_cache(self.cache_file), {})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+"""Tests of the asyncio runner of tf_pipeline, with the stub terraform of
+tests/fake_terraform.py.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import io
+import os
+import sys
+import shutil
+import asyncio
+import logging
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_pipeline
+import repo_index
+
+FAKE_TERRAFORM = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_terraform.py')]
+
+BACKEND_TF = """terraform {
+  backend "gcs" {
+    bucket = "test-bucket"
+    prefix = "terraform/%s"
+  }
+}
+"""
+
+REMOTE_STATE_TF = """data "terraform_remote_state" "foundation" {
+  backend = "gcs"
+  config = {
+    bucket = "test-bucket"
+    prefix = "terraform/foundation"
+  }
+}
+
+output "org" {
+  value = data.terraform_remote_state.foundation.outputs.org
+}
+"""
+
+# the pipeline must not wait forever, e.g. on a semaphore without slots
+TIMEOUT = 60
+
+class PipelineTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.calls_log = os.path.join(self.work_dir, 'calls.log')
+    self.environ = dict(os.environ)
+    os.environ['FAKE_TERRAFORM_DELAY'] = '0.05'
+    os.environ['FAKE_TERRAFORM_LOG'] = self.calls_log
+    os.environ.pop('FAKE_TERRAFORM_FAIL', None)
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def packages(self, *names):
+    paths = []
+    for name in names:
+      path = os.path.join(self.work_dir, 'tf', name)
+      os.makedirs(path)
+      paths.append(path)
+    return paths
+
+  def ended(self):
+    """
+    Returns the packages whose plan or apply ended, in order.
+    """
+    if not os.path.exists(self.calls_log):
+      return []
+    with open(self.calls_log, 'r') as f:
+      return [line.split(' ', 2)[2] for line in f.read().splitlines() if line.startswith('end ')]
+
+  def run_waves(self, waves, jobs, succeeded=None):
+    output_log = io.StringIO()
+    stream = io.StringIO()
+    failed = asyncio.run(asyncio.wait_for(tf_pipeline.run_waves(waves, FAKE_TERRAFORM, 'apply', jobs, output_log,
+                                                                stream, succeeded), TIMEOUT))
+    return failed, output_log.getvalue(), stream.getvalue()
+
+  def test_waves(self):
+    a, b, c = self.packages('a', 'b', 'c')
+    succeeded = []
+    failed, output_log, stream = self.run_waves([[a, b], [c]], 2, succeeded)
+    self.assertEqual(failed, [])
+    self.assertEqual(sorted(succeeded), [a, b, c])
+    ended = self.ended()
+    self.assertEqual(sorted(ended[:2]), [a, b])
+    self.assertEqual(ended[2:], [c])
+    # the outputs are streamed with the package as prefix, and logged one package at a time
+    self.assertIn('[%s] Terraform has been successfully initialized!\n' % (c), stream)
+    self.assertIn('* Processing terrform configuration %s\n' % (c), output_log)
+
+  def test_failed_package(self):
+    a, bad, c = self.packages('a', 'bad', 'c')
+    os.environ['FAKE_TERRAFORM_FAIL'] = 'bad'
+    succeeded = []
+    failed, output_log, stream = self.run_waves([[a, bad], [c]], 2, succeeded)
+    self.assertEqual(failed, [bad])
+    self.assertEqual(succeeded, [a])
+    # the next wave is not run
+    self.assertEqual(sorted(self.ended()), [a, bad])
+    self.assertIn('[%s] Error: fake failure in %s\n' % (bad, bad), stream)
+
+  def test_failed_package_stops_its_wave(self):
+    bad, b, c = self.packages('bad', 'b', 'c')
+    os.environ['FAKE_TERRAFORM_FAIL'] = 'bad'
+    failed, output_log, stream = self.run_waves([[bad, b, c]], 1)
+    self.assertEqual(failed, [bad])
+    self.assertEqual(self.ended(), [bad])
+
+class RunPipelineTest(PipelineTest):
+
+  def setUp(self):
+    super().setUp()
+    self.repo = os.path.join(self.work_dir, 'repo')
+    self.tf_out = os.path.join(self.repo, 'terraform')
+    for pkg, tf_content in [('foundation', ''), ('bu1', REMOTE_STATE_TF)]:
+      os.makedirs(os.path.join(self.tf_out, pkg))
+      with open(os.path.join(self.tf_out, pkg, 'main.tf'), 'w') as f:
+        f.write(BACKEND_TF % (pkg) + tf_content)
+    for command in [['init', '-q'], ['add', '.'],
+                    ['-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'init']]:
+      subprocess.run(['git'] + command, cwd=self.repo, check=True, stdout=subprocess.DEVNULL)
+    # the pipeline runs from the root of the git repository
+    self.cwd = os.getcwd()
+    os.chdir(self.repo)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    repo_index.invalidate(self.tf_out)
+    super().tearDown()
+
+  def run_pipeline(self, options):
+    with open(os.path.join(self.tf_out, 'foundation', 'main.tf'), 'a') as f:
+      f.write('\n')
+    repo_index.invalidate(self.tf_out)
+    args = tf_pipeline.parse_args(['--resources', 'group_root', '--config', 'config.yaml', '--template-dir', 'templates',
+                                   '--tf-out', 'terraform', '--skip-generate', '--terraform', ' '.join(FAKE_TERRAFORM),
+                                   '--output-log', os.path.join(self.work_dir, 'output.log'), '--quiet'] + options)
+    timings = []
+    ok = asyncio.run(asyncio.wait_for(tf_pipeline.run_pipeline(args, timings), TIMEOUT))
+    return ok, [phase for phase, elapsed in timings]
+
+  def test_pipeline(self):
+    ok, phases = self.run_pipeline([])
+    self.assertTrue(ok)
+    self.assertEqual(phases, ['changes', 'order', 'terraform'])
+    # bu1 reads the state of foundation
+    self.assertEqual(self.ended(), [os.path.join(self.tf_out, 'foundation'), os.path.join(self.tf_out, 'bu1')])
+
+  def test_one_job_per_cpu(self):
+    ok, phases = self.run_pipeline(['--jobs', '0'])
+    self.assertTrue(ok)
+    self.assertEqual(len(self.ended()), 2)
+
+  def test_failed_pipeline(self):
+    os.environ['FAKE_TERRAFORM_FAIL'] = 'foundation'
+    ok, phases = self.run_pipeline(['--jobs', '0'])
+    self.assertFalse(ok)
+    self.assertEqual(self.ended(), [os.path.join(self.tf_out, 'foundation')])
+
+if __name__ == '__main__':
+  unittest.main()
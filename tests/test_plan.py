@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""Tests of the plan command: groups compared with a snapshot of Cloud Identity.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import io
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import repo_index
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'golden')
+
+DOMAIN = 'example.com'
+PARENT = 'customers/C0test'
+
+GROUP_FILE = """
+- name: App1
+  owners:
+  - Owner.One@example.com
+  members:
+  - Member.One@example.com
+  - member.two@example.com
+- name: app2
+  managers:
+  - Manager.One@example.com
+"""
+
+class PlanTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.resources = os.path.join(self.work_dir, 'group_root')
+    os.makedirs(os.path.join(self.resources, 'tnt1', 'bu1'))
+    with open(os.path.join(self.resources, 'tnt1', 'bu1', 'team.yaml'), 'w') as f:
+      f.write(GROUP_FILE)
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def load(self):
+    return tf_generator.load_group_model(self.resources, DOMAIN)
+
+  def snapshot(self, groups):
+    snapshot_file = os.path.join(self.work_dir, 'snapshot.json')
+    with open(snapshot_file, 'w') as f:
+      json.dump(tf_generator.model_to_snapshot(groups, PARENT), f)
+    return tf_generator.load_identity_snapshot(snapshot_file)
+
+  def test_mixed_case_group_matches_its_snapshot(self):
+    desired = self.load()
+    self.assertIn('tnt1-bu1-app1@example.com', desired)
+    plan = tf_generator.diff_groups(desired, self.snapshot(desired), DOMAIN)
+    self.assertEqual(sum([len(v) for v in plan.values()]), 0, plan)
+
+  def test_mixed_case_snapshot_key(self):
+    desired = self.load()
+    # keys returned by the API keep the case used when the group was created
+    snapshot = tf_generator.model_to_snapshot(desired, PARENT)
+    snapshot['groups'][0]['groupKey']['id'] = 'tnt1-bu1-App1@Example.com'
+    with open(os.path.join(self.work_dir, 'snapshot.json'), 'w') as f:
+      json.dump(snapshot, f)
+    current = tf_generator.load_identity_snapshot(os.path.join(self.work_dir, 'snapshot.json'))
+    plan = tf_generator.diff_groups(desired, current, DOMAIN)
+    self.assertEqual(plan['create_groups'], [])
+    self.assertEqual(plan['delete_groups'], [])
+
+  def test_case_variants_of_a_group(self):
+    with open(os.path.join(self.resources, 'tnt1', 'bu1', 'other.yaml'), 'w') as f:
+      f.write('- name: APP1\n  members:\n  - someone@example.com\n')
+    # the definition of the first file is used, like in ci-groups
+    desired = self.load()
+    self.assertEqual(len(desired), 2)
+    self.assertEqual(desired['tnt1-bu1-app1@example.com']['full_name'], 'tnt1-bu1-APP1')
+    self.assertEqual(list(desired['tnt1-bu1-app1@example.com']['membership']), ['someone@example.com'])
+    self.assertIsNone(tf_generator.load_group_model(self.resources, DOMAIN, duplicate_groups='error'))
+
+  def test_membership_changes(self):
+    desired = self.load()
+    current = self.snapshot(desired)
+    app1 = current['tnt1-bu1-app1@example.com']['membership']
+    del app1['member.two@example.com']
+    app1['someone.else@example.com'] = tf_generator.ROLE_MEMBER
+    app1['member.one@example.com'] = tf_generator.ROLE_MEMBER | tf_generator.ROLE_MANAGER
+    plan = tf_generator.diff_groups(desired, current, DOMAIN)
+    self.assertEqual(plan['add_members'], [('tnt1-bu1-app1@example.com', 'member.two@example.com', tf_generator.ROLE_MEMBER)])
+    self.assertEqual(plan['remove_members'], [('tnt1-bu1-app1@example.com', 'someone.else@example.com', tf_generator.ROLE_MEMBER)])
+    self.assertEqual(plan['change_roles'], [('tnt1-bu1-app1@example.com', 'member.one@example.com',
+                                             tf_generator.ROLE_MEMBER | tf_generator.ROLE_MANAGER, tf_generator.ROLE_MEMBER)])
+
+  def test_only_managed_groups_are_deleted(self):
+    desired = self.load()
+    current = self.snapshot(desired)
+    for unique_id in ['payroll-admins@example.com', 'tnt1-bu1-stale@example.com', 'tnt1-bu1-x@other.com']:
+      current[unique_id] = {'display_name': unique_id, 'membership': {'a@example.com': tf_generator.ROLE_MEMBER}}
+    plan = tf_generator.diff_groups(desired, current, DOMAIN)
+    self.assertEqual(plan['delete_groups'], ['tnt1-bu1-stale@example.com'])
+    self.assertEqual(plan['remove_members'], [('tnt1-bu1-stale@example.com', 'a@example.com', tf_generator.ROLE_MEMBER)])
+
+  def test_groups_of_a_deleted_business_unit(self):
+    os.makedirs(os.path.join(self.resources, 'tnt1', 'bu2'))
+    with open(os.path.join(self.resources, 'tnt1', 'bu2', 'team.yaml'), 'w') as f:
+      f.write(GROUP_FILE)
+    snapshot_file = os.path.join(self.work_dir, 'snapshot.json')
+    with open(snapshot_file, 'w') as f:
+      json.dump(tf_generator.model_to_snapshot(self.load(), PARENT), f)
+    config_file = os.path.join(self.work_dir, 'config.yaml')
+    with open(config_file, 'w') as f:
+      f.write('group_domain: %s\n' % (DOMAIN))
+    prefixes_file = os.path.join(self.work_dir, 'prefixes.json')
+    plan_file = os.path.join(self.work_dir, 'plan.json')
+
+    def plan(options):
+      repo_index.invalidate(self.resources)
+      args = tf_generator.parse_args(['--resources', self.resources, '--config', config_file, 'plan',
+                                      '--snapshot', snapshot_file, '--plan-out', plan_file] + options)
+      self.assertTrue(args.func(args))
+      with open(plan_file, 'r') as f:
+        return json.load(f)
+    self.assertEqual(plan(['--managed-prefixes', prefixes_file])['delete_groups'], [])
+    # the whole business unit is deleted
+    shutil.rmtree(os.path.join(self.resources, 'tnt1', 'bu2'))
+    self.assertEqual(plan([])['delete_groups'], [])
+    self.assertEqual(plan(['--managed-prefixes', prefixes_file])['delete_groups'],
+                     ['tnt1-bu2-app1@example.com', 'tnt1-bu2-app2@example.com'])
+    # the prefix stays managed
+    self.assertEqual(plan(['--managed-prefixes', prefixes_file])['delete_groups'],
+                     ['tnt1-bu2-app1@example.com', 'tnt1-bu2-app2@example.com'])
+    self.assertEqual(tf_generator.load_managed_prefixes(prefixes_file), ['tnt1-bu1-', 'tnt1-bu2-'])
+
+  def test_plan_against_fixture_snapshot(self):
+    # the fixture stands in for Cloud Identity: it has mixed-case keys, a stale
+    # group of a managed prefix and a group that the tool does not manage
+    plan_file = os.path.join(self.work_dir, 'plan.json')
+    args = tf_generator.parse_args(['--resources', os.path.join(GOLDEN_DIR, 'group_root'),
+                                    '--config', os.path.join(GOLDEN_DIR, 'config.yaml'), '--template-dir', TEMPLATE_DIR,
+                                    'plan', '--snapshot', os.path.join(GOLDEN_DIR, 'identity_snapshot.json'),
+                                    '--plan-out', plan_file])
+    self.assertTrue(args.func(args))
+    with open(plan_file, 'r') as f:
+      plan = json.load(f)
+    self.assertEqual(plan, {
+      'create_groups': ['tnt1-bu2-app1-ops@example.com'],
+      'update_groups': [],
+      'delete_groups': ['tnt1-bu2-old@example.com'],
+      'add_members': [['tnt1-bu1-admins@example.com', 'dave@partner.org', tf_generator.ROLE_MEMBER],
+                      ['tnt1-bu2-app1-ops@example.com', 'ivan@example.com', tf_generator.ROLE_MEMBER | tf_generator.ROLE_MANAGER],
+                      ['tnt1-bu2-app1-ops@example.com', 'judy@example.com', tf_generator.ROLE_MEMBER]],
+      'change_roles': [['tnt1-bu1-admins@example.com', 'bob@example.com', tf_generator.ROLE_MEMBER,
+                        tf_generator.ROLE_MEMBER | tf_generator.ROLE_MANAGER]],
+      'remove_members': [['tnt1-bu1-admins@example.com', 'mallory@example.com', tf_generator.ROLE_MEMBER],
+                         ['tnt1-bu2-old@example.com', 'trent@example.com', tf_generator.ROLE_MEMBER]],
+    })
+    out = io.StringIO()
+    tf_generator.print_plan(plan, out)
+    self.assertIn('Memberships: 3 to add, 1 to change, 2 to destroy.', out.getvalue())
+
+if __name__ == '__main__':
+  unittest.main()
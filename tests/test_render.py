@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+"""Golden output tests of ci-groups: every rendering option must write exactly the
+files written by the original generator, kept in tests/data/golden/terraform.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import filecmp
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import tf_generator
+import tf_dump
+import repo_index
+import render_bench
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'golden')
+
+def tree_files(root):
+  """
+  Returns the relative paths of the files of a folder tree, without hidden files.
+  """
+  found = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    found.extend([os.path.relpath(os.path.join(dirpath, f), root) for f in filenames if not f.startswith('.')])
+  return sorted(found)
+
+class RenderTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.tf_out = os.path.join(self.work_dir, 'terraform')
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    tf_generator.conf_cache.clear()
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def generate(self, options):
+    repo_index.invalidate(self.tf_out)
+    args = tf_generator.parse_args(['--resources', os.path.join(GOLDEN_DIR, 'group_root'),
+                                    '--config', os.path.join(GOLDEN_DIR, 'config.yaml'),
+                                    '--template-dir', TEMPLATE_DIR, '--tf-out', self.tf_out] + options + ['ci-groups'])
+    return args.func(args)
+
+  def assert_golden(self):
+    expected_dir = os.path.join(GOLDEN_DIR, 'terraform')
+    files = tree_files(expected_dir)
+    self.assertEqual(tree_files(self.tf_out), files)
+    match, mismatch, errors = filecmp.cmpfiles(expected_dir, self.tf_out, files, shallow=False)
+    self.assertEqual(mismatch + errors, [])
+
+  def test_golden_output(self):
+    for options in [[], ['--fast-render'], ['--jobs', '2'], ['--jobs', '2', '--fast-render']]:
+      shutil.rmtree(self.tf_out, ignore_errors=True)
+      self.assertTrue(self.generate(options))
+      self.assert_golden()
+
+  def test_golden_output_incremental(self):
+    self.assertTrue(self.generate(['--incremental']))
+    self.assert_golden()
+    # a second run reuses the previous outputs
+    self.assertTrue(self.generate(['--incremental', '--fast-render']))
+    self.assert_golden()
+
+  def test_fast_render_same_as_tf_dump(self):
+    groups = render_bench.make_groups(200, 20, 1)
+    self.assertEqual(render_bench.render(groups, 'customers/C0test', True),
+                     render_bench.render(groups, 'customers/C0test', False))
+
+  def test_element_order_cache_bounded(self):
+    # blocks whose keys differ for each object must not grow the cache forever
+    for i in range(tf_dump.TFBlock._ORDER_CACHE_SIZE + 10):
+      block = tf_dump.TFBlock('locals', [], {'key_%d' % (i): 'value', 'name': 'n'})
+      self.assertEqual(block.order_elements(list(block.elements)), sorted(block.elements))
+    self.assertEqual(tf_dump.TFBlock._order_for.cache_info().currsize, tf_dump.TFBlock._ORDER_CACHE_SIZE)
+    block = tf_dump.TFBlock('resource', ['google_logging_folder_sink', 's'], {'name': 'n', 'folder': 'f', 'filter': ''})
+    self.assertEqual(block.order_elements(list(block.elements)), ['folder', 'name', 'filter'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+"""Tests of the index of the files of a folder tree, and of its snapshots kept
+between runs.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import repo_index
+
+FILES = [
+  'config.yaml',
+  'OWNERS',
+  'tnt1/bu1/team.yaml',
+  'tnt1/bu1/OWNERS',
+  'tnt1/bu2/team.yaml',
+  'terraform/tnt1/bu1/team.tf',
+  'terraform/tnt1/bu1/terraform.tfvars',
+  'terraform/tnt1/bu1/README.md',
+  '.hidden.yaml',
+  '.git/config.yaml',
+]
+
+# a modification time older than the snapshots, so that folders can be reused
+OLD_NS = (int(time.time()) - 3600) * 10**9
+
+class RepoIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.root = os.path.join(self.work_dir, 'repo')
+    self.snapshot_file = os.path.join(self.work_dir, 'snapshot.json')
+    for path in FILES:
+      self.write_file(path, path + '\n')
+    self.age_folders()
+
+  def tearDown(self):
+    repo_index.invalidate(self.root)
+    repo_index.snapshot_files.pop(self.root, None)
+    shutil.rmtree(self.work_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def write_file(self, path, content):
+    path = os.path.join(self.root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def age_folders(self):
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      os.utime(dirpath, ns=(OLD_NS, OLD_NS))
+
+  def test_files(self):
+    index = repo_index.RepoIndex(self.root).scan()
+    # hidden files and folders are ignored
+    self.assertEqual(index.files('yaml'), ['config.yaml', 'tnt1/bu1/team.yaml', 'tnt1/bu2/team.yaml'])
+    self.assertEqual(index.files('yaml', 'tnt1/bu1'), ['tnt1/bu1/team.yaml'])
+    self.assertEqual(index.files('owners'), ['OWNERS', 'tnt1/bu1/OWNERS'])
+    self.assertEqual(index.files('tf'), ['terraform/tnt1/bu1/team.tf'])
+    self.assertEqual(index.files('tfvars'), ['terraform/tnt1/bu1/terraform.tfvars'])
+    # the folder must match as a whole
+    self.assertEqual(index.files('yaml', 'tnt1/bu'), [])
+    st = os.stat(os.path.join(self.root, 'tnt1/bu1/team.yaml'))
+    self.assertEqual(index.stat('tnt1/bu1/team.yaml'), (st.st_size, st.st_mtime_ns))
+    self.assertIsNone(index.stat('tnt1/bu1/other.yaml'))
+
+  def test_find_files(self):
+    self.assertEqual(repo_index.find_files(self.root, 'yaml'),
+                     [self.root + '/' + path for path in ['config.yaml', 'tnt1/bu1/team.yaml', 'tnt1/bu2/team.yaml']])
+    # the index of the parent folder is used for its sub-folders
+    self.assertEqual(repo_index.find_files(self.root + '/tnt1', 'yaml'),
+                     [self.root + '/tnt1/bu1/team.yaml', self.root + '/tnt1/bu2/team.yaml'])
+    self.assertEqual(list(repo_index.indexes).count(self.root), 1)
+    self.assertNotIn(self.root + '/tnt1', repo_index.indexes)
+    # the index is kept until it is invalidated
+    self.write_file('tnt1/bu3/team.yaml', '')
+    self.assertEqual(len(repo_index.find_files(self.root, 'yaml')), 3)
+    repo_index.invalidate(self.root + '/tnt1/bu3')
+    self.assertNotIn(self.root, repo_index.indexes)
+    self.assertEqual(len(repo_index.find_files(self.root, 'yaml')), 4)
+
+  def test_file_stat(self):
+    path = os.path.join(self.root, 'tnt1/bu1/team.yaml')
+    repo_index.find_files(self.root, 'yaml')
+    self.write_file('tnt1/bu1/team.yaml', 'a longer content\n')
+    # the index gives the stat of the file when it was listed, until it is invalidated
+    self.assertEqual(repo_index.file_stat(path)[0], len('tnt1/bu1/team.yaml\n'))
+    repo_index.invalidate(self.root)
+    self.assertEqual(repo_index.file_stat(path)[0], len('a longer content\n'))
+
+  def test_snapshot(self):
+    first = repo_index.RepoIndex(self.root).scan()
+    self.assertEqual(len(first.listed), len(first.dirs))
+    repo_index.save_snapshot(self.snapshot_file, first)
+    snapshot = repo_index.load_snapshot(self.snapshot_file)
+    self.assertEqual(snapshot.dirs, json.loads(json.dumps(first.dirs)))
+    # unchanged folders are not listed again, and their file stats are not used
+    second = repo_index.RepoIndex(self.root).scan(snapshot)
+    self.assertEqual(second.listed, set())
+    self.assertEqual(second.files('yaml'), first.files('yaml'))
+    self.assertIsNone(second.stat('tnt1/bu1/team.yaml'))
+    # only the folders whose modification time changed are listed again
+    self.write_file('tnt1/bu1/other.yaml', '')
+    third = repo_index.RepoIndex(self.root).scan(second)
+    self.assertEqual(third.listed, set(['tnt1/bu1']))
+    self.assertIn('tnt1/bu1/other.yaml', third.files('yaml'))
+    self.assertIsNotNone(third.stat('tnt1/bu1/other.yaml'))
+    self.assertEqual(repo_index.changed_files(second, third, ['yaml']), [os.path.join(self.root, 'tnt1/bu1/other.yaml')])
+    # deleted folders are removed from the index
+    shutil.rmtree(os.path.join(self.root, 'tnt1/bu2'))
+    fourth = repo_index.RepoIndex(self.root).scan(third)
+    # tnt1/bu1 is listed again since it was modified just before the previous scan
+    self.assertEqual(fourth.listed, set(['tnt1', 'tnt1/bu1']))
+    self.assertNotIn('tnt1/bu2', fourth.dirs)
+
+  def test_racy_folders(self):
+    # folders modified just before the snapshot could change again within the
+    # resolution of their modification time, so they are listed again
+    now = time.time_ns()
+    os.utime(os.path.join(self.root, 'tnt1/bu1'), ns=(now, now))
+    first = repo_index.RepoIndex(self.root).scan()
+    second = repo_index.RepoIndex(self.root).scan(first)
+    self.assertEqual(second.listed, set(['tnt1/bu1']))
+    first.scanned = now + repo_index.RACY_NS + 1
+    third = repo_index.RepoIndex(self.root).scan(first)
+    self.assertEqual(third.listed, set())
+
+  def test_stale_snapshots(self):
+    index = repo_index.RepoIndex(self.root).scan()
+    repo_index.save_snapshot(self.snapshot_file, index)
+    # snapshots of another folder are not used
+    other = repo_index.RepoIndex(self.root + '/tnt1').scan(repo_index.load_snapshot(self.snapshot_file))
+    self.assertEqual(len(other.listed), len(other.dirs))
+    # snapshots of another version or that cannot be read are ignored
+    with open(self.snapshot_file, 'w') as f:
+      json.dump(dict(index.to_json(), version=repo_index.SNAPSHOT_VERSION + 1), f)
+    self.assertIsNone(repo_index.load_snapshot(self.snapshot_file))
+    with open(self.snapshot_file, 'w') as f:
+      f.write('{"version"')
+    self.assertIsNone(repo_index.load_snapshot(self.snapshot_file))
+    self.assertIsNone(repo_index.load_snapshot(os.path.join(self.work_dir, 'missing.json')))
+
+  def test_use_snapshot(self):
+    repo_index.use_snapshot(self.root, self.snapshot_file)
+    self.assertEqual(len(repo_index.find_files(self.root, 'yaml')), 3)
+    self.assertEqual(len(repo_index.indexes[self.root].listed), len(repo_index.indexes[self.root].dirs))
+    # the next run only lists the folders that changed since the snapshot
+    self.write_file('tnt1/bu2/other.yaml', '')
+    repo_index.invalidate(self.root)
+    self.assertEqual(len(repo_index.find_files(self.root, 'yaml')), 4)
+    self.assertEqual(repo_index.indexes[self.root].listed, set(['tnt1/bu2']))
+    # refresh lists all the folders again
+    self.assertEqual(len(repo_index.refresh(self.root).listed), len(repo_index.indexes[self.root].dirs))
+
+if __name__ == '__main__':
+  unittest.main()
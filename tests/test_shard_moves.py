@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+"""Tests of the moves of groups between terraform states in ci-groups.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import repo_index
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+CONFIG = """
+gcs_bucket: test-bucket
+group_domain: example.com
+group_parent: customers/C0test
+tf_service_account: tf@test.iam.gserviceaccount.com
+"""
+
+GROUP_FILE = """
+- name: app1
+  members:
+  - one@example.com
+  - two@example.com
+"""
+
+class ShardMovesTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.resources = os.path.join(self.work_dir, 'group_root')
+    self.tf_out = os.path.join(self.work_dir, 'terraform')
+    self.config = os.path.join(self.work_dir, 'config.yaml')
+    with open(self.config, 'w') as f:
+      f.write(CONFIG)
+    self.write_group_file('tnt1/bu1/team.yaml', GROUP_FILE)
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    tf_generator.conf_cache.clear()
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def write_group_file(self, path, content):
+    path = os.path.join(self.resources, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def generate(self):
+    repo_index.invalidate(self.resources)
+    args = tf_generator.parse_args(['--resources', self.resources, '--config', self.config,
+                                    '--template-dir', TEMPLATE_DIR, '--tf-out', self.tf_out,
+                                    '--incremental', 'ci-groups'])
+    return args.func(args)
+
+  def read_moves(self, shard):
+    with open(os.path.join(self.tf_out, shard, tf_generator.SHARD_MOVES_FILE), 'r') as f:
+      return f.read()
+
+  def test_move_with_new_member(self):
+    self.assertTrue(self.generate())
+    # move the group to another folder of the same business unit, adding a member
+    os.remove(os.path.join(self.resources, 'tnt1/bu1/team.yaml'))
+    self.write_group_file('tnt1/bu1/sub/team.yaml', GROUP_FILE + '  - three@example.com\n')
+    self.assertTrue(self.generate())
+    imports = self.read_moves('tnt1/bu1/sub')
+    self.assertIn('google_cloud_identity_group.tnt1-bu1-app1', imports)
+    self.assertIn('tnt1-bu1-app1_two_example_com', imports)
+    # the new member did not exist in the previous state: it is created, not imported
+    self.assertNotIn('three', imports)
+    removed = self.read_moves('tnt1/bu1')
+    self.assertIn('tnt1-bu1-app1_one_example_com', removed)
+    self.assertNotIn('three', removed)
+
+  def test_move_without_previous_files(self):
+    self.assertTrue(self.generate())
+    os.remove(os.path.join(self.tf_out, 'tnt1/bu1/team.tf'))
+    os.remove(os.path.join(self.resources, 'tnt1/bu1/team.yaml'))
+    self.write_group_file('tnt1/bu1/sub/team.yaml', GROUP_FILE)
+    self.assertFalse(self.generate())
+
+  def move_group(self):
+    self.assertTrue(self.generate())
+    os.remove(os.path.join(self.resources, 'tnt1/bu1/team.yaml'))
+    self.write_group_file('tnt1/bu1/sub/team.yaml', GROUP_FILE)
+    self.assertTrue(self.generate())
+
+  def test_moves_kept_by_the_next_runs(self):
+    self.move_group()
+    imports = self.read_moves('tnt1/bu1/sub')
+    removed = self.read_moves('tnt1/bu1')
+    # the moves were not applied yet: a second run writes them again
+    self.assertTrue(self.generate())
+    self.assertEqual(self.read_moves('tnt1/bu1/sub'), imports)
+    self.assertEqual(self.read_moves('tnt1/bu1'), removed)
+    # a member removed from the group is not moved anymore
+    self.write_group_file('tnt1/bu1/sub/team.yaml', GROUP_FILE.replace('  - two@example.com\n', ''))
+    self.assertTrue(self.generate())
+    self.assertNotIn('two', self.read_moves('tnt1/bu1/sub'))
+    self.assertNotIn('two', self.read_moves('tnt1/bu1'))
+    self.assertIn('tnt1-bu1-app1_one_example_com', self.read_moves('tnt1/bu1'))
+
+  def test_moves_cleared_once_applied(self):
+    self.move_group()
+    # only one of the two states was applied
+    self.assertEqual(tf_generator.clear_moves(self.tf_out, ['tnt1/bu1/sub']), 0)
+    self.assertEqual(tf_generator.clear_moves(self.tf_out, ['tnt1/bu1', 'tnt1/bu1/sub']), 1)
+    for shard in ['tnt1/bu1', 'tnt1/bu1/sub']:
+      self.assertFalse(os.path.exists(os.path.join(self.tf_out, shard, tf_generator.SHARD_MOVES_FILE)))
+    self.assertTrue(self.generate())
+    self.assertFalse(os.path.exists(os.path.join(self.tf_out, 'tnt1/bu1/sub', tf_generator.SHARD_MOVES_FILE)))
+
+  def test_group_moved_again_before_apply(self):
+    self.move_group()
+    os.remove(os.path.join(self.resources, 'tnt1/bu1/sub/team.yaml'))
+    self.write_group_file('tnt1/bu1/other/team.yaml', GROUP_FILE)
+    self.assertTrue(self.generate())
+    # removed from both previous states, since the first move may not be applied
+    self.assertIn('removed', self.read_moves('tnt1/bu1'))
+    self.assertIn('removed', self.read_moves('tnt1/bu1/sub'))
+    self.assertIn('import', self.read_moves('tnt1/bu1/other'))
+    # moved back to its first state: no import or removal in that state
+    os.remove(os.path.join(self.resources, 'tnt1/bu1/other/team.yaml'))
+    self.write_group_file('tnt1/bu1/team.yaml', GROUP_FILE)
+    self.assertTrue(self.generate())
+    self.assertNotIn('removed', self.read_moves('tnt1/bu1'))
+    self.assertIn('import', self.read_moves('tnt1/bu1'))
+    self.assertIn('removed', self.read_moves('tnt1/bu1/other'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+"""Tests of the single-pass terraform parser of tf_dep_finder, against the regex
+based functions it replaced (benchmarks/tf_parser_check.py).
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import tf_dep_finder
+import tf_parser_check
+
+BACKEND = """terraform {
+  backend "gcs" {
+    bucket = "tf-bootstrap"
+    prefix = "terraform/tenants/it/programs/cloud"
+  }
+}
+"""
+
+REMOTE_STATE = """data "terraform_remote_state" "foundation" {
+  backend = "gcs"
+  config = {
+    bucket = "tf-bootstrap"
+    prefix = "terraform/foundation"
+  }
+}
+"""
+
+MODULE = """module "program" {
+  source = "../../../modules/program"
+  org_id = "${data.terraform_remote_state.foundation.org_id}"
+  folder = data.terraform_remote_state.folders.outputs.id
+}
+"""
+
+ESCAPED = """locals {
+  # escaped sequences are literals, not interpolations
+  template = "$${var.not_a_reference}"
+  opening  = "$${"
+  directive = "%%{"
+}
+"""
+
+class TfParserTest(unittest.TestCase):
+
+  def check_same_as_regex(self, tf_content):
+    expected = tf_parser_check.regex_refs(tf_content, 'programs/it/cloud')
+    found = tf_dep_finder.parse_tf(tf_content, 'programs/it/cloud')
+    for key in ['BACKENDS', 'RS_DEF', 'RS_REF', 'MD_REF']:
+      self.assertEqual(sorted(found[key]), sorted(expected[key]), key)
+    return found
+
+  def test_same_as_regex(self):
+    for tf_content in [BACKEND, REMOTE_STATE, MODULE, BACKEND + REMOTE_STATE + MODULE, '']:
+      self.check_same_as_regex(tf_content)
+    found = self.check_same_as_regex(BACKEND + REMOTE_STATE + MODULE)
+    self.assertEqual(found['BACKENDS'], ['gs://tf-bootstrap/terraform/tenants/it/programs/cloud/gcs.tfstate'])
+    self.assertEqual(found['RS_DEF'], [('foundation', 'gs://tf-bootstrap/terraform/foundation/gcs.tfstate')])
+    self.assertEqual(sorted(found['RS_REF']), ['folders', 'foundation'])
+    self.assertEqual(found['MD_REF'], ['modules/program'])
+
+  def test_escaped_interpolations(self):
+    # blocks following the escaped sequences are still found
+    found = self.check_same_as_regex(ESCAPED + BACKEND + REMOTE_STATE + MODULE)
+    self.assertEqual(len(found['BACKENDS']), 1)
+    self.assertEqual(len(found['RS_DEF']), 1)
+    strings = [v for k, v in tf_dep_finder.tokenize_tf(ESCAPED) if k == 'STRING']
+    self.assertEqual(strings, ['$${var.not_a_reference}', '$${', '%%{'])
+    self.assertNotIn(('IDENT', 'not_a_reference'), list(tf_dep_finder.tokenize_tf(ESCAPED)))
+
+  def test_nested_blocks(self):
+    # the regexes do not support nested blocks in the terraform block
+    tf_content = BACKEND.replace('  }\n}', '  }\n  required_providers {\n    google = {\n      version = "~> 3.76"\n    }\n  }\n}')
+    self.assertEqual(tf_parser_check.regex_refs(tf_content, '')['BACKENDS'], [])
+    self.assertEqual(len(tf_dep_finder.parse_tf(tf_content, '')['BACKENDS']), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+"""Tests of the watch command of tf_generator: each cycle regenerates the outputs
+of the files that changed, and keeps the group moves that were not applied yet.
+
+Copyright 2021 Google LLC. This software is provided as-is, without warranty or
+representation for any use or purpose. Your use of it is subject to your 
+agreement with Google.  
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tf_generator
+import repo_index
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+CONFIG = """
+gcs_bucket: test-bucket
+group_domain: example.com
+group_parent: customers/C0test
+tf_service_account: tf@test.iam.gserviceaccount.com
+"""
+
+GROUP_FILE = """
+- name: app1
+  members:
+  - one@example.com
+"""
+
+class WatchTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    self.work_dir = tempfile.mkdtemp()
+    self.resources = os.path.join(self.work_dir, 'group_root')
+    self.tf_out = os.path.join(self.work_dir, 'terraform')
+    self.config = os.path.join(self.work_dir, 'config.yaml')
+    self.codeowners = os.path.join(self.work_dir, 'CODEOWNERS')
+    with open(self.config, 'w') as f:
+      f.write(CONFIG)
+    self.write_file('tnt1/bu1/team.yaml', GROUP_FILE)
+    self.write_file('tnt1/bu2/team.yaml', GROUP_FILE)
+    self.write_file('tnt1/OWNERS', '@tnt1-owner\n')
+
+  def tearDown(self):
+    repo_index.invalidate(self.resources)
+    repo_index.invalidate(self.tf_out)
+    shutil.rmtree(self.work_dir)
+    tf_generator.conf_cache.clear()
+    logging.getLogger().setLevel(logging.WARNING)
+
+  def write_file(self, path, content):
+    path = os.path.join(self.resources, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def read_output(self, path):
+    path = os.path.join(self.tf_out, path)
+    if not os.path.exists(path):
+      return None
+    with open(path, 'r') as f:
+      return f.read()
+
+  def watch(self, cycles):
+    """
+    Runs the watch command. Each wait for changes runs the next function of cycles,
+    the last wait stops the command like Ctrl-C.
+    """
+    pending = list(cycles)
+
+    def sleep(interval):
+      if not pending:
+        raise KeyboardInterrupt()
+      pending.pop(0)()
+
+    args = tf_generator.parse_args(['--resources', self.resources, '--config', self.config,
+                                    '--template-dir', TEMPLATE_DIR, '--tf-out', self.tf_out,
+                                    'watch', '--codeowners-out', self.codeowners])
+    with mock.patch('time.sleep', side_effect=sleep):
+      self.assertTrue(args.func(args))
+    self.assertEqual(pending, [])
+
+  def test_watch(self):
+    moves = {}
+
+    def move_group():
+      self.assertIn('one@example.com', self.read_output('tnt1/bu1/team.tf'))
+      os.remove(os.path.join(self.resources, 'tnt1/bu1/team.yaml'))
+      self.write_file('tnt1/bu1/sub/team.yaml', GROUP_FILE)
+
+    def change_other_group():
+      moves['imports'] = self.read_output('tnt1/bu1/sub/' + tf_generator.SHARD_MOVES_FILE)
+      moves['removed'] = self.read_output('tnt1/bu1/' + tf_generator.SHARD_MOVES_FILE)
+      self.assertIn('import', moves['imports'])
+      self.assertIn('removed', moves['removed'])
+      self.write_file('tnt1/bu2/team.yaml', GROUP_FILE + '  - two@example.com\n')
+
+    def change_config():
+      self.assertIn('two@example.com', self.read_output('tnt1/bu2/team.tf'))
+      with open(self.config, 'a') as f:
+        f.write('# all the files are generated again\n')
+
+    def change_owners():
+      self.write_file('tnt1/bu2/OWNERS', 'set noparent\n@bu2-owner\n')
+
+    # the last cycle has no change
+    self.watch([move_group, change_other_group, change_config, change_owners, lambda: None])
+    # the moves were not applied, every cycle kept them
+    self.assertEqual(self.read_output('tnt1/bu1/sub/' + tf_generator.SHARD_MOVES_FILE), moves['imports'])
+    self.assertEqual(self.read_output('tnt1/bu1/' + tf_generator.SHARD_MOVES_FILE), moves['removed'])
+    with open(self.codeowners, 'r') as f:
+      lines = f.read().splitlines()
+    self.assertEqual([line.split(' ', 1)[1] for line in lines], ['@tnt1-owner', '@bu2-owner'])
+
+  def test_errors_do_not_stop_watching(self):
+
+    def break_group():
+      self.write_file('tnt1/bu2/team.yaml', '- name: [app2\n')
+
+    def fix_group():
+      self.assertNotIn('app2', self.read_output('tnt1/bu2/team.tf'))
+      self.write_file('tnt1/bu2/team.yaml', GROUP_FILE.replace('app1', 'app2'))
+
+    self.watch([break_group, fix_group])
+    self.assertIn('app2', self.read_output('tnt1/bu2/team.tf'))
+
+if __name__ == '__main__':
+  unittest.main()